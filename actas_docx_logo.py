@@ -1,16 +1,21 @@
 # actas_docx_logo.py — Renderizar actas DOCX con logo en cabecera y listarlas por caso
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Query
 from pydantic import BaseModel
 from typing import Optional
 from uuid import uuid4
-from pathlib import Path
-import tempfile
-import datetime as dt
+from io import BytesIO
 
 import docx
 from docx.shared import Cm
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 import requests
+from starlette.background import BackgroundTask
+
+import actas_render
+import actas_storage
+import admin_auth
+import signing
+from db import pg_conn
 
 router = APIRouter(prefix="/api/actas", tags=["actas"])
 
@@ -31,25 +36,15 @@ class ActaPayload(BaseModel):
 
 
 class ActaInfo(BaseModel):
+    id: Optional[int] = None
     filename: str
     url: str
     created_at: Optional[str] = None
 
 
-BASE_DIR = Path("generated_actas")
-BASE_DIR.mkdir(parents=True, exist_ok=True)
-
-
-@router.post("/render_docx")
-def render_docx_acta(body: ActaPayload):
-    """Genera un DOCX de acta con cabecera de logo.
-
-    El archivo se guarda en generated_actas y se devuelve una URL descargable.
-    Si se facilita caso_id, el nombre del fichero incluye ese ID para poder listarlo después.
-    """
-    if not body.case_no or not body.date_iso:
-        raise HTTPException(400, "Faltan datos básicos del acta (expediente y fecha).")
-
+def build_docx(payload: dict) -> bytes:
+    """Construye el DOCX con cabecera de logo (se ejecuta en el pool de actas_render)."""
+    body = ActaPayload(**payload)
     doc = docx.Document()
 
     # Cabecera con logo
@@ -57,16 +52,12 @@ def render_docx_acta(body: ActaPayload):
         try:
             resp = requests.get(body.logo_url, timeout=8)
             if resp.ok:
-                tmpdir = Path(tempfile.gettempdir())
-                img_path = tmpdir / f"logo_acta_{uuid4().hex}.png"
-                img_path.write_bytes(resp.content)
-
                 section = doc.sections[0]
                 header = section.header
                 paragraph = header.paragraphs[0]
                 paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
                 run = paragraph.add_run()
-                run.add_picture(str(img_path), width=Cm(body.logo_width_cm))
+                run.add_picture(BytesIO(resp.content), width=Cm(body.logo_width_cm))
         except Exception:
             # No rompemos la generación de acta si hay un problema con el logo
             pass
@@ -113,46 +104,97 @@ def render_docx_acta(body: ActaPayload):
     doc.add_paragraph("La persona mediadora: ________________________________")
     doc.add_paragraph("Las partes intervinientes: ____________________________")
 
-    # Guardar DOCX en disco
+    buf = BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+@router.post("/render_docx")
+async def render_docx_acta(
+    body: ActaPayload,
+    wait: float = Query(actas_render.ACTAS_RENDER_WAIT_DEFAULT, ge=0, le=60),
+    stream: bool = False,
+    persist: bool = False,
+):
+    """Genera un DOCX de acta con cabecera de logo.
+
+    El render va a la cola de actas_render: con wait=0 se devuelve el job_id al
+    momento (202); con wait>0 se espera hasta ese tiempo y se devuelve la URL.
+    El archivo se guarda con actas_storage; si se facilita caso_id queda
+    registrado con él para poder listarlo después.
+    Con stream=true el DOCX va en la propia respuesta y solo se guarda si
+    además persist=true.
+    """
+    if not body.case_no or not body.date_iso:
+        raise HTTPException(400, "Faltan datos básicos del acta (expediente y fecha).")
+
     prefix = f"acta_caso-{body.caso_id}_" if body.caso_id else "acta_"
     file_id = uuid4().hex
     filename = f"{prefix}{file_id}.docx"
-    file_path = BASE_DIR / filename
-    doc.save(str(file_path))
 
-    # URL pública (ajusta a tu servidor de estáticos)
-    url = f"/static/actas/{filename}"
+    def save(data: bytes) -> int:
+        return actas_storage.save(
+            data, filename, caso_id=body.caso_id, case_no=body.case_no, source="actas_logo"
+        )
 
-    return {"ok": True, "url": url}
+    if stream:
+        data = await actas_render.render_bytes(build_docx, body.dict())
+        background = BackgroundTask(save, data) if persist else None
+        return actas_render.stream_response(data, filename, background)
+
+    def persist_job(data: bytes) -> dict:
+        doc_id = save(data)
+        return {"document_id": doc_id, "url": actas_storage.download_path(doc_id)}
+
+    job = actas_render.submit(build_docx, body.dict(), filename, persist_job)
+    return await actas_render.respond(job, wait)
+
+
+def _caso_owner(caso_id: str) -> Optional[str]:
+    """Email del mediador dueño del caso (tabla casos), o None."""
+    if not caso_id.isdigit():
+        return None
+    try:
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute("SELECT mediador_email FROM casos WHERE id=%s;", (int(caso_id),))
+            row = cur.fetchone()
+    except Exception:
+        return None
+    return (row[0] or "").strip().lower() if row else None
 
 
 @router.get("")
-def list_actas(caso_id: str):
+def list_actas(
+    caso_id: str,
+    before_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    authorization: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
+):
     """Lista actas DOCX vinculadas a un caso concreto.
 
-    Busca ficheros en generated_actas cuyo nombre empiece por 'acta_caso-{caso_id}_'.
+    Solo para el mediador dueño del caso (Bearer con su token de sesión) o admin
+    (X-Admin-Token): cada URL es un enlace de descarga firmado.
+    Consulta indexada sobre actas_documentos, más recientes primero. Para la
+    página siguiente, before_id = id del último elemento recibido.
     """
     if not caso_id:
         raise HTTPException(400, "caso_id requerido")
+    if not admin_auth.is_admin(x_admin_token):
+        email = signing.email_from_authorization(authorization)
+        if not email:
+            raise HTTPException(401, "Unauthorized")
+        if _caso_owner(caso_id) != email:
+            raise HTTPException(403, "No tienes acceso a este caso")
 
-    prefix = f"acta_caso-{caso_id}_"
     results = []
-
-    if not BASE_DIR.exists():
-        return []
-
-    for entry in BASE_DIR.iterdir():
-        if not entry.is_file():
-            continue
-        if not entry.name.startswith(prefix):
-            continue
-        stat = entry.stat()
-        created_at = dt.datetime.fromtimestamp(stat.st_mtime).isoformat()
-        url = f"/static/actas/{entry.name}"
+    for doc_id, filename, _size, created_at in actas_storage.list_for_caso(caso_id, before_id, limit):
         results.append(
-            ActaInfo(filename=entry.name, url=url, created_at=created_at).dict()
+            ActaInfo(
+                id=doc_id,
+                filename=filename,
+                url=actas_storage.download_path(doc_id),
+                created_at=created_at.isoformat() if created_at else None,
+            ).dict()
         )
-
-    # Ordenamos por fecha descendente
-    results.sort(key=lambda a: a.get("created_at") or "", reverse=True)
     return results
@@ -0,0 +1,451 @@
+# actas_render.py — Cola de render de actas DOCX fuera de la petición
+# ---------------------------------------------------------------
+# - Las rutas de actas (actas_routes, actas_docx_logo) ya no construyen el DOCX en
+#   el threadpool de la petición: encolan un trabajo en un pool de procesos acotado
+#   y devuelven un job_id al momento.
+# - GET /api/actas/jobs/{job_id}           → estado (queued | running | done | failed)
+# - GET /api/actas/jobs/{job_id}/download  → el DOCX cuando está listo
+# - Al terminar, el DOCX se guarda con actas_storage (S3 o local + actas_documentos)
+#   en un pool de hilos propio: el hilo de gestión del ProcessPoolExecutor solo
+#   entrega resultados, no hace E/S.
+# - ?wait=N en el POST espera hasta N s y, si da tiempo, responde como antes
+#   ({"ok": true, "url": ...}) para los clientes antiguos. La espera es async:
+#   no ocupa hilos del threadpool.
+# - Los trabajos viven en memoria del proceso (TTL ACTAS_JOB_TTL).
+# - ?stream=true: el DOCX se genera en memoria (BytesIO en el pool) y se devuelve
+#   en la misma respuesta (chunked, Content-Disposition), sin ficheros ni segunda
+#   petición. Guardarlo es opcional (&persist=true, tras enviar la respuesta).
+#
+# Renders/s y p95 con 50 envíos concurrentes (en línea vs pool):
+#   python actas_render.py --bench -c 50
+# Latencia y E/S de disco (/proc/self/io) guardando + descargando vs en memoria:
+#   python actas_render.py --bench-stream -n 200
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional
+from urllib.parse import quote
+from uuid import uuid4
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+import actas_storage
+
+ACTAS_RENDER_WORKERS      = int(os.getenv("ACTAS_RENDER_WORKERS", "2"))
+ACTAS_RENDER_QUEUE_MAX    = int(os.getenv("ACTAS_RENDER_QUEUE_MAX", "200"))
+ACTAS_RENDER_WAIT_DEFAULT = float(os.getenv("ACTAS_RENDER_WAIT_DEFAULT", "15"))
+ACTAS_JOB_TTL             = int(os.getenv("ACTAS_JOB_TTL", "3600"))
+ACTAS_STREAM_TIMEOUT      = float(os.getenv("ACTAS_STREAM_TIMEOUT", "60"))
+ACTAS_PERSIST_WORKERS     = int(os.getenv("ACTAS_PERSIST_WORKERS", "4"))
+STREAM_CHUNK              = 64 * 1024
+
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+router = APIRouter(prefix="/api/actas/jobs", tags=["actas"])
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_persist_executor = ThreadPoolExecutor(max_workers=ACTAS_PERSIST_WORKERS, thread_name_prefix="actas-persist")
+_jobs: Dict[str, dict] = {}
+_jobs_lock = threading.Lock()
+_durations: deque = deque(maxlen=500)  # s desde que se encola hasta que termina
+STATS = {"submitted": 0, "done": 0, "failed": 0, "rejected": 0, "streamed": 0, "streaming": 0}
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(
+                    max_workers=ACTAS_RENDER_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+    return _pool
+
+
+def _reset_pool(failed: ProcessPoolExecutor) -> None:
+    """Descarta un pool roto, solo si sigue siendo el actual (otro ya pudo rehacerlo)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not failed:
+            return
+        _pool = None
+    failed.shutdown(wait=False, cancel_futures=True)
+    print("[Actas] Pool de render roto (proceso hijo muerto): se crea uno nuevo")
+
+
+def _submit_build(build: Callable[[dict], bytes], payload: dict) -> Future:
+    """
+    submit() al pool. Si un hijo murió, el pool queda roto para siempre: se
+    rehace y se reintenta una vez; y si el trabajo acaba con BrokenProcessPool,
+    el siguiente envío ya encuentra un pool nuevo.
+    """
+    pool = _get_pool()
+    try:
+        future = pool.submit(build, payload)
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        pool = _get_pool()
+        future = pool.submit(build, payload)
+
+    def _check_broken(f: Future) -> None:
+        if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool):
+            _reset_pool(pool)
+
+    future.add_done_callback(_check_broken)
+    return future
+
+
+def _purge_expired() -> None:
+    limit = time.time() - ACTAS_JOB_TTL
+    with _jobs_lock:
+        for job_id in [j for j, job in _jobs.items() if job["finished_at"] and job["finished_at"] < limit]:
+            _jobs.pop(job_id, None)
+
+
+def _pending() -> int:
+    with _jobs_lock:
+        return sum(1 for job in _jobs.values() if job["status"] in ("queued", "running")) + STATS["streaming"]
+
+
+def _count_streaming(delta: int) -> None:
+    # también desde el hilo de gestión del pool (done callback)
+    with _jobs_lock:
+        STATS["streaming"] += delta
+
+
+def _finish(job: dict, persist: Callable[[bytes], dict], future: Future) -> None:
+    """Guarda el DOCX (persist: S3 + BD) y cierra el trabajo. Corre en _persist_executor."""
+    try:
+        data = future.result()
+        job.update(persist(data))
+        job["bytes"] = len(data)
+        job["status"] = "done"
+        STATS["done"] += 1
+    except Exception as e:
+        job["status"] = "failed"
+        job["error"] = str(e)[:500]
+        STATS["failed"] += 1
+        print(f"[Actas] Error generando {job['filename']}: {e}")
+    job["finished_at"] = time.time()
+    _durations.append(job["finished_at"] - job["created_at"])
+    job["done"].set_result(None)
+
+
+def _hand_off(job: dict, persist: Callable[[bytes], dict], future: Future) -> None:
+    """Callback del pool (hilo de gestión): pasa el guardado al pool de hilos."""
+    try:
+        _persist_executor.submit(_finish, job, persist, future)
+    except RuntimeError:
+        _finish(job, persist, future)  # apagando: ya no hay pool de hilos
+
+
+def submit(build: Callable[[dict], bytes], payload: dict, filename: str,
+           persist: Callable[[bytes], dict]) -> dict:
+    """
+    Encola `build(payload) -> bytes` en el pool. `build` debe ser una función de
+    nivel de módulo (se envía al proceso hijo por referencia). `persist(data)` se
+    ejecuta en este proceso al terminar y devuelve {"url", "document_id"}.
+    """
+    _purge_expired()
+    if _pending() >= ACTAS_RENDER_QUEUE_MAX:
+        STATS["rejected"] += 1
+        raise HTTPException(503, "Hay demasiadas actas en cola; inténtalo en unos segundos.")
+
+    job = {
+        "id": uuid4().hex,
+        "status": "queued",
+        "filename": filename,
+        "url": None,
+        "document_id": None,
+        "bytes": None,
+        "error": None,
+        "created_at": time.time(),
+        "finished_at": None,
+        "done": Future(),  # se resuelve cuando _finish ha guardado (o fallado)
+    }
+    future = _submit_build(build, payload)
+    job["future"] = future
+    with _jobs_lock:
+        _jobs[job["id"]] = job
+    STATS["submitted"] += 1
+    future.add_done_callback(lambda f: _hand_off(job, persist, f))
+    return job
+
+
+def _status(job: dict) -> dict:
+    status = job["status"]
+    if status == "queued" and (job["future"].running() or job["future"].done()):  # renderizando o guardando
+        status = "running"
+    out = {
+        "ok": True,
+        "job_id": job["id"],
+        "status": status,
+        "filename": job["filename"],
+        "status_url": f"/api/actas/jobs/{job['id']}",
+    }
+    if status == "done":
+        out["url"] = job["url"]
+        out["document_id"] = job["document_id"]
+        out["download_url"] = actas_storage.download_path(job["document_id"])
+        out["bytes"] = job["bytes"]
+        out["seconds"] = round(job["finished_at"] - job["created_at"], 3)
+    if status == "failed":
+        out["error"] = job["error"]
+    return out
+
+
+async def respond(job: dict, wait: float):
+    """
+    Respuesta del POST: con wait>0 espera (sin bloquear hilos) hasta `wait` s. Si
+    terminó, responde como la versión síncrona; si no, 202 con el job_id.
+    """
+    if wait > 0 and job["status"] in ("queued", "running"):
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job["done"])), timeout=wait)
+        except asyncio.TimeoutError:
+            pass
+
+    if job["status"] == "done":
+        return {
+            "ok": True,
+            "url": job["url"],
+            "job_id": job["id"],
+            "document_id": job["document_id"],
+            "download_url": actas_storage.download_path(job["document_id"]),
+        }
+    if job["status"] == "failed":
+        raise HTTPException(500, f"Error generando el acta: {job['error']}")
+    return JSONResponse(_status(job), status_code=202)
+
+
+async def render_bytes(build: Callable[[dict], bytes], payload: dict) -> bytes:
+    """Modo stream: render en el pool esperando el resultado (sin crear trabajo)."""
+    if _pending() >= ACTAS_RENDER_QUEUE_MAX:
+        STATS["rejected"] += 1
+        raise HTTPException(503, "Hay demasiadas actas en cola; inténtalo en unos segundos.")
+    _count_streaming(1)
+    t0 = time.time()
+    try:
+        future = _submit_build(build, payload)
+    except Exception as e:
+        _count_streaming(-1)
+        STATS["failed"] += 1
+        raise HTTPException(500, f"Error generando el acta: {e}")
+    # Cuenta como pendiente hasta que el pool lo suelta de verdad, no hasta el 504:
+    # si no, ACTAS_RENDER_QUEUE_MAX deja de acotar el pool con renders lentos.
+    future.add_done_callback(lambda f: _count_streaming(-1))
+    try:
+        data = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=ACTAS_STREAM_TIMEOUT)
+    except asyncio.TimeoutError:
+        future.cancel()  # solo surte efecto si aún no ha empezado
+        raise HTTPException(504, "El acta está tardando demasiado en generarse")
+    except asyncio.CancelledError:
+        future.cancel()  # el cliente se fue
+        raise
+    except Exception as e:
+        STATS["failed"] += 1
+        raise HTTPException(500, f"Error generando el acta: {e}")
+    STATS["streamed"] += 1
+    _durations.append(time.time() - t0)
+    return data
+
+
+def stream_response(data: bytes, filename: str, background: Optional[BackgroundTask] = None) -> StreamingResponse:
+    """DOCX en memoria → respuesta por trozos (sin Content-Length: chunked)."""
+    view = memoryview(data)
+
+    async def _chunks():
+        for i in range(0, len(view), STREAM_CHUNK):
+            yield bytes(view[i:i + STREAM_CHUNK])
+
+    headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"}
+    return StreamingResponse(_chunks(), media_type=DOCX_MEDIA_TYPE, headers=headers, background=background)
+
+
+def _get_job(job_id: str) -> dict:
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if not job:
+        raise HTTPException(404, "Trabajo no encontrado (o caducado)")
+    return job
+
+
+@router.get("/metrics")
+def actas_jobs_metrics():
+    """Trabajos de este proceso y latencia encolado → terminado."""
+    durations = sorted(_durations)
+    p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))] if durations else 0.0
+    return {
+        "ok": True,
+        "workers": ACTAS_RENDER_WORKERS,
+        "pending": _pending(),
+        "stats": dict(STATS),
+        "p50_seconds": round(durations[len(durations) // 2], 3) if durations else 0.0,
+        "p95_seconds": round(p95, 3),
+    }
+
+
+@router.get("/{job_id}")
+def actas_job_status(job_id: str):
+    return _status(_get_job(job_id))
+
+
+@router.get("/{job_id}/download")
+def actas_job_download(job_id: str):
+    job = _get_job(job_id)
+    if job["status"] == "failed":
+        raise HTTPException(500, f"Error generando el acta: {job['error']}")
+    if job["status"] != "done":
+        raise HTTPException(409, "El acta todavía se está generando")
+    return actas_storage.serve(job["document_id"])  # el job_id (uuid) ya es el permiso
+
+
+@router.on_event("shutdown")
+def _shutdown_pool():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _persist_executor.shutdown(wait=True)  # terminar los guardados en curso
+
+
+# ---------------- Benchmark ----------------
+
+_SAMPLE = {
+    "case_no": "EXP-2024-001",
+    "date_iso": "2024-05-01",
+    "mediator_alias": "Mediadora de prueba",
+    "parties": "Parte A y Parte B",
+    "summary": "Resumen de la sesión de mediación. " * 80,
+    "agreements": "Acuerdo de ejemplo. " * 40,
+    "confidentiality": True,
+    "logo_url": None,
+}
+
+
+def _percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def bench(concurrency: int, directory: str) -> None:
+    """
+    `concurrency` envíos a la vez. En línea: un threadpool como el de Starlette
+    (40 hilos) construye y guarda el DOCX, como hacía la petición. Pool: los mismos
+    trabajos vía submit(). Latencia = desde el envío hasta el fichero escrito.
+    """
+    from actas_routes import build_docx
+
+    def _inline(i: int, t_submit: float) -> float:
+        data = build_docx(_SAMPLE)
+        with open(os.path.join(directory, f"bench_inline_{i}.docx"), "wb") as fh:
+            fh.write(data)
+        return time.perf_counter() - t_submit
+
+    os.makedirs(directory, exist_ok=True)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=40) as ex:
+        futures = [ex.submit(_inline, i, time.perf_counter()) for i in range(concurrency)]
+        lat_inline = [f.result() for f in futures]
+    inline_s = time.perf_counter() - t0
+
+    _get_pool().submit(int, 0).result()  # arrancar los procesos fuera de la medida
+    t0 = time.perf_counter()
+    def _to_disk(i: int):
+        def persist(data: bytes) -> dict:
+            path = os.path.join(directory, f"bench_pool_{i}.docx")
+            with open(path, "wb") as fh:
+                fh.write(data)
+            return {"url": path}
+        return persist
+
+    jobs = [submit(build_docx, _SAMPLE, f"bench_pool_{i}.docx", _to_disk(i)) for i in range(concurrency)]
+    while any(j["status"] in ("queued", "running") for j in jobs):
+        time.sleep(0.005)
+    pool_s = time.perf_counter() - t0
+    lat_pool = [j["finished_at"] - j["created_at"] for j in jobs]
+
+    print(f"{concurrency} actas a la vez, {ACTAS_RENDER_WORKERS} procesos")
+    print(f"en línea: {concurrency / inline_s:.1f} actas/s  p95={_percentile(lat_inline, 0.95):.3f}s")
+    print(f"pool:     {concurrency / pool_s:.1f} actas/s  p95={_percentile(lat_pool, 0.95):.3f}s")
+
+
+def _proc_io() -> Dict[str, int]:
+    """Contadores de E/S del proceso (Linux). Vacío si no hay /proc."""
+    try:
+        with open("/proc/self/io") as fh:
+            return {k: int(v) for k, v in (line.split(":") for line in fh)}
+    except OSError:
+        return {}
+
+
+def bench_stream(n: int, directory: str) -> None:
+    """
+    Por acta, en serie y en este proceso (sin red):
+    - disco:    build → LocalStorage.put (tmp + rename) → lectura por trozos,
+                como el POST que guarda + el GET de la URL devuelta.
+    - memoria:  build → los trozos de stream_response(), como ?stream=true.
+    Se mide la latencia y las escrituras/lecturas a disco de cada modo.
+    """
+    from actas_routes import build_docx
+
+    storage = actas_storage.LocalStorage(directory)
+    os.makedirs(directory, exist_ok=True)
+
+    def _disk(i: int) -> int:
+        key = f"bench/{i}.docx"
+        storage.put(key, build_docx(_SAMPLE), DOCX_MEDIA_TYPE)
+        size = sum(len(chunk) for chunk in storage.stream(key))
+        storage.delete(key)
+        return size
+
+    async def _drain(response: StreamingResponse) -> int:
+        return sum([len(chunk) async for chunk in response.body_iterator])
+
+    def _memory(i: int) -> int:
+        return asyncio.run(_drain(stream_response(build_docx(_SAMPLE), f"bench_{i}.docx")))
+
+    build_docx(_SAMPLE)  # imports y cachés fuera de la medida
+    print(f"{n} actas en serie")
+    for name, fn in (("disco", _disk), ("memoria", _memory)):
+        io0 = _proc_io()
+        lat = []
+        t0 = time.perf_counter()
+        for i in range(n):
+            t = time.perf_counter()
+            fn(i)
+            lat.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - t0
+        io1 = _proc_io()
+        io = {k: (io1[k] - io0[k]) / n for k in io1}
+        print(
+            f"{name:8s} p50={_percentile(lat, 0.5) * 1000:.1f}ms p95={_percentile(lat, 0.95) * 1000:.1f}ms "
+            f"{n / elapsed:.1f} actas/s | por acta: write() {io.get('syscw', 0):.1f}, "
+            f"read() {io.get('syscr', 0):.1f}, a disco {io.get('write_bytes', 0) / 1024:.1f} KB"
+        )
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Cola de render de actas DOCX")
+    ap.add_argument("--bench", action="store_true")
+    ap.add_argument("--bench-stream", action="store_true")
+    ap.add_argument("-n", type=int, default=200)
+    ap.add_argument("-c", "--concurrency", type=int, default=50)
+    ap.add_argument("--dir", default="/tmp/actas_bench")
+    args = ap.parse_args()
+    if args.bench:
+        bench(args.concurrency, args.dir)
+    elif args.bench_stream:
+        bench_stream(args.n, args.dir)
+    else:
+        ap.print_help()
@@ -1,19 +1,19 @@
 # actas_routes.py — generación de ACTAS en DOCX (simple y robusto)
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Query, Request
 from pydantic import BaseModel
 from typing import Optional
-import os
 from datetime import datetime
 from io import BytesIO
 
 import requests
 from docx import Document
 from docx.shared import Inches
+from starlette.background import BackgroundTask
 
-actas_router = APIRouter()
+import actas_render
+import actas_storage
 
-ACTAS_DIR = os.path.join("uploads", "actas")
-os.makedirs(ACTAS_DIR, exist_ok=True)
+actas_router = APIRouter()
 
 class ActaIn(BaseModel):
     case_no: str
@@ -25,49 +25,78 @@ class ActaIn(BaseModel):
     confidentiality: Optional[bool] = True
     logo_url: Optional[str] = "https://mediazion.eu/logo.png"
 
+def build_docx(payload: dict) -> bytes:
+    """Construye el DOCX (se ejecuta en el pool de actas_render)."""
+    body = ActaIn(**payload)
+    doc = Document()
+
+    # Logo opcional
+    if body.logo_url:
+        try:
+            resp = requests.get(body.logo_url, timeout=5)
+            resp.raise_for_status()
+            image_stream = BytesIO(resp.content)
+            doc.add_picture(image_stream, width=Inches(1.5))
+        except Exception:
+            # si falla el logo, no rompemos el acta
+            pass
+
+    doc.add_heading("ACTA DE MEDIACIÓN", level=1)
+    doc.add_paragraph(f"Expediente: {body.case_no}")
+    doc.add_paragraph(f"Fecha: {body.date_iso}")
+    doc.add_paragraph(f"Mediador/a: {body.mediator_alias}")
+    doc.add_paragraph(f"Partes: {body.parties}")
+
+    doc.add_heading("Resumen / Contenido", level=2)
+    doc.add_paragraph(body.summary)
+
+    doc.add_heading("Acuerdos alcanzados", level=2)
+    doc.add_paragraph(body.agreements or "Sin acuerdos adicionales registrados.")
+
+    if body.confidentiality:
+        doc.add_paragraph("")
+        doc.add_paragraph(
+            "Cláusula de confidencialidad: Las partes se comprometen a mantener la confidencialidad "
+            "del proceso de mediación y de la información intercambiada."
+        )
+
+    buf = BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
 @actas_router.post("/actas/render_docx")
-def render_docx(body: ActaIn, request: Request):
-    try:
-        doc = Document()
-
-        # Logo opcional
-        if body.logo_url:
-            try:
-                resp = requests.get(body.logo_url, timeout=5)
-                resp.raise_for_status()
-                image_stream = BytesIO(resp.content)
-                doc.add_picture(image_stream, width=Inches(1.5))
-            except Exception:
-                # si falla el logo, no rompemos el acta
-                pass
-
-        doc.add_heading("ACTA DE MEDIACIÓN", level=1)
-        doc.add_paragraph(f"Expediente: {body.case_no}")
-        doc.add_paragraph(f"Fecha: {body.date_iso}")
-        doc.add_paragraph(f"Mediador/a: {body.mediator_alias}")
-        doc.add_paragraph(f"Partes: {body.parties}")
-
-        doc.add_heading("Resumen / Contenido", level=2)
-        doc.add_paragraph(body.summary)
-
-        doc.add_heading("Acuerdos alcanzados", level=2)
-        doc.add_paragraph(body.agreements or "Sin acuerdos adicionales registrados.")
-
-        if body.confidentiality:
-            doc.add_paragraph("")
-            doc.add_paragraph(
-                "Cláusula de confidencialidad: Las partes se comprometen a mantener la confidencialidad "
-                "del proceso de mediación y de la información intercambiada."
+async def render_docx(
+    body: ActaIn,
+    request: Request,
+    wait: float = Query(actas_render.ACTAS_RENDER_WAIT_DEFAULT, ge=0, le=60),
+    stream: bool = False,
+    persist: bool = False,
+):
+    """
+    Encola el render. Con wait=0 devuelve 202 y el job_id al momento; con wait>0
+    (por defecto, para clientes antiguos) responde con la URL si termina a tiempo.
+    Con stream=true devuelve el DOCX en la propia respuesta; solo se guarda si
+    además persist=true.
+    """
+    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    safe_case = body.case_no.replace(" ", "_")
+    filename = f"Acta_{safe_case}_{ts}.docx"
+
+    if stream:
+        data = await actas_render.render_bytes(build_docx, body.dict())
+        background = None
+        if persist:
+            background = BackgroundTask(
+                actas_storage.save, data, filename, case_no=body.case_no, source="actas"
             )
+        return actas_render.stream_response(data, filename, background)
 
-        ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        safe_case = body.case_no.replace(" ", "_")
-        filename = f"Acta_{safe_case}_{ts}.docx"
-        path = os.path.join(ACTAS_DIR, filename)
-        doc.save(path)
+    base_url = str(request.base_url).rstrip("/")
 
-        base_url = str(request.base_url).rstrip("/")
-        return {"ok": True, "url": f"{base_url}/uploads/actas/{filename}"}
+    def persist_job(data: bytes) -> dict:
+        doc_id = actas_storage.save(data, filename, case_no=body.case_no, source="actas")
+        return {"document_id": doc_id, "url": base_url + actas_storage.download_path(doc_id)}
 
-    except Exception as e:
-        raise HTTPException(500, f"Error generando el acta: {str(e)}")
+    job = actas_render.submit(build_docx, body.dict(), filename, persist_job)
+    return await actas_render.respond(job, wait)
@@ -1,17 +1,18 @@
 # actas_routes.py — generación de ACTAS en DOCX (con plantilla Mediazion)
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, HTTPException, Query, Request
 from pydantic import BaseModel
 from typing import Optional
 import os
 from datetime import datetime
+from io import BytesIO
 
 from docx import Document
+from starlette.background import BackgroundTask
 
-actas_router = APIRouter()
+import actas_render
+import actas_storage
 
-# Directorio donde se guardan las actas generadas
-ACTAS_DIR = os.path.join("uploads", "actas")
-os.makedirs(ACTAS_DIR, exist_ok=True)
+actas_router = APIRouter()
 
 # Ruta de la plantilla base (DOCX) con el diseño azul + logo
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -44,44 +45,72 @@ def _replace_placeholders(doc: Document, mapping: dict):
                     p.runs[0].text = inline_text
 
 
+def build_docx(payload: dict) -> bytes:
+    """Rellena la plantilla base de Mediazion y devuelve el DOCX en memoria."""
+    body = ActaIn(**payload)
+    if not os.path.exists(TEMPLATE_PATH):
+        raise RuntimeError(f"No se encontró la plantilla de actas en: {TEMPLATE_PATH}")
+
+    doc = Document(TEMPLATE_PATH)
+
+    conf_text = ""
+    if body.confidentiality:
+        conf_text = (
+            "Las partes se comprometen a mantener la confidencialidad del proceso de mediación "
+            "y de la información intercambiada, salvo obligación legal o acuerdo expreso en contrario."
+        )
+
+    mapping = {
+        "{{CASE_NO}}": body.case_no,
+        "{{DATE_ISO}}": body.date_iso,
+        "{{MEDIATOR}}": body.mediator_alias,
+        "{{PARTIES}}": body.parties,
+        "{{SUMMARY}}": body.summary,
+        "{{AGREEMENTS}}": body.agreements or "Sin acuerdos adicionales registrados.",
+        "{{CONF_TEXT}}": conf_text,
+    }
+
+    _replace_placeholders(doc, mapping)
+
+    buf = BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
 @actas_router.post("/actas/render_docx")
-def render_docx(body: ActaIn, request: Request):
-    """Genera un ACTA en DOCX usando la plantilla base de Mediazion."""
-    try:
-        if not os.path.exists(TEMPLATE_PATH):
-            raise HTTPException(500, f"No se encontró la plantilla de actas en: {TEMPLATE_PATH}")
-
-        doc = Document(TEMPLATE_PATH)
-
-        conf_text = ""
-        if body.confidentiality:
-            conf_text = (
-                "Las partes se comprometen a mantener la confidencialidad del proceso de mediación "
-                "y de la información intercambiada, salvo obligación legal o acuerdo expreso en contrario."
+async def render_docx(
+    body: ActaIn,
+    request: Request,
+    wait: float = Query(actas_render.ACTAS_RENDER_WAIT_DEFAULT, ge=0, le=60),
+    stream: bool = False,
+    persist: bool = False,
+):
+    """
+    Genera un ACTA en DOCX usando la plantilla base de Mediazion.
+    Por defecto va a la cola de actas_render y se guarda (como actas_routes); con
+    stream=true el DOCX va en la propia respuesta y solo se guarda si persist=true.
+    """
+    if not os.path.exists(TEMPLATE_PATH):
+        raise HTTPException(500, f"No se encontró la plantilla de actas en: {TEMPLATE_PATH}")
+
+    ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    safe_case = body.case_no.replace(" ", "_")
+    filename = f"Acta_{safe_case}_{ts}.docx"
+
+    if stream:
+        data = await actas_render.render_bytes(build_docx, body.dict())
+        background = None
+        if persist:
+            background = BackgroundTask(
+                actas_storage.save, data, filename, case_no=body.case_no, source="actas_plantilla"
             )
+        return actas_render.stream_response(data, filename, background)
+
+    base_url = str(request.base_url).rstrip("/")
+
+    def persist_job(data: bytes) -> dict:
+        doc_id = actas_storage.save(data, filename, case_no=body.case_no, source="actas_plantilla")
+        return {"document_id": doc_id, "url": base_url + actas_storage.download_path(doc_id)}
 
-        mapping = {
-            "{{CASE_NO}}": body.case_no,
-            "{{DATE_ISO}}": body.date_iso,
-            "{{MEDIATOR}}": body.mediator_alias,
-            "{{PARTIES}}": body.parties,
-            "{{SUMMARY}}": body.summary,
-            "{{AGREEMENTS}}": body.agreements or "Sin acuerdos adicionales registrados.",
-            "{{CONF_TEXT}}": conf_text,
-        }
-
-        _replace_placeholders(doc, mapping)
-
-        ts = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        safe_case = body.case_no.replace(" ", "_")
-        filename = f"Acta_{safe_case}_{ts}.docx"
-        path = os.path.join(ACTAS_DIR, filename)
-        doc.save(path)
-
-        base_url = str(request.base_url).rstrip("/")
-        return {"ok": True, "url": f"{base_url}/uploads/actas/{filename}"}
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(500, f"Error generando el acta: {str(e)}")
+    job = actas_render.submit(build_docx, body.dict(), filename, persist_job)
+    return await actas_render.respond(job, wait)
@@ -0,0 +1,282 @@
+# actas_storage.py — Almacenamiento de actas generadas (S3 o disco local) + índice en BD
+# ---------------------------------------------------------------
+# - Cada acta se guarda en el backend (ACTAS_STORAGE=s3 | local) y se registra en
+#   actas_documentos (caso_id, nombre, clave, tamaño, fecha).
+# - El listado por caso es una consulta indexada (caso_id, created_at, id) con
+#   paginación keyset; ya no se recorre generated_actas con stat() por fichero.
+# - La descarga se sirve por streaming desde el backend:
+#     GET /api/actas/documentos/{id}/download?token=...
+#   Las actas son confidenciales y los ids son correlativos: solo se sirve con el
+#   token firmado que llevan las URLs de download_path() (caduca a las
+#   ACTAS_LINK_TTL s) o con X-Admin-Token.
+# - `local` es el sustituto para desarrollo (una sola instancia); en producción
+#   con varias instancias, s3.
+#
+# Importar actas antiguas de generated_actas/:
+#   python actas_storage.py --import-local generated_actas
+
+import argparse
+import os
+import re
+import uuid
+from datetime import datetime
+from typing import Iterator, Optional
+from urllib.parse import quote
+
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+import admin_auth
+import signing
+from db import pg_conn
+
+S3_BUCKET       = os.getenv("S3_BUCKET_NAME")
+AWS_REGION      = os.getenv("AWS_DEFAULT_REGION", "eu-north-1")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+
+ACTAS_STORAGE   = (os.getenv("ACTAS_STORAGE") or ("s3" if S3_BUCKET else "local")).strip().lower()
+ACTAS_S3_PREFIX = os.getenv("ACTAS_S3_PREFIX", "actas/")
+ACTAS_LOCAL_DIR = os.getenv("ACTAS_LOCAL_DIR", "generated_actas")
+ACTAS_LINK_TTL  = int(os.getenv("ACTAS_LINK_TTL", str(24 * 3600)))
+STREAM_CHUNK    = 64 * 1024
+
+DOCX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+SQL_ACTAS_DOCUMENTOS = """
+CREATE TABLE IF NOT EXISTS actas_documentos (
+  id            BIGSERIAL PRIMARY KEY,
+  caso_id       TEXT,
+  case_no       TEXT,
+  filename      TEXT NOT NULL,
+  storage       TEXT NOT NULL,
+  key           TEXT NOT NULL,
+  size_bytes    BIGINT,
+  content_type  TEXT NOT NULL,
+  source        TEXT,
+  created_at    TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS actas_documentos_caso_idx ON actas_documentos (caso_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS actas_documentos_created_idx ON actas_documentos (created_at DESC, id DESC);
+"""
+
+_table_ready = False
+
+
+def ensure_table() -> None:
+    global _table_ready
+    if _table_ready:
+        return
+    with pg_conn() as cx:
+        with cx.cursor() as cur:
+            cur.execute(SQL_ACTAS_DOCUMENTOS)
+        cx.commit()
+    _table_ready = True
+
+
+# ---------------- Backends ----------------
+
+class LocalStorage:
+    name = "local"
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError("Clave fuera del directorio de actas")
+        return path
+
+    def put(self, key: str, data: bytes, content_type: str) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)  # nadie lee un fichero a medio escribir
+
+    def stream(self, key: str) -> Iterator[bytes]:
+        with open(self._path(key), "rb") as fh:
+            while True:
+                chunk = fh.read(STREAM_CHUNK)
+                if not chunk:
+                    return
+                yield chunk
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage:
+    name = "s3"
+
+    def __init__(self, bucket: str, prefix: str):
+        import boto3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", region_name=AWS_REGION, endpoint_url=S3_ENDPOINT_URL)
+
+    def put(self, key: str, data: bytes, content_type: str) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data, ContentType=content_type)
+
+    def stream(self, key: str) -> Iterator[bytes]:
+        obj = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        body = obj["Body"]
+        try:
+            for chunk in body.iter_chunks(STREAM_CHUNK):
+                yield chunk
+        finally:
+            body.close()
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+
+_storage = None
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        if ACTAS_STORAGE == "s3":
+            if not S3_BUCKET:
+                raise RuntimeError("ACTAS_STORAGE=s3 requiere S3_BUCKET_NAME")
+            _storage = S3Storage(S3_BUCKET, ACTAS_S3_PREFIX)
+        else:
+            _storage = LocalStorage(ACTAS_LOCAL_DIR)
+    return _storage
+
+
+# ---------------- API del módulo ----------------
+
+def save(data: bytes, filename: str, caso_id: Optional[str] = None, case_no: Optional[str] = None,
+         source: str = "", content_type: str = DOCX_MEDIA_TYPE) -> int:
+    """Sube el documento y lo registra. Devuelve el id en actas_documentos."""
+    ensure_table()
+    storage = get_storage()
+    key = f"{datetime.utcnow():%Y/%m}/{uuid.uuid4().hex}{os.path.splitext(filename)[1] or '.docx'}"
+    storage.put(key, data, content_type)
+    try:
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO actas_documentos (caso_id, case_no, filename, storage, key, size_bytes, content_type, source)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id;
+                """,
+                (caso_id, case_no, filename, storage.name, key, len(data), content_type, source or None),
+            )
+            doc_id = cur.fetchone()[0]
+            cx.commit()
+    except Exception:
+        storage.delete(key)  # sin fila no hay forma de encontrarlo: no dejar huérfanos
+        raise
+    return doc_id
+
+
+def download_path(doc_id: int) -> str:
+    """URL de descarga firmada (válida ACTAS_LINK_TTL s)."""
+    token = signing.sign(str(doc_id), ACTAS_LINK_TTL, "acta")
+    return f"/api/actas/documentos/{doc_id}/download?token={quote(token)}"
+
+
+def list_for_caso(caso_id: str, before_id: Optional[int] = None, limit: int = 50) -> list:
+    """Actas de un caso, más recientes primero. Keyset sobre (created_at, id)."""
+    ensure_table()
+    sql = """
+        SELECT id, filename, size_bytes, created_at
+          FROM actas_documentos
+         WHERE caso_id = %s
+    """
+    params: list = [caso_id]
+    if before_id:
+        sql += """
+           AND (created_at, id) < (SELECT created_at, id FROM actas_documentos WHERE id = %s)
+        """
+        params.append(before_id)
+    sql += " ORDER BY created_at DESC, id DESC LIMIT %s;"
+    params.append(limit)
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(sql, tuple(params))
+        return cur.fetchall()
+
+
+def serve(doc_id: int) -> StreamingResponse:
+    """El documento por streaming, sin comprobar permisos (lo hace quien llama)."""
+    ensure_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "SELECT filename, storage, key, size_bytes, content_type FROM actas_documentos WHERE id=%s;",
+            (doc_id,),
+        )
+        row = cur.fetchone()
+    if not row:
+        raise HTTPException(404, "Acta no encontrada")
+    filename, storage_name, key, size_bytes, content_type = row
+    storage = get_storage()
+    if storage_name != storage.name:
+        raise HTTPException(404, f"El acta está en otro almacenamiento ({storage_name})")
+
+    stream = storage.stream(key)
+    try:
+        first = next(stream)  # si no existe, 404 antes de empezar la respuesta
+    except StopIteration:
+        first = b""
+    except Exception:
+        raise HTTPException(404, "Fichero del acta no disponible")
+
+    def _body():
+        yield first
+        yield from stream
+
+    headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"}
+    if size_bytes:
+        headers["Content-Length"] = str(size_bytes)
+    return StreamingResponse(_body(), media_type=content_type, headers=headers)
+
+
+router = APIRouter(prefix="/api/actas/documentos", tags=["actas"])
+
+
+@router.get("/{doc_id}/download")
+def actas_documento_download(
+    doc_id: int,
+    token: str = Query(""),
+    x_admin_token: Optional[str] = Header(None),
+):
+    if not admin_auth.is_admin(x_admin_token) and signing.unsign(token, "acta") != str(doc_id):
+        raise HTTPException(403, "Enlace de descarga no válido o caducado")
+    return serve(doc_id)
+
+
+# ---------------- Importación de ficheros antiguos ----------------
+
+def import_local(directory: str) -> int:
+    """Registra (y sube al backend actual) las actas sueltas de un directorio."""
+    count = 0
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if not entry.is_file() or not entry.name.endswith(".docx"):
+            continue
+        m = re.match(r"acta_caso-(.+)_[0-9a-f]{32}\.docx$", entry.name)
+        with open(entry.path, "rb") as fh:
+            data = fh.read()
+        doc_id = save(data, entry.name, caso_id=m.group(1) if m else None, source="import")
+        mtime = datetime.fromtimestamp(entry.stat().st_mtime)
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute("UPDATE actas_documentos SET created_at=%s WHERE id=%s;", (mtime, doc_id))
+            cx.commit()
+        count += 1
+    return count
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Almacenamiento de actas")
+    ap.add_argument("--import-local", metavar="DIR", help="registrar las actas .docx de DIR")
+    args = ap.parse_args()
+    if args.import_local:
+        print(f"Importadas: {import_local(args.import_local)}")
+    else:
+        ap.print_help()
@@ -0,0 +1,28 @@
+# admin_auth.py — Token de administración compartido por las rutas nuevas
+# ---------------------------------------------------------------
+# - ADMIN_TOKEN solo se lee del entorno: sin él no hay acceso admin (no hay
+#   valor por defecto en el código).
+# - Comparación en tiempo constante.
+
+import hmac
+import os
+from typing import Optional
+
+from fastapi import HTTPException
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or ""
+
+if not ADMIN_TOKEN:
+    print("[Admin] ADMIN_TOKEN no configurado: acceso de administración desactivado")
+
+
+def is_admin(token: Optional[str]) -> bool:
+    if not ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8"))
+
+
+def require_admin(token: Optional[str]) -> None:
+    """Para las rutas que reciben X-Admin-Token: 401 si no cuadra."""
+    if not is_admin(token):
+        raise HTTPException(401, "Unauthorized")
@@ -0,0 +1,467 @@
+# ai_admission.py — Control de admisión para llamadas a OpenAI (Mediazion)
+# ---------------------------------------------------------------
+# Compartido por ai_routes, ai_legal_routes y la moderación de voces_routes.
+#
+#   - Concurrencia global (AI_GLOBAL_CONCURRENCY) y por identidad (AI_IDENTITY_CONCURRENCY).
+#   - Cola justa por prioridad: PRO/trialing > mediador autenticado / sistema > anónimo (/complete).
+#   - Presupuesto de tokens con token-bucket por identidad y global: se reserva una
+#     estimación antes de la llamada y se corrige con `usage` al terminar.
+#   - Métricas de espera en cola y consumo de presupuesto (GET /api/ai/admission/metrics).
+#
+# Uso (código síncrono, p. ej. endpoints `def` o hilos):
+#     with ai_admission.admit(ident, ai_admission.estimate_tokens(prompt)) as ticket:
+#         resp = client.chat.completions.create(...)
+#         ticket.settle(resp)
+#
+# Las rutas async usan `async with ai_admission.admit_async(...)`: esperan en el
+# event loop (un future por espera), sin ocupar hilos del executor por defecto.
+
+import asyncio
+import heapq
+import ipaddress
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, Request
+
+import signing
+
+GLOBAL_CONCURRENCY   = int(os.getenv("AI_GLOBAL_CONCURRENCY", "16"))
+IDENTITY_CONCURRENCY = int(os.getenv("AI_IDENTITY_CONCURRENCY", "2"))
+IDENTITY_MAX_QUEUED  = int(os.getenv("AI_IDENTITY_MAX_QUEUED", "6"))
+QUEUE_TIMEOUT        = float(os.getenv("AI_QUEUE_TIMEOUT", "30"))
+
+# Tokens por minuto (capacidad del bucket = 1 minuto de presupuesto)
+GLOBAL_TPM = int(os.getenv("AI_GLOBAL_TPM", "800000"))
+TIER_TPM = {
+    "pro": int(os.getenv("AI_TPM_PRO", "200000")),
+    "auth": int(os.getenv("AI_TPM_AUTH", "60000")),
+    "system": int(os.getenv("AI_TPM_SYSTEM", "100000")),
+    "anon": int(os.getenv("AI_TPM_ANON", "10000")),
+}
+
+# Menor número = antes en la cola
+TIER_PRIORITY = {"pro": 0, "auth": 1, "system": 1, "anon": 2}
+
+PRO_STATUSES = ("active", "trialing")
+PRO_CACHE_SECONDS = 300
+
+# Tope de identidades recordadas (buckets y caché PRO); se olvidan las menos recientes
+IDENTITY_CACHE_MAX = int(os.getenv("AI_IDENTITY_CACHE_MAX", "10000"))
+
+# Proxies cuyo X-Forwarded-For se cree (CIDR separados por comas). Vacío: cualquier
+# par en red privada o loopback (el balanceador de la plataforma).
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(n.strip(), strict=False)
+    for n in os.getenv("TRUSTED_PROXIES", "").split(",")
+    if n.strip()
+]
+
+
+class AdmissionRejected(HTTPException):
+    """429: cola llena, espera agotada o presupuesto de tokens consumido."""
+
+    def __init__(self, detail: str, retry_after: float = 5.0):
+        super().__init__(429, detail, headers={"Retry-After": str(max(1, int(retry_after)))})
+
+
+@dataclass(frozen=True)
+class Identity:
+    key: str    # email:..., ip:..., system:...
+    tier: str   # pro | auth | system | anon
+
+
+# ---------------- Identidad y nivel ----------------
+
+_pro_cache: "OrderedDict[str, tuple[float, bool]]" = OrderedDict()
+_pro_lock = threading.Lock()
+
+
+def _is_pro(email: str) -> bool:
+    now = time.monotonic()
+    with _pro_lock:
+        hit = _pro_cache.get(email)
+    if hit and now - hit[0] < PRO_CACHE_SECONDS:
+        return hit[1]
+    pro = False
+    try:
+        from db import pg_conn
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute(
+                "SELECT subscription_status FROM mediadores WHERE LOWER(email)=LOWER(%s);",
+                (email,),
+            )
+            row = cur.fetchone()
+        status = (row[0] if not isinstance(row, dict) else row["subscription_status"]) if row else None
+        pro = (status or "").lower() in PRO_STATUSES
+    except Exception:
+        pro = False
+    with _pro_lock:
+        _pro_cache[email] = (now, pro)
+        _pro_cache.move_to_end(email)
+        while len(_pro_cache) > IDENTITY_CACHE_MAX:
+            _pro_cache.popitem(last=False)
+    return pro
+
+
+def _trusted_proxy(host: str) -> bool:
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    if TRUSTED_PROXIES:
+        return any(addr in net for net in TRUSTED_PROXIES)
+    return addr.is_private or addr.is_loopback
+
+
+def client_ip(request: Request) -> str:
+    """
+    IP del cliente. X-Forwarded-For solo cuenta si llega de un proxy de confianza,
+    y se lee de derecha a izquierda: la primera IP que no es un proxy nuestro es
+    la que vio el balanceador (lo que el cliente ponga a la izquierda no cuenta).
+    """
+    peer = request.client.host if request.client else "unknown"
+    if not _trusted_proxy(peer):
+        return peer
+    hops = [h.strip() for h in (request.headers.get("x-forwarded-for") or "").split(",") if h.strip()]
+    for hop in reversed(hops):
+        if not _trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+
+def identity_from_request(request: Request) -> Identity:
+    """
+    Identidad para la admisión:
+      - Authorization: Bearer <token de sesión firmado> → email del mediador
+        (verificado); PRO/trialing según mediadores.
+      - Otro Bearer (sin sesión verificable) → por IP, nivel 'auth'.
+      - Sin credenciales → por IP, nivel 'anon'.
+    X-User-Email y ?email= no se usan: los pone el cliente.
+    """
+    authorization = request.headers.get("authorization") or ""
+    email = signing.email_from_authorization(authorization)
+    auth = authorization.lower().startswith("bearer ")
+    ip = client_ip(request)
+
+    if email:
+        return Identity(f"email:{email}", "pro" if _is_pro(email) else "auth")
+    if auth:
+        return Identity(f"ip:{ip}", "auth")
+    return Identity(f"ip:{ip}", "anon")
+
+
+def system_identity(name: str) -> Identity:
+    return Identity(f"system:{name}", "system")
+
+
+def estimate_tokens(*texts: Optional[str], max_output: int = 1000) -> int:
+    """Estimación rápida previa a la llamada (≈ 4 caracteres por token + salida)."""
+    return sum(len(t or "") for t in texts) // 4 + max_output
+
+
+# ---------------- Token buckets ----------------
+
+class _TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, n: int, now: float) -> float:
+        """Segundos hasta poder reservar n tokens (0 si ya se puede)."""
+        self._refill(now)
+        need = min(n, self.capacity) - self.tokens
+        return 0.0 if need <= 0 else need / self.rate
+
+    def take(self, n: float) -> None:
+        self.tokens -= n  # puede quedar negativo tras corregir con usage real
+
+
+# ---------------- Cola justa + semáforos ----------------
+
+class _Waiter:
+    __slots__ = ("ident", "seq", "granted", "loop", "future")
+
+    def __init__(self, ident: Identity, seq: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.ident = ident
+        self.seq = seq
+        self.granted = False
+        # espera async: se despierta con un future del event loop, sin ocupar hilos
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class _Admission:
+    def __init__(self):
+        self._cv = threading.Condition()
+        self._heap: list = []
+        self._seq = itertools.count()
+        self._active_total = 0
+        self._active: Dict[str, int] = {}
+        self._queued: Dict[str, int] = {}
+        self._buckets: "OrderedDict[str, _TokenBucket]" = OrderedDict()
+        self._global_bucket = _TokenBucket(GLOBAL_TPM)
+        self._waits: deque = deque(maxlen=1000)
+        self.stats: Dict[str, Any] = {
+            "admitted": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "rejected_budget": 0,
+            "tokens_estimated": 0,
+            "tokens_used": 0,
+            "tokens_by_tier": {t: 0 for t in TIER_PRIORITY},
+        }
+
+    def _bucket(self, ident: Identity) -> _TokenBucket:
+        """(con el lock) Bucket de la identidad; LRU acotado a IDENTITY_CACHE_MAX."""
+        b = self._buckets.get(ident.key)
+        if b is None:
+            b = self._buckets[ident.key] = _TokenBucket(TIER_TPM.get(ident.tier, TIER_TPM["anon"]))
+            while len(self._buckets) > IDENTITY_CACHE_MAX:
+                self._buckets.popitem(last=False)  # en un minuto sin uso ya estaría lleno
+        else:
+            self._buckets.move_to_end(ident.key)
+        return b
+
+    def _eligible(self, ident: Identity) -> bool:
+        return (
+            self._active_total < GLOBAL_CONCURRENCY
+            and self._active.get(ident.key, 0) < IDENTITY_CONCURRENCY
+        )
+
+    def _grant_next(self) -> None:
+        """Concede huecos a los primeros de la cola (por prioridad) que puedan entrar."""
+        skipped = []
+        while self._heap and self._active_total < GLOBAL_CONCURRENCY:
+            entry = heapq.heappop(self._heap)
+            waiter = entry[2]
+            if waiter.granted:
+                continue
+            if self._eligible(waiter.ident):
+                waiter.granted = True
+                self._active_total += 1
+                self._active[waiter.ident.key] = self._active.get(waiter.ident.key, 0) + 1
+                if waiter.future is not None:
+                    waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+            else:
+                skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        self._cv.notify_all()
+
+    def _enqueue(self, ident: Identity, est_tokens: int,
+                 loop: Optional[asyncio.AbstractEventLoop] = None) -> _Waiter:
+        """(con el lock) Comprueba presupuesto y cola llena, y entra en la cola."""
+        # 1) Presupuesto de tokens (identidad y global)
+        wait = self._budget_wait(ident, est_tokens)
+        if wait > QUEUE_TIMEOUT:
+            self.stats["rejected_budget"] += 1
+            raise AdmissionRejected(
+                "Has superado temporalmente tu presupuesto de IA. Inténtalo en un momento.",
+                retry_after=wait,
+            )
+        if self._queued.get(ident.key, 0) >= IDENTITY_MAX_QUEUED:
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejected("Demasiadas peticiones de IA en curso para este usuario.")
+
+        # 2) Cola por prioridad
+        waiter = _Waiter(ident, next(self._seq), loop)
+        heapq.heappush(self._heap, (TIER_PRIORITY.get(ident.tier, 2), waiter.seq, waiter))
+        self._queued[ident.key] = self._queued.get(ident.key, 0) + 1
+        self._grant_next()
+        return waiter
+
+    def _dequeue(self, waiter: _Waiter, abandon: bool) -> None:
+        """(con el lock) Fin de la espera: concedida, o abandonada (timeout, cancelación)."""
+        if abandon:
+            if waiter.granted:
+                self._release_locked(waiter.ident)
+            waiter.granted = True  # el heap lo descarta al sacarlo
+        key = waiter.ident.key
+        self._queued[key] -= 1
+        if not self._queued[key]:
+            del self._queued[key]
+
+    def _budget_wait(self, ident: Identity, est_tokens: int) -> float:
+        now = time.monotonic()
+        return max(
+            self._bucket(ident).wait_for(est_tokens, now),
+            self._global_bucket.wait_for(est_tokens, now),
+        )
+
+    def _take(self, ident: Identity, est_tokens: int, t0: float) -> float:
+        with self._cv:
+            self._bucket(ident).take(est_tokens)
+            self._global_bucket.take(est_tokens)
+            waited = time.monotonic() - t0
+            self._waits.append(waited)
+            self.stats["admitted"] += 1
+            self.stats["tokens_estimated"] += est_tokens
+        return waited
+
+    def acquire(self, ident: Identity, est_tokens: int) -> float:
+        """Bloquea hasta tener hueco y presupuesto. Devuelve los segundos de espera."""
+        t0 = time.monotonic()
+        deadline = t0 + QUEUE_TIMEOUT
+        with self._cv:
+            waiter = self._enqueue(ident, est_tokens)
+            try:
+                while not waiter.granted:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats["rejected_timeout"] += 1
+                        raise AdmissionRejected("La IA está saturada en este momento. Inténtalo de nuevo.")
+                    self._cv.wait(remaining)
+            except BaseException:
+                self._dequeue(waiter, abandon=True)
+                raise
+            self._dequeue(waiter, abandon=False)
+            # 3) Presupuesto: si hay que esperar a que se rellene, lo hacemos ya con hueco
+            wait = self._budget_wait(ident, est_tokens)
+        if wait > 0:
+            time.sleep(min(wait, max(0.0, deadline - time.monotonic())))
+        return self._take(ident, est_tokens, t0)
+
+    async def acquire_async(self, ident: Identity, est_tokens: int) -> float:
+        """
+        Igual que acquire() pero esperando en el event loop: los que esperan no
+        ocupan hilos del executor por defecto, que es justo lo que necesita el
+        trabajo ya admitido (to_thread de las llamadas a OpenAI).
+        """
+        t0 = time.monotonic()
+        deadline = t0 + QUEUE_TIMEOUT
+        with self._cv:
+            waiter = self._enqueue(ident, est_tokens, asyncio.get_running_loop())
+        try:
+            await asyncio.wait_for(waiter.future, max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            with self._cv:
+                granted = waiter.granted  # concedido justo al vencer el plazo: lo aprovechamos
+                if not granted:
+                    self.stats["rejected_timeout"] += 1
+                    self._dequeue(waiter, abandon=True)
+            if not granted:
+                raise AdmissionRejected("La IA está saturada en este momento. Inténtalo de nuevo.")
+        except BaseException:
+            with self._cv:
+                self._dequeue(waiter, abandon=True)
+            raise
+        with self._cv:
+            self._dequeue(waiter, abandon=False)
+            wait = self._budget_wait(ident, est_tokens)
+        if wait > 0:
+            try:
+                await asyncio.sleep(min(wait, max(0.0, deadline - time.monotonic())))
+            except BaseException:
+                self.release(ident)
+                raise
+        return self._take(ident, est_tokens, t0)
+
+    def _release_locked(self, ident: Identity) -> None:
+        self._active_total -= 1
+        n = self._active.get(ident.key, 1) - 1
+        if n > 0:
+            self._active[ident.key] = n
+        else:
+            self._active.pop(ident.key, None)
+        self._grant_next()
+
+    def release(self, ident: Identity) -> None:
+        with self._cv:
+            self._release_locked(ident)
+
+    def correct(self, ident: Identity, est_tokens: int, used: Optional[int]) -> None:
+        """Ajusta los buckets con el consumo real (usage.total_tokens)."""
+        with self._cv:
+            if used is not None:
+                delta = used - est_tokens
+                self._bucket(ident).take(delta)
+                self._global_bucket.take(delta)
+            actual = used if used is not None else est_tokens
+            self.stats["tokens_used"] += actual
+            tiers = self.stats["tokens_by_tier"]
+            tiers[ident.tier] = tiers.get(ident.tier, 0) + actual
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cv:
+            waits = sorted(self._waits)
+            out = dict(self.stats)
+            out["tokens_by_tier"] = dict(self.stats["tokens_by_tier"])
+            out["active"] = self._active_total
+            out["queued"] = sum(self._queued.values())
+            out["global_tokens_available"] = int(self._global_bucket.tokens)
+        if waits:
+            out["queue_wait_p50"] = round(waits[len(waits) // 2], 4)
+            out["queue_wait_p95"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 4)
+            out["queue_wait_max"] = round(waits[-1], 4)
+        out["limits"] = {
+            "global_concurrency": GLOBAL_CONCURRENCY,
+            "identity_concurrency": IDENTITY_CONCURRENCY,
+            "global_tpm": GLOBAL_TPM,
+            "tier_tpm": dict(TIER_TPM),
+        }
+        return out
+
+
+_admission = _Admission()
+
+
+class Ticket:
+    def __init__(self, ident: Identity, est_tokens: int):
+        self.ident = ident
+        self.est_tokens = est_tokens
+        self.used: Optional[int] = None
+        self.waited = 0.0
+        self._lock = threading.Lock()  # settle() llega desde varios hilos (map de _map_reduce)
+
+    def settle(self, resp: Any) -> None:
+        """Registra el consumo real a partir de la respuesta de OpenAI (resp.usage)."""
+        usage = getattr(resp, "usage", None)
+        total = getattr(usage, "total_tokens", None) if usage is not None else None
+        if total is not None:
+            with self._lock:
+                self.used = (self.used or 0) + int(total)
+
+
+@contextmanager
+def admit(ident: Identity, est_tokens: int):
+    ticket = Ticket(ident, est_tokens)
+    ticket.waited = _admission.acquire(ident, est_tokens)
+    try:
+        yield ticket
+    finally:
+        _admission.release(ident)
+        _admission.correct(ident, est_tokens, ticket.used)
+
+
+@asynccontextmanager
+async def admit_async(ident: Identity, est_tokens: int):
+    ticket = Ticket(ident, est_tokens)
+    ticket.waited = await _admission.acquire_async(ident, est_tokens)
+    try:
+        yield ticket
+    finally:
+        _admission.release(ident)
+        _admission.correct(ident, est_tokens, ticket.used)
+
+
+def metrics() -> Dict[str, Any]:
+    return _admission.metrics()
+
@@ -0,0 +1,246 @@
+# ai_fake_openai.py — Servidor local que imita la API de chat completions de OpenAI
+# ---------------------------------------------------------------
+# Para pruebas de carga sin coste ni límites de OpenAI. El SDK de openai usa
+# OPENAI_BASE_URL, así que basta con arrancar la app con:
+#
+#   OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=fake uvicorn app:app
+#
+# - Latencia configurable: base (hasta el primer token) + por token generado + jitter.
+# - Streaming SSE (stream=true), con el chunk de `usage` si se pide include_usage.
+# - Inyección de errores: 500 y 429 (con Retry-After) con la probabilidad indicada.
+# - `usage` calculado con ai_tokens (prompt) y el nº de tokens generados.
+# - Respuestas de moderación en JSON válido para voces_routes.
+# - /files/sample.txt sirve un documento para /ai/assist_with.
+#
+# Uso:  python ai_fake_openai.py --port 8900 --latency-ms 400 --token-ms 5 --error-rate 0.02
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+import ai_tokens
+
+CONFIG: Dict[str, Any] = {
+    "latency_ms": float(os.getenv("FAKE_OPENAI_LATENCY_MS", "300")),
+    "token_ms": float(os.getenv("FAKE_OPENAI_TOKEN_MS", "4")),
+    "jitter_ms": float(os.getenv("FAKE_OPENAI_JITTER_MS", "50")),
+    "output_tokens": int(os.getenv("FAKE_OPENAI_OUTPUT_TOKENS", "120")),
+    "error_rate": float(os.getenv("FAKE_OPENAI_ERROR_RATE", "0")),
+    "rate_limit_rate": float(os.getenv("FAKE_OPENAI_RATE_LIMIT_RATE", "0")),
+    "moderation_action": os.getenv("FAKE_OPENAI_MODERATION_ACTION", "publish"),
+    "sample_paragraphs": int(os.getenv("FAKE_OPENAI_SAMPLE_PARAGRAPHS", "60")),
+}
+
+STATS: Dict[str, Any] = {
+    "requests": 0,
+    "streamed": 0,
+    "errors_500": 0,
+    "errors_429": 0,
+    "in_flight": 0,
+    "max_in_flight": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+}
+
+_rng = random.Random(int(os.getenv("FAKE_OPENAI_SEED", "0")) or None)
+
+fake = FastAPI(title="fake-openai")
+
+_WORDS = (
+    "la mediación permite a las partes alcanzar un acuerdo voluntario con ayuda de "
+    "una persona neutral que facilita la comunicación y propone alternativas"
+).split()
+
+
+def _reply_text(messages: list, n_tokens: int) -> str:
+    system = " ".join(str(m.get("content") or "") for m in messages if m.get("role") == "system")
+    if "moderador de contenidos" in system:
+        action = CONFIG["moderation_action"]
+        risk = "low" if action == "publish" else "high"
+        return json.dumps({"action": action, "risk": risk, "reasons": ["fake"]})
+    # ~1 token por palabra corta: suficiente para medir
+    return " ".join(_WORDS[i % len(_WORDS)] for i in range(n_tokens)).capitalize() + "."
+
+
+def _prompt_text(messages: list) -> list:
+    out = []
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, list):
+            # visión: solo cuenta la parte de texto (la imagen se estima aparte)
+            content = " ".join(p.get("text", "") for p in content if isinstance(p, dict))
+        out.append(str(content or ""))
+    return out
+
+
+def _first_token_delay() -> float:
+    return max(0.0, CONFIG["latency_ms"] + _rng.uniform(-1, 1) * CONFIG["jitter_ms"]) / 1000
+
+
+def _inject_error() -> Optional[JSONResponse]:
+    roll = _rng.random()
+    if roll < CONFIG["rate_limit_rate"]:
+        STATS["errors_429"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (fake)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"Retry-After": "1"},
+        )
+    if roll < CONFIG["rate_limit_rate"] + CONFIG["error_rate"]:
+        STATS["errors_500"] += 1
+        return JSONResponse(
+            {"error": {"message": "Internal error (fake)", "type": "server_error", "code": None}},
+            status_code=500,
+        )
+    return None
+
+
+@fake.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages") or []
+    model = body.get("model") or "gpt-4o-mini"
+    stream = bool(body.get("stream"))
+    max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+
+    STATS["requests"] += 1
+    STATS["in_flight"] += 1
+    STATS["max_in_flight"] = max(STATS["max_in_flight"], STATS["in_flight"])
+    try:
+        await asyncio.sleep(_first_token_delay())
+        err = _inject_error()
+        if err is not None:
+            return err
+
+        n_out = CONFIG["output_tokens"] if not max_tokens else min(CONFIG["output_tokens"], int(max_tokens))
+        text = _reply_text(messages, n_out)
+        prompt_tokens = ai_tokens.messages_tokens(model, *_prompt_text(messages))
+        completion_tokens = ai_tokens.count_tokens(text, model)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        STATS["prompt_tokens"] += prompt_tokens
+        STATS["completion_tokens"] += completion_tokens
+
+        cid = "chatcmpl-" + uuid.uuid4().hex[:24]
+        created = int(time.time())
+
+        if not stream:
+            await asyncio.sleep(completion_tokens * CONFIG["token_ms"] / 1000)
+            return {
+                "id": cid,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        STATS["streamed"] += 1
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        STATS["in_flight"] += 1  # lo libera el generador al terminar
+
+        async def events():
+            try:
+                def chunk(delta: dict, finish: Optional[str] = None, **extra) -> str:
+                    data = {
+                        "id": cid,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+                        **extra,
+                    }
+                    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+                yield chunk({"role": "assistant", "content": ""})
+                for i, word in enumerate(text.split(" ")):
+                    await asyncio.sleep(CONFIG["token_ms"] / 1000)
+                    yield chunk({"content": word if i == 0 else " " + word})
+                yield chunk({}, "stop")
+                if include_usage:
+                    data = {"id": cid, "object": "chat.completion.chunk", "created": created,
+                            "model": model, "choices": [], "usage": usage}
+                    yield f"data: {json.dumps(data)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                STATS["in_flight"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+    finally:
+        STATS["in_flight"] -= 1
+
+
+@fake.get("/v1/models")
+def models():
+    names = sorted(ai_tokens.MODEL_CONTEXT)
+    return {"object": "list", "data": [{"id": n, "object": "model", "owned_by": "fake"} for n in names]}
+
+
+@fake.get("/files/sample.txt", response_class=PlainTextResponse)
+def sample_document():
+    """Documento de prueba para /ai/assist_with (tamaño con sample_paragraphs)."""
+    para = (
+        "La parte solicitante expone que el conflicto vecinal comenzó en 2021 por ruidos "
+        "nocturnos y que se han intentado varias conversaciones sin éxito. "
+    ) * 6
+    return "\n\n".join(f"{i + 1}. {para}" for i in range(CONFIG["sample_paragraphs"]))
+
+
+@fake.get("/_stats")
+def fake_stats():
+    return {"ok": True, "stats": dict(STATS), "config": dict(CONFIG)}
+
+
+@fake.post("/_config")
+async def fake_config(request: Request):
+    """Cambia la configuración en caliente (p. ej. subir la latencia entre niveles)."""
+    body = await request.json()
+    unknown = set(body) - set(CONFIG)
+    if unknown:
+        raise HTTPException(400, f"Claves desconocidas: {sorted(unknown)}")
+    for k, v in body.items():
+        CONFIG[k] = type(CONFIG[k])(v)
+    return {"ok": True, "config": dict(CONFIG)}
+
+
+@fake.post("/_reset")
+def fake_reset():
+    for k in STATS:
+        if k != "in_flight":  # las peticiones en curso siguen contando
+            STATS[k] = 0
+    return {"ok": True}
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    ap = argparse.ArgumentParser(description="Servidor local que imita chat completions de OpenAI")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8900)
+    ap.add_argument("--latency-ms", type=float)
+    ap.add_argument("--token-ms", type=float)
+    ap.add_argument("--jitter-ms", type=float)
+    ap.add_argument("--output-tokens", type=int)
+    ap.add_argument("--error-rate", type=float)
+    ap.add_argument("--rate-limit-rate", type=float)
+    args = ap.parse_args()
+    for key in ("latency_ms", "token_ms", "jitter_ms", "output_tokens", "error_rate", "rate_limit_rate"):
+        if getattr(args, key) is not None:
+            CONFIG[key] = getattr(args, key)
+
+    uvicorn.run(fake, host=args.host, port=args.port, log_level="warning")
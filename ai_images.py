@@ -0,0 +1,176 @@
+# ai_images.py — Preprocesado de imágenes para la IA con visión
+# ---------------------------------------------------------------
+# - Rota según EXIF, reduce al tamaño que el modelo realmente usa para el nivel de
+#   detalle pedido y recomprime a JPEG; se envía inline (data URL).
+# - Caché por hash del contenido (y de URL → hash) para reutilizar el mismo escaneo.
+# - Estimación de tokens de visión para medir el ahorro y para la admisión.
+#
+# preprocess_image() es una función pura (bytes → dict) y se ejecuta en el pool de
+# procesos de ai_routes.
+
+import base64
+import hashlib
+import io
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+    _HAS_PIL = True
+except Exception:
+    _HAS_PIL = False
+
+IMAGE_MAX_BYTES   = int(os.getenv("AI_IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+IMAGE_JPEG_QUALITY = int(os.getenv("AI_IMAGE_JPEG_QUALITY", "85"))
+CACHE_MAX_BYTES   = int(os.getenv("AI_IMAGE_CACHE_BYTES", str(64 * 1024 * 1024)))
+URL_CACHE_SECONDS = int(os.getenv("AI_IMAGE_URL_CACHE_SECONDS", "600"))
+
+# Reglas de escalado del modelo (gpt-4o):
+#   low  → 512x512 fijo (85 tokens)
+#   high → cabe en 2048x2048 y el lado corto a 768; 170 tokens por tesela de 512 + 85
+LOW_SIDE = 512
+HIGH_MAX_SIDE = 2048
+HIGH_SHORT_SIDE = 768
+DETAILS = ("low", "high", "auto")
+
+
+def vision_tokens(width: int, height: int, detail: str) -> int:
+    """Tokens que cobra el modelo por una imagen de ese tamaño y detalle."""
+    if detail == "low":
+        return 85
+    w, h = _high_size(width, height)
+    return 85 + 170 * math.ceil(w / 512) * math.ceil(h / 512)
+
+
+def _high_size(width: int, height: int) -> tuple[int, int]:
+    scale = min(1.0, HIGH_MAX_SIDE / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, HIGH_SHORT_SIDE / min(w, h))
+    return max(1, int(w * scale)), max(1, int(h * scale))
+
+
+def resolve_detail(detail: Optional[str], width: int, height: int) -> str:
+    detail = (detail or "auto").lower()
+    if detail == "auto":
+        # imágenes pequeñas no ganan nada con "high"
+        return "low" if max(width, height) <= LOW_SIDE else "high"
+    return detail
+
+
+def preprocess_image(data: bytes, detail: str) -> dict:
+    """
+    EXIF-rotate + reducción + JPEG. Devuelve dict con data_url, tamaños y tokens
+    antes/después. Lanza ValueError si la imagen no se puede abrir.
+    """
+    if not _HAS_PIL:
+        raise ValueError("Pillow no disponible")
+    try:
+        img = Image.open(io.BytesIO(data))
+        img = ImageOps.exif_transpose(img)
+    except Exception as e:
+        raise ValueError(f"Imagen no válida: {e}")
+
+    orig_w, orig_h = img.size
+    detail = resolve_detail(detail, orig_w, orig_h)
+
+    if detail == "low":
+        target = (LOW_SIDE, LOW_SIDE)
+        img.thumbnail(target, Image.LANCZOS)
+    else:
+        w, h = _high_size(orig_w, orig_h)
+        if (w, h) != (orig_w, orig_h):
+            img = img.resize((w, h), Image.LANCZOS)
+
+    if img.mode not in ("RGB", "L"):
+        # transparencias sobre blanco (capturas PNG)
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        rgba = img.convert("RGBA")
+        bg.paste(rgba, mask=rgba.split()[-1])
+        img = bg
+
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    jpeg = out.getvalue()
+
+    return {
+        "data_url": "data:image/jpeg;base64," + base64.b64encode(jpeg).decode("ascii"),
+        "detail": detail,
+        "width": img.size[0],
+        "height": img.size[1],
+        "bytes": len(jpeg),
+        "orig_width": orig_w,
+        "orig_height": orig_h,
+        "orig_bytes": len(data),
+        # lo que habría costado enviar la original en "high" frente a lo enviado
+        "orig_tokens": vision_tokens(orig_w, orig_h, "high"),
+        "tokens": vision_tokens(img.size[0], img.size[1], detail),
+    }
+
+
+# ---------------- Caché ----------------
+
+_cache: "OrderedDict[tuple, dict]" = OrderedDict()
+_cache_bytes = 0
+_url_index: dict = {}
+_lock = threading.Lock()
+
+STATS = {"processed": 0, "cache_hits": 0, "url_hits": 0, "tokens_saved": 0, "bytes_saved": 0}
+
+
+def content_key(data: bytes, detail: str) -> tuple:
+    return (hashlib.sha256(data).hexdigest(), (detail or "auto").lower())
+
+
+def cache_get(key: tuple) -> Optional[dict]:
+    with _lock:
+        item = _cache.get(key)
+        if item is not None:
+            _cache.move_to_end(key)
+            STATS["cache_hits"] += 1
+        return item
+
+
+def cache_get_url(url: str, detail: str) -> Optional[dict]:
+    with _lock:
+        hit = _url_index.get((url, (detail or "auto").lower()))
+        if not hit or time.monotonic() - hit[0] > URL_CACHE_SECONDS:
+            return None
+        item = _cache.get(hit[1])
+        if item is not None:
+            _cache.move_to_end(hit[1])
+            STATS["url_hits"] += 1
+        return item
+
+
+def cache_put(key: tuple, item: dict, url: Optional[str] = None) -> None:
+    global _cache_bytes
+    with _lock:
+        if key not in _cache:
+            STATS["processed"] += 1
+            STATS["tokens_saved"] += max(0, item["orig_tokens"] - item["tokens"])
+            STATS["bytes_saved"] += max(0, item["orig_bytes"] - item["bytes"])
+            _cache_bytes += len(item["data_url"])
+        _cache[key] = item
+        _cache.move_to_end(key)
+        if url:
+            _url_index[(url, key[1])] = (time.monotonic(), key)
+        while _cache_bytes > CACHE_MAX_BYTES and _cache:
+            _, old = _cache.popitem(last=False)
+            _cache_bytes -= len(old["data_url"])
+        if len(_url_index) > 4 * len(_cache) + 100:
+            live = set(_cache)
+            for k in [k for k, v in _url_index.items() if v[1] not in live]:
+                del _url_index[k]
+
+
+def stats() -> dict:
+    with _lock:
+        out = dict(STATS)
+        out["cache_items"] = len(_cache)
+        out["cache_bytes"] = _cache_bytes
+    out["pillow"] = _HAS_PIL
+    return out
@@ -1,8 +1,19 @@
 # ai_legal_routes.py — IA Legal unificada (CHAT + BUSCADOR) con normalización OpenAI
-from fastapi import APIRouter, HTTPException, Query, Header
+from fastapi import APIRouter, HTTPException, Query, Header, Request, BackgroundTasks
 from pydantic import BaseModel
+from typing import Optional
 import feedparser
+import hashlib
+import hmac
 import os
+import secrets
+import time
+import uuid
+
+import ai_admission
+import ai_tokens
+from admin_auth import require_admin
+from db import pg_conn
 
 # OpenAI
 try:
@@ -45,47 +56,331 @@ def normalize_openai_content(content):
     return "\n".join(result).strip() if result else ""
 
 # --------------------------------------
-# CHAT LEGAL
+# CHAT LEGAL (sesiones con historial en servidor)
 # --------------------------------------
+# El cliente solo envía session_id + session_key + el turno nuevo. El historial se
+# guarda aquí; cuando los turnos no resumidos pasan de LEGAL_HISTORY_MAX_TOKENS, los
+# más antiguos se condensan en un resumen (fuera de la petición) y solo quedan los
+# últimos LEGAL_HISTORY_KEEP_MESSAGES literales.
+# session_key es el secreto que se devuelve al abrir la sesión (aquí solo su hash);
+# las sesiones de un mediador con token firmado también las abre su dueño.
+MODEL_LEGAL = os.getenv("OPENAI_MODEL_LEGAL", "gpt-4o-mini")
+HISTORY_MAX_TOKENS    = int(os.getenv("LEGAL_HISTORY_MAX_TOKENS", "3000"))
+HISTORY_KEEP_MESSAGES = int(os.getenv("LEGAL_HISTORY_KEEP_MESSAGES", "4"))
+SUMMARY_MAX_TOKENS    = int(os.getenv("LEGAL_SUMMARY_MAX_TOKENS", "400"))
+
+LEGAL_SYSTEM = (
+    "Eres una IA experta jurídica en mediación en España. "
+    "Respondes de forma clara, estructurada y prudente. "
+    "No inventes normativa ni hechos. No sustituyes asesoramiento de un abogado presencial."
+)
+SUMMARY_SYSTEM = (
+    "Resume la conversación entre un usuario y una IA jurídica de mediación. "
+    "Conserva hechos, datos, preguntas pendientes y conclusiones; omite saludos y relleno. "
+    "Escribe en español, en viñetas breves."
+)
+
+SQL_LEGAL_CHAT = """
+CREATE TABLE IF NOT EXISTS legal_chat_sessions (
+  id            TEXT PRIMARY KEY,
+  owner         TEXT NOT NULL,
+  secret_hash   TEXT,
+  summary       TEXT,
+  summary_upto  INTEGER DEFAULT 0,         -- último mensaje incluido en el resumen
+  summary_tokens INTEGER DEFAULT 0,
+  created_at    TIMESTAMP DEFAULT NOW(),
+  updated_at    TIMESTAMP DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS legal_chat_messages (
+  id            SERIAL PRIMARY KEY,
+  session_id    TEXT NOT NULL REFERENCES legal_chat_sessions(id) ON DELETE CASCADE,
+  role          TEXT NOT NULL,             -- user | assistant
+  content       TEXT NOT NULL,
+  tokens        INTEGER NOT NULL,
+  prompt_tokens INTEGER,                   -- assistant: tokens realmente enviados
+  full_tokens   INTEGER,                   -- assistant: tokens con el historial completo
+  latency_ms    INTEGER,
+  created_at    TIMESTAMP DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS legal_chat_messages_session_idx ON legal_chat_messages (session_id, id);
+ALTER TABLE legal_chat_sessions ADD COLUMN IF NOT EXISTS secret_hash TEXT;
+"""
+
+_tables_ready = False
+
+def _ensure_chat_tables():
+    global _tables_ready
+    if _tables_ready:
+        return
+    with pg_conn() as cx:
+        with cx.cursor() as cur:
+            cur.execute(SQL_LEGAL_CHAT)
+        cx.commit()
+    _tables_ready = True
+
+
 class LegalChatIn(BaseModel):
     prompt: str
+    session_id: Optional[str] = None  # None → se abre una sesión nueva
+    session_key: Optional[str] = None  # secreto devuelto al abrirla
 
-@ai_legal.post("/chat")
-def legal_chat(body: LegalChatIn, authorization: str = Header(None)):
-    if not authorization:
-        raise HTTPException(401, "Falta Authorization")
 
+def _openai_client():
     if not HAS_OPENAI:
         raise HTTPException(500, "OpenAI no disponible")
-
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise HTTPException(503, "Falta OPENAI_API_KEY")
+    return OpenAI(api_key=api_key)
+
+
+def _hash_key(session_key: str) -> str:
+    return hashlib.sha256(session_key.encode("utf-8")).hexdigest()
 
-    client = OpenAI(api_key=api_key)
 
-    system = (
-        "Eres una IA experta jurídica en mediación en España. "
-        "Respondes de forma clara, estructurada y prudente. "
-        "No inventes normativa ni hechos. No sustituyes asesoramiento de un abogado presencial."
+def _load_session(session_id: str, owner: str, session_key: Optional[str]):
+    """Devuelve (summary, summary_tokens, mensajes no resumidos, tokens de todo el historial)."""
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "SELECT owner, secret_hash, summary, summary_upto, summary_tokens FROM legal_chat_sessions WHERE id=%s;",
+            (session_id,),
+        )
+        row = cur.fetchone()
+        if not row:
+            raise HTTPException(404, "Sesión no encontrada")
+        # owner email:... solo sale de un token de sesión verificado (ai_admission)
+        by_owner = row[0].startswith("email:") and row[0] == owner
+        by_key = bool(row[1] and session_key) and hmac.compare_digest(row[1], _hash_key(session_key))
+        if not (by_owner or by_key):
+            raise HTTPException(403, "No tienes acceso a esta sesión")
+        summary, upto, summary_tokens = row[2], row[3] or 0, row[4] or 0
+
+        cur.execute(
+            "SELECT id, role, content, tokens FROM legal_chat_messages WHERE session_id=%s AND id > %s ORDER BY id;",
+            (session_id, upto),
+        )
+        history = cur.fetchall()
+        cur.execute("SELECT COALESCE(SUM(tokens), 0) FROM legal_chat_messages WHERE session_id=%s;", (session_id,))
+        full = int(cur.fetchone()[0])
+    return summary, summary_tokens, history, full
+
+
+def _summarize_session(session_id: str) -> None:
+    """
+    Condensa los turnos antiguos si el historial literal supera el umbral.
+    Se ejecuta como tarea de fondo, tras responder al usuario.
+    """
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute("SELECT summary, summary_upto FROM legal_chat_sessions WHERE id=%s;", (session_id,))
+        row = cur.fetchone()
+        if not row:
+            return
+        summary, upto = row[0], row[1] or 0
+        cur.execute(
+            "SELECT id, role, content, tokens FROM legal_chat_messages WHERE session_id=%s AND id > %s ORDER BY id;",
+            (session_id, upto),
+        )
+        history = cur.fetchall()
+
+    if sum(r[3] for r in history) <= HISTORY_MAX_TOKENS or len(history) <= HISTORY_KEEP_MESSAGES:
+        return
+    old = history[:-HISTORY_KEEP_MESSAGES] if HISTORY_KEEP_MESSAGES else history
+
+    transcript = "\n\n".join(
+        ("Usuario: " if r[1] == "user" else "IA: ") + r[2] for r in old
     )
+    if summary:
+        transcript = f"Resumen previo:\n{summary}\n\nNuevos turnos:\n{transcript}"
 
     try:
-        resp = client.chat.completions.create(
-            model=os.getenv("OPENAI_MODEL_LEGAL", "gpt-4o-mini"),
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": body.prompt},
-            ],
+        client = _openai_client()
+        ident = ai_admission.system_identity("legal-summary")
+        est = ai_admission.estimate_tokens(SUMMARY_SYSTEM, transcript, max_output=SUMMARY_MAX_TOKENS)
+        with ai_admission.admit(ident, est) as ticket:
+            resp = client.chat.completions.create(
+                model=MODEL_LEGAL,
+                messages=[
+                    {"role": "system", "content": SUMMARY_SYSTEM},
+                    {"role": "user", "content": transcript},
+                ],
+                max_tokens=SUMMARY_MAX_TOKENS,
+            )
+            ticket.settle(resp)
+        new_summary = normalize_openai_content(resp.choices[0].message.content)
+    except Exception:
+        # sin resumen seguimos enviando el historial literal; se reintenta en el próximo turno
+        return
+    if not new_summary:
+        return
+
+    with pg_conn() as cx, cx.cursor() as cur:
+        # summary_upto=%s evita pisar un resumen hecho a la vez por otro turno
+        cur.execute(
+            """
+            UPDATE legal_chat_sessions
+               SET summary=%s, summary_upto=%s, summary_tokens=%s, updated_at=NOW()
+             WHERE id=%s AND summary_upto=%s;
+            """,
+            (new_summary, old[-1][0], ai_tokens.count_tokens(new_summary, MODEL_LEGAL), session_id, upto),
         )
+        cx.commit()
 
-        raw = resp.choices[0].message.content
-        text = normalize_openai_content(raw)
 
-        return {"ok": True, "text": text}
+@ai_legal.post("/chat")
+def legal_chat(body: LegalChatIn, request: Request, background: BackgroundTasks, authorization: str = Header(None)):
+    if not authorization:
+        raise HTTPException(401, "Falta Authorization")
 
-    except Exception as e:
-        raise HTTPException(500, f"Error IA Legal: {e}")
+    prompt = (body.prompt or "").strip()
+    if not prompt:
+        raise HTTPException(400, "Falta el mensaje")
+
+    client = _openai_client()
+    ident = ai_admission.identity_from_request(request)
+    _ensure_chat_tables()
+
+    session_id = (body.session_id or "").strip()
+    session_key = body.session_key
+    if session_id:
+        summary, summary_tokens, history, full = _load_session(session_id, ident.key, session_key)
+    else:
+        session_id = uuid.uuid4().hex
+        session_key = secrets.token_urlsafe(24)
+        summary, summary_tokens, history, full = None, 0, [], 0
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute(
+                "INSERT INTO legal_chat_sessions (id, owner, secret_hash) VALUES (%s, %s, %s);",
+                (session_id, ident.key, _hash_key(session_key)),
+            )
+            cx.commit()
+
+    messages = [{"role": "system", "content": LEGAL_SYSTEM}]
+    if summary:
+        messages.append({"role": "system", "content": f"Resumen de la conversación anterior:\n{summary}"})
+    messages += [{"role": r[1], "content": r[2]} for r in history]
+    messages.append({"role": "user", "content": prompt})
+
+    prompt_tokens = ai_tokens.count_tokens(prompt, MODEL_LEGAL)
+    sent_tokens = ai_tokens.messages_tokens(MODEL_LEGAL, *(m["content"] for m in messages))
+    # lo que costaría reenviar la conversación completa, como hacía el frontend
+    full_tokens = ai_tokens.messages_tokens(MODEL_LEGAL, LEGAL_SYSTEM, prompt) + full
+    if not ai_tokens.fits(MODEL_LEGAL, *(m["content"] for m in messages)):
+        raise HTTPException(413, "La conversación es demasiado larga. Abre una sesión nueva.")
+
+    t0 = time.perf_counter()
+    with ai_admission.admit(ident, sent_tokens + 1000) as ticket:
+        try:
+            resp = client.chat.completions.create(model=MODEL_LEGAL, messages=messages)
+            ticket.settle(resp)
+
+            raw = resp.choices[0].message.content
+            text = normalize_openai_content(raw)
+        except Exception as e:
+            raise HTTPException(500, f"Error IA Legal: {e}")
+    latency_ms = int((time.perf_counter() - t0) * 1000)
+
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "INSERT INTO legal_chat_messages (session_id, role, content, tokens) VALUES (%s, 'user', %s, %s);",
+            (session_id, prompt, prompt_tokens),
+        )
+        cur.execute(
+            """
+            INSERT INTO legal_chat_messages
+                   (session_id, role, content, tokens, prompt_tokens, full_tokens, latency_ms)
+            VALUES (%s, 'assistant', %s, %s, %s, %s, %s);
+            """,
+            (session_id, text, ai_tokens.count_tokens(text, MODEL_LEGAL), sent_tokens, full_tokens, latency_ms),
+        )
+        cur.execute("UPDATE legal_chat_sessions SET updated_at=NOW() WHERE id=%s;", (session_id,))
+        cx.commit()
+
+    background.add_task(_summarize_session, session_id)
+
+    return {
+        "ok": True,
+        "text": text,
+        "session_id": session_id,
+        "session_key": session_key,
+        "stats": {
+            "latency_ms": latency_ms,
+            "prompt_tokens": sent_tokens,
+            "tokens_saved": max(0, full_tokens - sent_tokens),
+            "summarized": bool(summary),
+        },
+    }
+
+
+@ai_legal.get("/chat/{session_id}")
+def legal_chat_history(
+    session_id: str,
+    request: Request,
+    authorization: str = Header(None),
+    x_session_key: Optional[str] = Header(None),
+):
+    """Historial completo de la sesión (para repintar el chat en el frontend).
+    El session_key va en X-Session-Key, no en la URL (que acaba en los logs)."""
+    if not authorization:
+        raise HTTPException(401, "Falta Authorization")
+    _ensure_chat_tables()
+    ident = ai_admission.identity_from_request(request)
+    summary, _, _, _ = _load_session(session_id, ident.key, x_session_key)
+
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            SELECT role, content, latency_ms, prompt_tokens, full_tokens, created_at
+              FROM legal_chat_messages
+             WHERE session_id=%s
+             ORDER BY id;
+            """,
+            (session_id,),
+        )
+        rows = cur.fetchall()
+
+    items = [
+        {
+            "role": r[0],
+            "content": r[1],
+            "latency_ms": r[2],
+            "tokens_saved": max(0, r[4] - r[3]) if r[3] is not None and r[4] is not None else None,
+            "created_at": r[5].isoformat() if r[5] else None,
+        }
+        for r in rows
+    ]
+    return {"ok": True, "session_id": session_id, "summary": summary, "items": items}
+
+
+@ai_legal.get("/chat-metrics")
+def legal_chat_metrics(hours: int = Query(24, ge=1, le=24 * 30), x_admin_token: Optional[str] = Header(None)):
+    """Latencia por turno y tokens ahorrados por el resumen en las últimas `hours` horas (admin)."""
+    require_admin(x_admin_token)
+    _ensure_chat_tables()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            SELECT COUNT(*),
+                   COALESCE(AVG(latency_ms), 0),
+                   COALESCE(percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms), 0),
+                   COALESCE(SUM(prompt_tokens), 0),
+                   COALESCE(SUM(GREATEST(full_tokens - prompt_tokens, 0)), 0),
+                   COUNT(DISTINCT session_id)
+              FROM legal_chat_messages
+             WHERE role='assistant' AND created_at > NOW() - (%s * INTERVAL '1 hour');
+            """,
+            (hours,),
+        )
+        turns, avg_ms, p95_ms, sent, saved, sessions = cur.fetchone()
+    return {
+        "ok": True,
+        "hours": hours,
+        "turns": turns,
+        "sessions": sessions,
+        "latency_avg_ms": round(float(avg_ms), 1),
+        "latency_p95_ms": round(float(p95_ms), 1),
+        "prompt_tokens": int(sent),
+        "tokens_saved": int(saved),
+    }
 
 # --------------------------------------
 # BUSCADOR LEGAL (BOE, Confilegal, LegalToday, CGPJ)
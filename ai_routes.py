@@ -1,13 +1,23 @@
 # ai_routes.py — IA institucional + asistente profesional + asistente con documento / imagen (Vision)
 import os
-from typing import Optional, Dict, Any
-from fastapi import APIRouter, HTTPException, Depends, Header
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Any, List
+from fastapi import APIRouter, HTTPException, Depends, Header, Request
 from pydantic import BaseModel
 import httpx
 import io
 import re
+import tempfile
 from pathlib import Path
 
+import ai_admission
+import ai_images
+import ai_tokens
+
 # --- OpenAI client ---
 try:
     from openai import OpenAI
@@ -54,73 +64,154 @@ def _client():
 MODEL_GENERAL = os.getenv("OPENAI_MODEL_GENERAL", "gpt-4o-mini")
 MODEL_ASSIST  = os.getenv("OPENAI_MODEL_ASSIST",  "gpt-4o")  # usamos gpt-4o para texto + visión
 
+# Map-reduce para documentos largos (en vez de recortar a max_chars)
+MAP_CHUNK_CHARS     = int(os.getenv("AI_MAP_CHUNK_CHARS", "24000"))
+MAP_CONCURRENCY     = int(os.getenv("AI_MAP_CONCURRENCY", "4"))
+MAP_MAX_CONCURRENCY = int(os.getenv("AI_MAP_MAX_CONCURRENCY", "8"))
+REDUCE_MAX_LEVELS   = int(os.getenv("AI_REDUCE_MAX_LEVELS", "3"))  # rondas de condensado si las notas no caben
+
+# Descargas de documentos: límite duro; se escriben por trozos a un fichero temporal
+DOWNLOAD_MAX_BYTES   = int(os.getenv("AI_DOWNLOAD_MAX_BYTES", str(8 * 1024 * 1024)))
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+# Extracción de texto en procesos aparte (pypdf / python-docx no bloquean el event loop)
+EXTRACT_WORKERS   = int(os.getenv("AI_EXTRACT_WORKERS", "2"))
+EXTRACT_MAX_QUEUE = int(os.getenv("AI_EXTRACT_MAX_QUEUE", "8"))    # trabajos esperando además de los activos
+EXTRACT_TIMEOUT   = float(os.getenv("AI_EXTRACT_TIMEOUT", "60"))   # segundos por documento
+EXTRACT_MAX_PAGES = int(os.getenv("AI_EXTRACT_MAX_PAGES", "500"))
+
+# Estimación de tokens de una imagen en visión sin preprocesar (detalle alto) para la admisión
+VISION_TOKENS_ESTIMATE = 1500
+
+# Separador de páginas en el texto extraído de PDF (permite trocear por página)
+PAGE_BREAK = "\f"
+
+def _ensure_fits(model: str, *contents: str) -> None:
+    """Rechaza antes de llamar a OpenAI si el prompt no cabe en el contexto del modelo."""
+    if not ai_tokens.fits(model, *contents):
+        raise HTTPException(413, "El texto es demasiado largo para el modelo. Acórtalo o adjúntalo como documento.")
+
 # -------------------- IA pública (institucional) --------------------
 class CompleteIn(BaseModel):
     prompt: str
 
 @ai_router.post("/complete")
-def ai_complete(body: CompleteIn):
+def ai_complete(body: CompleteIn, request: Request):
     client = _client()
-    try:
-        resp = client.chat.completions.create(
-            model=MODEL_GENERAL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Eres el asistente institucional de MEDIAZION. "
-                        "Respondes claro, breve y sin pedir ni retener datos personales."
-                    ),
-                },
-                {"role": "user", "content": body.prompt},
-            ],
-        )
-        out = resp.choices[0].message.content
-        return {"ok": True, "text": out}
-    except Exception as ex:
-        raise HTTPException(500, f"IA error: {ex}")
+    system = (
+        "Eres el asistente institucional de MEDIAZION. "
+        "Respondes claro, breve y sin pedir ni retener datos personales."
+    )
+    _ensure_fits(MODEL_GENERAL, system, body.prompt)
+    ident = ai_admission.identity_from_request(request)
+    with ai_admission.admit(ident, ai_admission.estimate_tokens(system, body.prompt)) as ticket:
+        try:
+            resp = client.chat.completions.create(
+                model=MODEL_GENERAL,
+                messages=[
+                    {"role": "system", "content": system},
+                    {"role": "user", "content": body.prompt},
+                ],
+            )
+            ticket.settle(resp)
+            out = resp.choices[0].message.content
+            return {"ok": True, "text": out}
+        except Exception as ex:
+            raise HTTPException(500, f"IA error: {ex}")
 
 # -------------------- IA profesional (solo mediadores autenticados) --------------------
 class AssistIn(BaseModel):
     prompt: str
 
 @ai_router.post("/assist")
-def ai_assist(body: AssistIn, _=Depends(token_gate)):
+def ai_assist(body: AssistIn, request: Request, _=Depends(token_gate)):
     client = _client()
     system = (
         "Eres el asistente profesional de MEDIAZION. Ayudas a mediadores a redactar actas, resúmenes de "
         "sesiones y comunicaciones. Sé preciso, confidencial, evita datos personales salvo que el usuario lo aporte."
     )
-    try:
-        resp = client.chat.completions.create(
-            model=MODEL_ASSIST,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": body.prompt},
-            ],
-        )
-        out = resp.choices[0].message.content
-        return {"ok": True, "text": out}
-    except Exception as ex:
-        raise HTTPException(500, f"IA error: {ex}")
+    _ensure_fits(MODEL_ASSIST, system, body.prompt)
+    ident = ai_admission.identity_from_request(request)
+    with ai_admission.admit(ident, ai_admission.estimate_tokens(system, body.prompt)) as ticket:
+        try:
+            resp = client.chat.completions.create(
+                model=MODEL_ASSIST,
+                messages=[
+                    {"role": "system", "content": system},
+                    {"role": "user", "content": body.prompt},
+                ],
+            )
+            ticket.settle(resp)
+            out = resp.choices[0].message.content
+            return {"ok": True, "text": out}
+        except Exception as ex:
+            raise HTTPException(500, f"IA error: {ex}")
+
+@ai_router.get("/admission/metrics")
+def admission_metrics(_=Depends(token_gate)):
+    """Métricas de la capa de admisión IA (espera en cola y consumo de tokens)."""
+    return {"ok": True, "metrics": ai_admission.metrics()}
 
 # -------------------- IA con documento (TXT/MD/PDF/DOCX/IMAGEN) --------------------
 class AssistWithIn(BaseModel):
     doc_url: str   # e.g. "https://.../archivo.pdf" o "https://.../imagen.jpg"
     prompt: str
-    max_chars: Optional[int] = 120_000
+    max_tokens: Optional[int] = None   # tope opcional de tokens del documento (por defecto, el contexto libre del modelo)
+    max_chars: Optional[int] = None    # legado: tope adicional en caracteres
+    # auto: map-reduce solo si el documento no cabe | truncate: recorta por párrafos | map_reduce: siempre trocea
+    mode: Optional[str] = "auto"
+    concurrency: Optional[int] = None  # llamadas simultáneas en la fase map (por defecto AI_MAP_CONCURRENCY)
+    image_detail: Optional[str] = "auto"  # visión: low | high | auto
 
 def _is_http(u: str) -> bool:
     return u.lower().startswith("http://") or u.lower().startswith("https://")
 
-async def _download_http(url: str, max_bytes: int = 8 * 1024 * 1024) -> tuple[str, bytes]:
-    """Descarga un recurso HTTP con límite de tamaño y devuelve (nombre sugerido, bytes)."""
-    async with httpx.AsyncClient(timeout=30) as cli:
-        r = await cli.get(url)
+# Cliente HTTP compartido (pool de conexiones reutilizado entre peticiones)
+_http: Optional[httpx.AsyncClient] = None
+
+def _http_client() -> httpx.AsyncClient:
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(
+            timeout=30,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=10),
+        )
+    return _http
+
+@ai_router.on_event("shutdown")
+async def _close_http_client():
+    if _http is not None and not _http.is_closed:
+        await _http.aclose()
+
+def _too_big(max_bytes: int) -> HTTPException:
+    return HTTPException(413, f"Archivo demasiado grande (>{max_bytes // (1024 * 1024)}MB)")
+
+async def _download_http(url: str, max_bytes: int = DOWNLOAD_MAX_BYTES) -> tuple[str, str]:
+    """
+    Descarga un recurso HTTP en streaming y devuelve (nombre sugerido, ruta temporal).
+    - Aborta en cuanto Content-Length o los bytes recibidos superan max_bytes.
+    - El contenido va directo a disco por trozos: en memoria solo hay un trozo cada vez.
+    El llamante debe borrar el fichero devuelto.
+    """
+    async with _http_client().stream("GET", url) as r:
         r.raise_for_status()
-        content = r.content
-        if len(content) > max_bytes:
-            raise HTTPException(413, "Archivo demasiado grande (>8MB)")
+        length = r.headers.get("content-length") or ""
+        if length.isdigit() and int(length) > max_bytes:
+            raise _too_big(max_bytes)
+
+        fh = tempfile.NamedTemporaryFile(prefix="ai_doc_", delete=False)
+        try:
+            with fh:
+                received = 0
+                async for chunk in r.aiter_bytes(DOWNLOAD_CHUNK_BYTES):
+                    received += len(chunk)
+                    if received > max_bytes:
+                        raise _too_big(max_bytes)
+                    fh.write(chunk)
+        except BaseException:
+            os.unlink(fh.name)
+            raise
+
         # Nombre sugerido desde cabeceras o URL
         filename = None
         cd = r.headers.get("content-disposition") or ""
@@ -130,31 +221,35 @@ async def _download_http(url: str, max_bytes: int = 8 * 1024 * 1024) -> tuple[st
         if not filename:
             path = r.url.path or ""
             filename = path.split("/")[-1] or "doc.bin"
-        return filename, content
+        return filename, fh.name
 
-def _read_local(path: Path, max_bytes: int = 8 * 1024 * 1024) -> bytes:
+def _check_local(path: Path, max_bytes: int = DOWNLOAD_MAX_BYTES) -> None:
     if not path.exists() or not path.is_file():
         raise HTTPException(404, "Documento no encontrado")
     size = path.stat().st_size
     if size > max_bytes:
-        raise HTTPException(413, "Archivo demasiado grande (>8MB)")
-    return path.read_bytes()
+        raise _too_big(max_bytes)
 
-def _extract_text_bytes(data: bytes, ext: str) -> str:
+def _extract_text_bytes(data, ext: str, max_pages: Optional[int] = None) -> str:
+    """Extrae texto de `data` (bytes o fichero binario abierto) según la extensión."""
     ext = ext.lower()
+    stream = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
     # TXT / MD
     if ext in (".txt", ".md"):
-        return data.decode("utf-8", errors="ignore")
+        return stream.read().decode("utf-8", errors="ignore")
     # PDF
     if ext == ".pdf":
         if not _HAS_PYPDF:
             raise HTTPException(500, "Falta pypdf en el entorno (añade pypdf a requirements)")
         try:
-            reader = pypdf.PdfReader(io.BytesIO(data))
+            reader = pypdf.PdfReader(stream)
             out = []
-            for page in reader.pages:
+            for i, page in enumerate(reader.pages):
+                if max_pages and i >= max_pages:
+                    out.append(f"[...documento recortado a {max_pages} páginas…]")
+                    break
                 out.append(page.extract_text() or "")
-            return "\n".join(out)
+            return ("\n" + PAGE_BREAK).join(out)
         except Exception as e:
             raise HTTPException(400, f"No se pudo extraer texto del PDF: {e}")
     # DOCX
@@ -162,8 +257,7 @@ def _extract_text_bytes(data: bytes, ext: str) -> str:
         if not _HAS_DOXC:
             raise HTTPException(500, "Falta python-docx en el entorno (añade python-docx a requirements)")
         try:
-            bio = io.BytesIO(data)
-            document = docx.Document(bio)
+            document = docx.Document(stream)
             out = [p.text for p in document.paragraphs]
             return "\n".join(out)
         except Exception as e:
@@ -171,14 +265,324 @@ def _extract_text_bytes(data: bytes, ext: str) -> str:
 
     raise HTTPException(415, "Tipo de documento no soportado. Usa TXT, MD, PDF o DOCX.")
 
+# -------------------- Extracción en pool de procesos --------------------
+_extract_pool: Optional[ProcessPoolExecutor] = None
+
+EXTRACT_STATS: Dict[str, Any] = {
+    "in_flight": 0,       # enviados al pool y aún sin terminar
+    "completed": 0,
+    "failed": 0,
+    "timeouts": 0,
+    "rejected": 0,        # cola llena → 503
+    "cancelled": 0,
+    "total_seconds": 0.0,
+    "max_seconds": 0.0,
+}
+
+def _extract_job(path: str, ext: str, max_pages: int) -> tuple[int, str]:
+    """
+    Se ejecuta en un proceso del pool. Recibe la ruta del fichero (no sus bytes:
+    pypdf y python-docx leen de disco lo que necesitan). Devuelve (status, texto |
+    detalle de error) en vez de lanzar HTTPException, que no viaja bien entre procesos.
+    """
+    try:
+        with open(path, "rb") as fh:
+            return 200, _extract_text_bytes(fh, ext, max_pages)
+    except HTTPException as e:
+        return e.status_code, str(e.detail)
+    except Exception as e:
+        return 500, f"Error extrayendo texto: {e}"
+
+def _get_extract_pool() -> ProcessPoolExecutor:
+    global _extract_pool
+    if _extract_pool is None:
+        # spawn: los procesos hijos no heredan el event loop ni los hilos del worker
+        _extract_pool = ProcessPoolExecutor(
+            max_workers=EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _extract_pool
+
+def _reset_extract_pool(failed: Optional[ProcessPoolExecutor] = None, kill: bool = False) -> None:
+    """
+    Descarta el pool; con kill=True termina sus procesos (trabajo colgado).
+    Con `failed`, solo si sigue siendo ese pool: una petición que falla tarde no
+    debe tirar el pool nuevo que ya ha creado otra.
+    """
+    global _extract_pool
+    if failed is not None and _extract_pool is not failed:
+        return
+    pool, _extract_pool = _extract_pool, None
+    if pool is None:
+        return
+    if kill:
+        for proc in list(getattr(pool, "_processes", {}).values()):
+            proc.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+@ai_router.on_event("shutdown")
+def _close_extract_pool():
+    _reset_extract_pool()
+
+def _image_job(data: bytes, detail: str) -> tuple[int, Any]:
+    """Preprocesado de imagen en el pool; mismo contrato (status, resultado) que _extract_job."""
+    try:
+        return 200, ai_images.preprocess_image(data, detail)
+    except Exception as e:
+        return 415, str(e)
+
+async def _run_pool_job(fn, *args) -> Any:
+    """
+    Ejecuta un trabajo en el pool de procesos con límite de cola y timeout.
+    - Cola llena → 503 inmediato (no acumulamos trabajo que va a llegar tarde).
+    - Timeout → 504 y se reinicia el pool para liberar el proceso colgado.
+    - Si el cliente cancela, el trabajo pendiente se descarta antes de empezar.
+    """
+    if EXTRACT_STATS["in_flight"] >= EXTRACT_WORKERS + EXTRACT_MAX_QUEUE:
+        EXTRACT_STATS["rejected"] += 1
+        raise HTTPException(503, "Hay demasiados documentos en proceso. Inténtalo en unos segundos.")
+
+    pool = _get_extract_pool()
+    try:
+        fut = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        # un proceso murió entre peticiones: pool nuevo y un reintento
+        _reset_extract_pool(pool)
+        pool = _get_extract_pool()
+        fut = pool.submit(fn, *args)
+    EXTRACT_STATS["in_flight"] += 1
+    t0 = time.perf_counter()
+    try:
+        status, out = await asyncio.wait_for(asyncio.wrap_future(fut), EXTRACT_TIMEOUT)
+    except asyncio.TimeoutError:
+        EXTRACT_STATS["timeouts"] += 1
+        if not fut.cancel():
+            _reset_extract_pool(pool, kill=True)
+        raise HTTPException(504, "La extracción de texto ha tardado demasiado")
+    except asyncio.CancelledError:
+        EXTRACT_STATS["cancelled"] += 1
+        fut.cancel()
+        raise
+    except BrokenProcessPool:
+        EXTRACT_STATS["failed"] += 1
+        _reset_extract_pool(pool)
+        raise HTTPException(500, "El proceso de extracción de texto se ha interrumpido")
+    finally:
+        EXTRACT_STATS["in_flight"] -= 1
+        elapsed = time.perf_counter() - t0
+        EXTRACT_STATS["total_seconds"] += elapsed
+        EXTRACT_STATS["max_seconds"] = max(EXTRACT_STATS["max_seconds"], elapsed)
+
+    if status != 200:
+        EXTRACT_STATS["failed"] += 1
+        raise HTTPException(status, out)
+    EXTRACT_STATS["completed"] += 1
+    return out
+
+async def _extract_text_async(path: str, ext: str) -> str:
+    """Extrae texto del fichero `path` en el pool de procesos (con límite de páginas)."""
+    return await _run_pool_job(_extract_job, path, ext, EXTRACT_MAX_PAGES)
+
+async def _prepare_image(url: str, detail: str) -> Optional[dict]:
+    """
+    Descarga la imagen una vez, la rota/reduce/recomprime y la cachea por hash.
+    Devuelve None si no se puede preprocesar (sin Pillow, URL no HTTP o imagen rara):
+    en ese caso se envía la URL original como antes.
+    """
+    if not ai_images._HAS_PIL or not _is_http(url):
+        return None
+
+    hit = ai_images.cache_get_url(url, detail)
+    if hit is not None:
+        return {**hit, "cached": True}
+
+    _, tmp_path = await _download_http(url, ai_images.IMAGE_MAX_BYTES)
+    try:
+        with open(tmp_path, "rb") as fh:
+            data = fh.read()  # acotado por IMAGE_MAX_BYTES; hace falta entero para el hash
+    finally:
+        os.unlink(tmp_path)
+
+    key = ai_images.content_key(data, detail)
+    hit = ai_images.cache_get(key)
+    if hit is not None:
+        ai_images.cache_put(key, hit, url)
+        return {**hit, "cached": True}
+
+    try:
+        item = await _run_pool_job(_image_job, data, detail)
+    except HTTPException as e:
+        if e.status_code == 415:
+            return None
+        raise
+    ai_images.cache_put(key, item, url)
+    return {**item, "cached": False}
+
+@ai_router.get("/extract/metrics")
+def extract_metrics(_=Depends(token_gate)):
+    """Métricas del pool de extracción (profundidad de cola y tiempos)."""
+    stats = dict(EXTRACT_STATS)
+    finished = stats["completed"] + stats["failed"] + stats["timeouts"] + stats["cancelled"]
+    stats["queue_depth"] = max(0, stats["in_flight"] - EXTRACT_WORKERS)
+    stats["avg_seconds"] = round(stats["total_seconds"] / finished, 4) if finished else 0.0
+    stats["workers"] = EXTRACT_WORKERS
+    stats["max_queue"] = EXTRACT_MAX_QUEUE
+    return {"ok": True, "metrics": stats, "images": ai_images.stats()}
+
+# -------------------- Map-reduce para documentos largos --------------------
+MAP_SYSTEM = (
+    "Eres el asistente profesional de MEDIAZION. Recibirás UNA PARTE de un documento más largo "
+    "junto con la instrucción del usuario. Extrae de esta parte solo lo relevante para la instrucción "
+    "(hechos, fechas, partes, posiciones, importes, acuerdos) en notas breves y fieles al texto. "
+    "No inventes datos; si la parte no contiene nada relevante, responde 'SIN DATOS RELEVANTES'."
+)
+
+REDUCE_SYSTEM = (
+    "Eres el asistente profesional de MEDIAZION. Recibirás notas extraídas, en orden, de las partes "
+    "de un documento largo junto con la instrucción del usuario. Responde a la instrucción usando solo "
+    "esas notas, con rigor, bien estructurado y orientado a mediación. "
+    "No inventes datos; si algo no está en las notas, dilo claramente."
+)
+
+CONDENSE_SYSTEM = (
+    "Eres el asistente profesional de MEDIAZION. Recibirás notas extraídas, en orden, de varias partes "
+    "consecutivas de un documento largo junto con la instrucción del usuario. Fusiónalas en notas más "
+    "breves, fieles y en el mismo orden, conservando lo relevante para la instrucción (hechos, fechas, "
+    "partes, posiciones, importes, acuerdos). No respondas aún a la instrucción ni inventes datos."
+)
+
+def _split_chunks(text: str, chunk_chars: int) -> List[str]:
+    """
+    Trocea el texto respetando páginas y párrafos:
+    - Primero separa por página (PAGE_BREAK) y después por párrafos (línea en blanco).
+    - Agrupa piezas consecutivas hasta chunk_chars.
+    - Solo si un párrafo suelto supera chunk_chars se corta por líneas / caracteres.
+    """
+    pieces: List[str] = []
+    for page in text.split(PAGE_BREAK):
+        for para in re.split(r"\n\s*\n", page):
+            para = para.strip()
+            if not para:
+                continue
+            if len(para) <= chunk_chars:
+                pieces.append(para)
+                continue
+            # párrafo enorme: por líneas y, en último caso, corte duro
+            buf = ""
+            for line in para.split("\n"):
+                while len(line) > chunk_chars:
+                    if buf:
+                        pieces.append(buf)
+                        buf = ""
+                    pieces.append(line[:chunk_chars])
+                    line = line[chunk_chars:]
+                if buf and len(buf) + len(line) + 1 > chunk_chars:
+                    pieces.append(buf)
+                    buf = ""
+                buf = f"{buf}\n{line}" if buf else line
+            if buf:
+                pieces.append(buf)
+
+    chunks: List[str] = []
+    cur = ""
+    for piece in pieces:
+        if cur and len(cur) + len(piece) + 2 > chunk_chars:
+            chunks.append(cur)
+            cur = ""
+        cur = f"{cur}\n\n{piece}" if cur else piece
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+def _chat(client, model: str, system: str, user: str, ticket=None) -> str:
+    resp = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ],
+    )
+    if ticket is not None:
+        ticket.settle(resp)
+    return resp.choices[0].message.content or ""
+
+async def _map_reduce(client, prompt: str, text: str, concurrency: int, ticket=None) -> tuple[str, int]:
+    """
+    Map: una llamada por trozo (como mucho `concurrency` a la vez).
+    Reduce: una llamada final con las notas de todos los trozos, en orden. Si no
+    caben en el contexto, antes se condensan por grupos (hasta REDUCE_MAX_LEVELS
+    rondas) y, en último caso, se recortan con ai_tokens.fit_to_budget.
+    Devuelve (respuesta, nº de trozos).
+    """
+    chunks = _split_chunks(text, MAP_CHUNK_CHARS)
+    total = len(chunks)
+    sem = asyncio.Semaphore(max(1, min(concurrency, MAP_MAX_CONCURRENCY)))
+
+    async def _map_one(i: int, chunk: str) -> str:
+        user = (
+            f"INSTRUCCIÓN DEL USUARIO:\n{prompt}\n\n"
+            f"=== PARTE {i + 1} DE {total} ===\n{chunk}"
+        )
+        async with sem:
+            return await asyncio.to_thread(_chat, client, MODEL_ASSIST, MAP_SYSTEM, user, ticket)
+
+    notes = await asyncio.gather(*(_map_one(i, c) for i, c in enumerate(chunks)))
+    notes = [f"--- Notas de la parte {i + 1}/{total} ---\n{n.strip()}" for i, n in enumerate(notes)]
+
+    header = f"{prompt}\n\n=== NOTAS DEL DOCUMENTO ({total} partes) ===\n"
+    budget = ai_tokens.remaining_context(MODEL_ASSIST, REDUCE_SYSTEM, header)
+
+    # Reduce jerárquico: mientras las notas no quepan en la llamada final, se
+    # condensan por grupos consecutivos que sí caben
+    for _ in range(REDUCE_MAX_LEVELS):
+        if len(notes) < 2 or ai_tokens.count_tokens("\n\n".join(notes), MODEL_ASSIST) <= budget:
+            break
+        groups = _group_notes(notes, budget)
+
+        async def _condense(group: List[str]) -> str:
+            joined, _, _ = ai_tokens.fit_to_budget("\n\n".join(group), MODEL_ASSIST, budget)
+            async with sem:
+                return await asyncio.to_thread(
+                    _chat, client, MODEL_ASSIST, CONDENSE_SYSTEM, f"{header}{joined}", ticket
+                )
+
+        condensed = await asyncio.gather(*(_condense(g) for g in groups))
+        notes = [f"--- Notas (grupo {i + 1}/{len(groups)}) ---\n{n.strip()}" for i, n in enumerate(condensed)]
+
+    # Red de seguridad: lo que quede se recorta por párrafos hasta caber
+    joined, _, _ = ai_tokens.fit_to_budget("\n\n".join(notes), MODEL_ASSIST, budget)
+    out = await asyncio.to_thread(_chat, client, MODEL_ASSIST, REDUCE_SYSTEM, f"{header}{joined}", ticket)
+    return out, total
+
+def _group_notes(notes: List[str], budget: int) -> List[List[str]]:
+    """Agrupa notas consecutivas sin pasar de `budget` tokens por grupo (al menos dos por grupo)."""
+    groups: List[List[str]] = []
+    cur: List[str] = []
+    used = 0
+    for note in notes:
+        n = ai_tokens.count_tokens(note, MODEL_ASSIST) + 2
+        if len(cur) >= 2 and used + n > budget:
+            groups.append(cur)
+            cur, used = [], 0
+        cur.append(note)
+        used += n
+    if cur:
+        if len(cur) == 1 and groups:
+            groups[-1].append(cur[0])
+        else:
+            groups.append(cur)
+    return groups
+
 @ai_router.post("/assist_with")
-async def ai_assist_with(body: AssistWithIn, _=Depends(token_gate)):
+async def ai_assist_with(body: AssistWithIn, request: Request, _=Depends(token_gate)):
     """
     Usa IA con un documento o imagen adjunto:
     - Si es PDF/DOCX/TXT/MD → extrae texto y responde.
-    - Si es imagen (JPG/PNG/WEBP/GIF) → usa GPT-4o con visión sobre la URL.
+    - Si es imagen (JPG/PNG/WEBP/GIF) → la reduce/cachea y usa GPT-4o con visión.
+    Toda la petición (incluidas las llamadas map-reduce) ocupa un único hueco de admisión.
     """
     client = _client()
+    ident = ai_admission.identity_from_request(request)
 
     doc_url = (body.doc_url or "").strip()
     if not doc_url:
@@ -189,39 +593,57 @@ async def ai_assist_with(body: AssistWithIn, _=Depends(token_gate)):
     if "." in doc_url:
         ext = "." + doc_url.split("?")[0].split(".")[-1].lower()
 
-    # 2) IMAGEN → Vision (usamos directamente la URL pública, no hace falta leer bytes)
+    # 2) IMAGEN → Vision (preprocesada e inline; si no se puede, la URL pública)
     if ext in IMAGE_EXTS:
+        detail = (body.image_detail or "auto").lower()
+        if detail not in ai_images.DETAILS:
+            raise HTTPException(400, "image_detail no válido. Usa low, high o auto.")
+        image = await _prepare_image(doc_url, detail)
+        if image is not None:
+            image_part = {"url": image["data_url"], "detail": image["detail"]}
+            image_tokens = image["tokens"]
+            image_info = {k: image[k] for k in ("width", "height", "bytes", "detail", "tokens", "orig_tokens", "cached")}
+        else:
+            image_part = {"url": doc_url}
+            image_tokens = VISION_TOKENS_ESTIMATE
+            image_info = None
+
         system = (
             "Eres el asistente profesional de MEDIAZION. Vas a analizar una imagen "
             "(por ejemplo un documento escaneado, una captura de pantalla, etc.) "
             "junto con una instrucción. Describe el contenido relevante y responde "
             "pensando en mediación (hechos, posiciones, posibles acuerdos)."
         )
-        try:
-            resp = client.chat.completions.create(
-                model=MODEL_ASSIST,
-                messages=[
-                    {"role": "system", "content": system},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": body.prompt},
-                            {"type": "image_url", "image_url": {"url": doc_url}},
-                        ],
-                    },
-                ],
-            )
-            out = resp.choices[0].message.content
-            return {"ok": True, "text": out}
-        except Exception as ex:
-            raise HTTPException(500, f"IA (visión) error: {ex}")
+        est = ai_admission.estimate_tokens(system, body.prompt) + image_tokens
+        async with ai_admission.admit_async(ident, est) as ticket:
+            try:
+                resp = await asyncio.to_thread(
+                    client.chat.completions.create,
+                    model=MODEL_ASSIST,
+                    messages=[
+                        {"role": "system", "content": system},
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": body.prompt},
+                                {"type": "image_url", "image_url": image_part},
+                            ],
+                        },
+                    ],
+                )
+                ticket.settle(resp)
+                out = resp.choices[0].message.content
+                return {"ok": True, "text": out, "image": image_info}
+            except Exception as ex:
+                raise HTTPException(500, f"IA (visión) error: {ex}")
 
     # 3) DOCUMENTO TEXTO → PDF/DOCX/TXT/MD: descargamos y extraemos texto
     filename = "doc.bin"
-    raw = b""
+    tmp_path: Optional[str] = None
 
     if _is_http(doc_url):
-        filename, raw = await _download_http(doc_url)
+        filename, tmp_path = await _download_http(doc_url)
+        doc_path = tmp_path
         if "." in filename:
             ext = "." + filename.split(".")[-1].lower()
         else:
@@ -235,17 +657,21 @@ async def ai_assist_with(body: AssistWithIn, _=Depends(token_gate)):
         # seguridad básica: sólo dentro de la carpeta actual
         if str(path).find(str(Path(".").resolve())) != 0:
             raise HTTPException(403, "Ruta no permitida")
-        raw = _read_local(path)
+        _check_local(path)
+        doc_path = str(path)
         ext = path.suffix.lower()
 
-    text = _extract_text_bytes(raw, ext)
+    try:
+        text = await _extract_text_async(doc_path, ext)
+    finally:
+        if tmp_path:
+            os.unlink(tmp_path)
     if not text.strip():
         raise HTTPException(400, "El documento no tiene texto legible")
 
-    # recortar si es demasiado grande
-    max_chars = body.max_chars or 120_000
-    if len(text) > max_chars:
-        text = text[:max_chars] + "\n\n[...texto recortado por longitud…]"
+    mode = (body.mode or "auto").strip().lower()
+    if mode not in ("auto", "truncate", "map_reduce"):
+        raise HTTPException(400, "mode no válido. Usa auto, truncate o map_reduce.")
 
     system = (
         "Eres el asistente profesional de MEDIAZION. Recibirás el contenido de un documento "
@@ -253,17 +679,42 @@ async def ai_assist_with(body: AssistWithIn, _=Depends(token_gate)):
         "mediación (actas, resúmenes, borradores de acuerdos, comunicaciones). "
         "No inventes datos; si algo no está en el documento, dilo claramente."
     )
-    user_message = f"{body.prompt}\n\n=== DOCUMENTO COMPLETO ===\n{text}"
+    header = f"{body.prompt}\n\n=== DOCUMENTO COMPLETO ===\n"
 
-    try:
-        resp = client.chat.completions.create(
-            model=MODEL_ASSIST,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user_message},
-            ],
+    # Presupuesto en tokens: contexto del modelo − system − prompt − reserva de respuesta
+    budget = ai_tokens.remaining_context(MODEL_ASSIST, system, header)
+    if body.max_tokens:
+        budget = min(budget, body.max_tokens)
+    if body.max_chars and len(text) > body.max_chars:
+        text_fits = False
+    else:
+        text_fits = ai_tokens.count_tokens(text, MODEL_ASSIST) <= budget
+
+    # documentos largos → map-reduce (sin perder el final del documento)
+    if mode == "map_reduce" or (mode == "auto" and not text_fits):
+        n_parts = len(text) // MAP_CHUNK_CHARS + 1
+        est = ai_admission.estimate_tokens(
+            text, MAP_SYSTEM * n_parts, body.prompt * (n_parts + 1), max_output=1000 * (n_parts + 1)
         )
-        out = resp.choices[0].message.content
-        return {"ok": True, "text": out}
-    except Exception as ex:
-        raise HTTPException(500, f"IA error: {ex}")
+        async with ai_admission.admit_async(ident, est) as ticket:
+            try:
+                out, parts = await _map_reduce(
+                    client, body.prompt, text, body.concurrency or MAP_CONCURRENCY, ticket
+                )
+                return {"ok": True, "text": out, "mode": "map_reduce", "parts": parts}
+            except Exception as ex:
+                raise HTTPException(500, f"IA error: {ex}")
+
+    # recortar por párrafos hasta caber en el presupuesto (modo truncate)
+    if body.max_chars and len(text) > body.max_chars:
+        text = text[: body.max_chars]
+    text, doc_tokens, truncated = ai_tokens.fit_to_budget(text, MODEL_ASSIST, budget)
+    user_message = header + text
+
+    est = ai_tokens.messages_tokens(MODEL_ASSIST, system, header) + doc_tokens + 1000
+    async with ai_admission.admit_async(ident, est) as ticket:
+        try:
+            out = await asyncio.to_thread(_chat, client, MODEL_ASSIST, system, user_message, ticket)
+            return {"ok": True, "text": out, "tokens": doc_tokens, "truncated": truncated}
+        except Exception as ex:
+            raise HTTPException(500, f"IA error: {ex}")
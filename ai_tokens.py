@@ -0,0 +1,165 @@
+# ai_tokens.py — Presupuesto de prompt por tokens (en vez de por caracteres)
+# ---------------------------------------------------------------
+# - Cuenta tokens con tiktoken (si está instalado) o con una estimación de respaldo.
+# - Calcula el contexto restante de un modelo tras el system prompt, el prompt del
+#   usuario y la reserva para la respuesta.
+# - Recorta documentos por párrafos hasta caber en el presupuesto.
+# - Cachea el recuento de documentos repetidos (hash del texto).
+#
+# Micro-benchmark:  python ai_tokens.py
+
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import tiktoken  # type: ignore
+    _HAS_TIKTOKEN = True
+except Exception:
+    _HAS_TIKTOKEN = False
+
+# Ventana de contexto por modelo (tokens). AI_CONTEXT_TOKENS fuerza un valor para todos.
+MODEL_CONTEXT = {
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000,
+    "gpt-4-turbo": 128_000,
+    "gpt-4": 8_192,
+    "gpt-3.5-turbo": 16_385,
+}
+DEFAULT_CONTEXT = 128_000
+CONTEXT_OVERRIDE = int(os.getenv("AI_CONTEXT_TOKENS", "0"))
+OUTPUT_RESERVE = int(os.getenv("AI_OUTPUT_RESERVE_TOKENS", "4096"))
+
+# Coste fijo aproximado del formato chat: por mensaje + cebado de la respuesta
+TOKENS_PER_MESSAGE = 4
+TOKENS_REPLY_PRIMING = 3
+
+CACHE_MAX_ITEMS = int(os.getenv("AI_TOKEN_CACHE_ITEMS", "256"))
+CACHE_MIN_CHARS = 2_000  # textos cortos: contar es más barato que hashear y buscar
+
+TRUNCATION_MARK = "\n\n[...texto recortado por longitud…]"
+
+_encodings: dict = {}
+_cache: "OrderedDict[tuple, int]" = OrderedDict()
+_lock = threading.Lock()
+
+
+def _encoding(model: str):
+    if not _HAS_TIKTOKEN:
+        return None
+    enc = _encodings.get(model)
+    if enc is None:
+        try:
+            enc = tiktoken.encoding_for_model(model)
+        except Exception:
+            enc = tiktoken.get_encoding("o200k_base")
+        _encodings[model] = enc
+    return enc
+
+
+def _count_raw(text: str, model: str) -> int:
+    enc = _encoding(model)
+    if enc is None:
+        # Respaldo sin tiktoken: ~3 caracteres por token (sobreestima a propósito)
+        return len(text) // 3 + 1
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Tokens de `text` para `model`; los textos largos repetidos salen de caché."""
+    if not text:
+        return 0
+    if len(text) < CACHE_MIN_CHARS:
+        return _count_raw(text, model)
+
+    key = (model, hashlib.sha256(text.encode("utf-8")).hexdigest())
+    with _lock:
+        n = _cache.get(key)
+        if n is not None:
+            _cache.move_to_end(key)
+            return n
+    n = _count_raw(text, model)
+    with _lock:
+        _cache[key] = n
+        while len(_cache) > CACHE_MAX_ITEMS:
+            _cache.popitem(last=False)
+    return n
+
+
+def context_window(model: str) -> int:
+    if CONTEXT_OVERRIDE:
+        return CONTEXT_OVERRIDE
+    if model in MODEL_CONTEXT:
+        return MODEL_CONTEXT[model]
+    # variantes con fecha: gpt-4o-2024-08-06 → gpt-4o
+    for name in sorted(MODEL_CONTEXT, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_CONTEXT[name]
+    return DEFAULT_CONTEXT
+
+
+def messages_tokens(model: str, *contents: str) -> int:
+    """Tokens de una conversación con esos contenidos (un mensaje por contenido)."""
+    return sum(count_tokens(c, model) + TOKENS_PER_MESSAGE for c in contents) + TOKENS_REPLY_PRIMING
+
+
+def remaining_context(model: str, *fixed: str, reserve_output: int = OUTPUT_RESERVE) -> int:
+    """Tokens disponibles para el documento tras los textos fijos y la reserva de salida."""
+    return max(0, context_window(model) - messages_tokens(model, *fixed) - reserve_output)
+
+
+def fits(model: str, *contents: str, reserve_output: int = OUTPUT_RESERVE) -> bool:
+    return messages_tokens(model, *contents) + reserve_output <= context_window(model)
+
+
+def fit_to_budget(text: str, model: str, budget: int) -> tuple[str, int, bool]:
+    """
+    Recorta `text` por párrafos para que quepa en `budget` tokens.
+    Devuelve (texto, tokens usados, recortado?).
+    """
+    total = count_tokens(text, model)
+    if total <= budget:
+        return text, total, False
+
+    budget -= count_tokens(TRUNCATION_MARK, model)
+    kept = []
+    used = 0
+    for para in re.split(r"(\n\s*\n)", text):
+        n = _count_raw(para, model)
+        if used + n > budget:
+            if not kept and para.strip():
+                # primer párrafo más grande que todo el presupuesto: corte por líneas
+                for line in para.split("\n"):
+                    n = _count_raw(line + "\n", model)
+                    if used + n > budget:
+                        break
+                    kept.append(line + "\n")
+                    used += n
+            break
+        kept.append(para)
+        used += n
+
+    out = "".join(kept).rstrip() + TRUNCATION_MARK
+    return out, used + count_tokens(TRUNCATION_MARK, model), True
+
+
+if __name__ == "__main__":
+    para = "La parte solicitante expone que el conflicto vecinal comenzó en 2021 por ruidos nocturnos. " * 8
+    doc = "\n\n".join(f"{i}. {para}" for i in range(170))  # ≈ 120k caracteres
+    model = "gpt-4o"
+
+    t0 = time.perf_counter()
+    n = count_tokens(doc, model)
+    cold = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    count_tokens(doc, model)
+    warm = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    fit_to_budget(doc, model, n // 2)
+    trim = time.perf_counter() - t0
+
+    print(f"tiktoken={_HAS_TIKTOKEN} chars={len(doc)} tokens={n}")
+    print(f"count cold={cold * 1000:.2f} ms  cached={warm * 1000:.3f} ms  trim={trim * 1000:.2f} ms")
@@ -75,6 +75,8 @@ from upload_routes import upload_router
 # 🔹 Actas DOCX/PDF
 from actas_routes import actas_router
 from actas_docx_logo import router as actas_docx_router
+from actas_render import router as actas_jobs_router
+from actas_storage import router as actas_documentos_router
 
 # 🔹 Contacto web
 from contact_routes import contact_router
@@ -138,6 +140,11 @@ except:
     admin_instituciones_router = None
 from instituciones_login_routes import router as instituciones_login_router
 
+# Correo (bandeja de salida, admin)
+from email_outbox import outbox_router
+# Contactos de la web (admin)
+from contactos import contactos_router
+
 
 # ---------------------------------------------------------
 # REGISTER ROUTERS (orden estable y limpio)
@@ -159,6 +166,8 @@ app.include_router(upload_router, prefix="/api", tags=["upload"])
 # Actas
 app.include_router(actas_router, prefix="/api", tags=["actas"])
 app.include_router(actas_docx_router)
+app.include_router(actas_jobs_router)
+app.include_router(actas_documentos_router)
 
 # Contacto
 app.include_router(contact_router, prefix="/api", tags=["contact"])
@@ -216,6 +225,12 @@ if admin_instituciones_router:
         tags=["instituciones-admin"],
     )
 
+# Bandeja de salida de correo (dead letters)
+app.include_router(outbox_router, prefix="/api/admin", tags=["admin"])
+
+# Contactos de la web (búsqueda y seguimiento)
+app.include_router(contactos_router, prefix="/api/admin", tags=["admin"])
+
 
 # ---------------------------------------------------------
 # END
@@ -4,6 +4,8 @@ from pydantic import BaseModel, EmailStr
 from db import pg_conn
 import bcrypt
 
+import signing
+
 auth_router = APIRouter(prefix="/auth", tags=["auth"])
 
 # ======== INPUT MODELS ========
@@ -63,8 +65,8 @@ def login(body: LoginIn):
             raise HTTPException(401, "Usuario o contraseña incorrectos")
         if not _check_password(body.password, row[0]):
             raise HTTPException(401, "Usuario o contraseña incorrectos")
-    # El frontend solo necesita ok:true para entrar; si luego usas JWT, cámbialo aquí
-    return {"ok": True, "token": "ok"}
+    # Token de sesión firmado: las rutas de IA lo usan como identidad verificada
+    return {"ok": True, "token": signing.issue_session(email)}
 
 @auth_router.post("/change_password")
 def change_password(body: ChangePwdIn):
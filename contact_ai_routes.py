@@ -1,9 +1,9 @@
 # contact_ai_routes.py — Clasificación básica + auto-respuesta para contactos web
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, BackgroundTasks, HTTPException
 from pydantic import BaseModel, EmailStr
-from typing import Literal
-from contact_routes import _send_mail  # ya lo tienes para enviar correos
+import contactos
+from contact_classifier import ContactType, classify_contact
 
 router = APIRouter()
 
@@ -13,41 +13,6 @@ class ContactIn(BaseModel):
     subject: str
     message: str
 
-ContactType = Literal["mediador", "cliente", "otro"]
-
-
-def classify_contact(body: ContactIn) -> tuple[ContactType, float]:
-    """
-    Versión 1: clasificación sencilla por palabras clave.
-    Más adelante se puede sustituir por IA sin tocar el resto.
-    """
-    text = f"{body.subject} {body.message}".lower()
-
-    score_mediador = 0
-    score_cliente = 0
-
-    # Indicadores de mediador
-    for kw in ["mediador", "mediación", "panel", "alta", "suscripción", "pro", "herramientas", "ia"]:
-        if kw in text:
-            score_mediador += 1
-
-    # Indicadores de cliente
-    for kw in ["conflicto", "problema", "disputa", "mi pareja", "mi ex", "vecino", "empresa", "trabajo", "laboral"]:
-        if kw in text:
-            score_cliente += 1
-
-    # Si no hay casi contexto, lo marcamos como "otro"
-    if score_mediador == 0 and score_cliente == 0:
-        return "otro", 0.4
-
-    if score_mediador > score_cliente:
-        return "mediador", 0.7 + 0.05 * score_mediador
-    if score_cliente > score_mediador:
-        return "cliente", 0.7 + 0.05 * score_cliente
-
-    # Empate raro → lo dejamos como "otro"
-    return "otro", 0.5
-
 
 def build_auto_reply(body: ContactIn, kind: ContactType) -> str:
     name = body.name.strip() or "Hola"
@@ -111,32 +76,32 @@ Mediazion
 """
 
 
+def contact_emails(name: str, email: str, subject: str, message: str, kind: ContactType, confidence: float) -> list:
+    """Correos de un contacto de /contact/auto: solo la auto-respuesta. [(to, asunto, html, nombre)]"""
+    reply_text = build_auto_reply(ContactIn(name=name, email=email, subject=subject, message=message), kind)
+    return [(email, "Hemos recibido tu mensaje · Mediazion", reply_text, email)]
+
+
 @router.post("/api/contact/auto")
-def contact_auto(body: ContactIn):
+def contact_auto(body: ContactIn, background: BackgroundTasks):
     """
-    Recibe un contacto desde la web, lo clasifica y envía una auto-respuesta.
-    Devuelve el tipo detectado y un preview del texto enviado.
+    Recibe un contacto desde la web, lo guarda en `contactos` y devuelve el tipo
+    detectado y un preview de la auto-respuesta. El envío va en segundo plano
+    (contactos.process).
     """
+    kind, confidence = classify_contact(body)
+    reply_text = build_auto_reply(body, kind)
     try:
-        kind, confidence = classify_contact(body)
-        reply_text = build_auto_reply(body, kind)
-
-        # Enviar auto-respuesta al usuario
-        # Usamos la misma función de envío que en contact_routes
-        _send_mail(
-            body.email,
-            "Hemos recibido tu mensaje · Mediazion",
-            reply_text,
-            body.email,
-        )
-
-        # (Opcional) Podríamos enviar copia interna a vuestro email general
-
-        return {
-            "ok": True,
-            "type": kind,
-            "confidence": confidence,
-            "auto_reply": reply_text,
-        }
+        contact_id = contactos.insert(body.name, body.email, body.subject, body.message, source="contact_auto")
     except Exception as e:
         raise HTTPException(500, f"Error procesando contacto: {e}")
+    background.add_task(contactos.process, contact_id)
+
+    return {
+        "ok": True,
+        "id": contact_id,
+        "status": "pending",
+        "type": kind,
+        "confidence": confidence,
+        "auto_reply": reply_text,
+    }
@@ -0,0 +1,199 @@
+# contact_classifier.py — Clasificación por palabras clave de contactos y correos entrantes
+# ---------------------------------------------------------------
+# Compartido por /contact (contact_routes), /contact/auto (contact_ai_routes) y el
+# listener IMAP (email_listener_mediazion).
+#
+# - Todas las formas de todas las palabras clave van en UNA expresión regular
+#   precompilada con límites de palabra: el texto se recorre una sola vez, y
+#   "pro" ya no casa con "problema" ni "ia" con "familia".
+# - El texto y las palabras clave se comparan sin tildes ni mayúsculas
+#   ("Mediación" = "mediacion").
+# - Cada palabra clave suma su peso una vez por tipo, aunque aparezca varias veces.
+#
+# Benchmark sobre correos largos (frente a la versión con `kw in text`):
+#   python contact_classifier.py --bench
+
+import argparse
+import random
+import re
+import time
+import unicodedata
+from typing import Dict, Literal, Tuple
+
+ContactType = Literal["mediador", "cliente", "otro"]
+
+# tipo → palabra clave → (peso, formas). Las formas se escriben sin tildes.
+KEYWORDS: Dict[str, Dict[str, Tuple[float, Tuple[str, ...]]]] = {
+    "mediador": {
+        "mediador":     (1.0, ("mediador", "mediadora", "mediadores", "mediadoras")),
+        "mediacion":    (1.0, ("mediacion", "mediaciones")),
+        "panel":        (1.0, ("panel",)),
+        "alta":         (1.0, ("alta", "darme de alta", "darse de alta")),
+        "suscripcion":  (1.0, ("suscripcion", "suscripciones", "suscribirme")),
+        "pro":          (1.0, ("pro",)),
+        "herramientas": (1.0, ("herramienta", "herramientas")),
+        "ia":           (1.0, ("ia",)),
+    },
+    "cliente": {
+        "conflicto": (1.0, ("conflicto", "conflictos")),
+        "problema":  (1.0, ("problema", "problemas")),
+        "disputa":   (1.0, ("disputa", "disputas")),
+        "mi pareja": (1.0, ("mi pareja",)),
+        "mi ex":     (1.0, ("mi ex", "mi expareja", "mi exmarido", "mi exmujer")),
+        "vecino":    (1.0, ("vecino", "vecina", "vecinos", "vecinas")),
+        "empresa":   (1.0, ("empresa", "empresas")),
+        "trabajo":   (1.0, ("trabajo",)),
+        "laboral":   (1.0, ("laboral", "laborales")),
+    },
+}
+
+
+def fold(text: str) -> str:
+    """Minúsculas y sin tildes (y sin el resto de caracteres no ASCII: emojis, €…)."""
+    if text.isascii():
+        return text.lower()
+    return unicodedata.normalize("NFKD", text.casefold()).encode("ascii", "ignore").decode("ascii")
+
+
+def _compile():
+    forms: Dict[str, Tuple[str, str, float]] = {}
+    for kind, keywords in KEYWORDS.items():
+        for keyword, (weight, variants) in keywords.items():
+            for form in variants:
+                forms[" ".join(fold(form).split())] = (kind, keyword, weight)
+    # más largas primero: "mi expareja" antes que "mi ex"
+    alternation = "|".join(
+        r"\s+".join(re.escape(w) for w in form.split())
+        for form in sorted(forms, key=len, reverse=True)
+    )
+    return re.compile(rf"\b(?:{alternation})\b"), forms
+
+
+_PATTERN, _FORMS = _compile()
+
+
+def score(text: str) -> Dict[str, float]:
+    """Puntuación por tipo en una sola pasada sobre el texto."""
+    seen = set()
+    scores = {kind: 0.0 for kind in KEYWORDS}
+    for m in _PATTERN.finditer(fold(text)):
+        kind, keyword, weight = _FORMS[" ".join(m.group(0).split())]
+        if (kind, keyword) not in seen:
+            seen.add((kind, keyword))
+            scores[kind] += weight
+    return scores
+
+
+def classify_text(subject: str, message: str) -> Tuple[ContactType, float]:
+    scores = score(f"{subject} {message}")
+    score_mediador, score_cliente = scores["mediador"], scores["cliente"]
+
+    # Si no hay casi contexto, lo marcamos como "otro"
+    if score_mediador == 0 and score_cliente == 0:
+        return "otro", 0.4
+
+    if score_mediador > score_cliente:
+        return "mediador", min(1.0, 0.7 + 0.05 * score_mediador)
+    if score_cliente > score_mediador:
+        return "cliente", min(1.0, 0.7 + 0.05 * score_cliente)
+
+    # Empate raro → lo dejamos como "otro"
+    return "otro", 0.5
+
+
+def classify_contact(body) -> Tuple[ContactType, float]:
+    """`body` es cualquier objeto con subject y message (los ContactIn de las rutas)."""
+    return classify_text(body.subject or "", body.message or "")
+
+
+# ---------------- Benchmark ----------------
+
+_LEGACY = {
+    "mediador": ["mediador", "mediación", "panel", "alta", "suscripción", "pro", "herramientas", "ia"],
+    "cliente": ["conflicto", "problema", "disputa", "mi pareja", "mi ex", "vecino", "empresa", "trabajo", "laboral"],
+}
+
+
+_PER_KEYWORD = {
+    kind: [
+        re.compile(r"\b(?:" + "|".join(re.escape(f) for f in forms) + r")\b")
+        for _, forms in keywords.values()
+    ]
+    for kind, keywords in KEYWORDS.items()
+}
+
+
+def _per_keyword_score(subject: str, message: str) -> Dict[str, float]:
+    """Mismo resultado que score(), pero una pasada por palabra clave (para comparar)."""
+    text = fold(f"{subject} {message}")
+    return {kind: float(sum(1 for rx in pats if rx.search(text))) for kind, pats in _PER_KEYWORD.items()}
+
+
+def _legacy_classify(subject: str, message: str) -> Tuple[ContactType, float]:
+    """La versión anterior (una búsqueda `in` por palabra clave), solo para comparar."""
+    text = f"{subject} {message}".lower()
+    sm = sum(1 for kw in _LEGACY["mediador"] if kw in text)
+    sc = sum(1 for kw in _LEGACY["cliente"] if kw in text)
+    if sm == 0 and sc == 0:
+        return "otro", 0.4
+    if sm > sc:
+        return "mediador", 0.7 + 0.05 * sm
+    if sc > sm:
+        return "cliente", 0.7 + 0.05 * sc
+    return "otro", 0.5
+
+
+# Relleno neutro (con palabras que la versión `in` confundía: familia, programa…)
+_CORPUS_FILLER = (
+    "hola buenas tardes les escribo porque familia hijos casa acuerdo reunión propuesta "
+    "gracias saludos información consulta situación presupuesto abogado juzgado programa "
+    "provincia ciudad comunidad pago alquiler herencia divorcio custodia fecha semana "
+    "problemático programación familiar iniciativa altavoz empresarial proceso día"
+).split()
+_CORPUS_KEYWORDS = (
+    "mediación", "Mediadora", "panel", "darme de alta", "suscripción", "PRO", "herramientas", "IA",
+    "conflicto", "problemas", "disputa", "mi pareja", "mi ex", "vecinos", "empresa", "trabajo", "laboral",
+)
+
+
+def bench(n: int = 500, words: int = 3000, seed: int = 7) -> None:
+    rnd = random.Random(seed)
+    corpus = []
+    for i in range(n):
+        text = rnd.choices(_CORPUS_FILLER, k=words)
+        for kw in rnd.sample(_CORPUS_KEYWORDS, rnd.randint(0, 4)):
+            text.insert(rnd.randrange(len(text)), kw)
+        corpus.append((f"Consulta {i}", " ".join(text)))
+    size_kb = sum(len(m) for _, m in corpus) / 1024
+
+    results = {}
+    runs = (
+        ("antes (`in`, subcadenas)", _legacy_classify),
+        ("una regex por palabra clave", _per_keyword_score),
+        ("ahora (una pasada)", classify_text),
+    )
+    for name, fn in runs:
+        t0 = time.perf_counter()
+        results[name] = [fn(s, m) for s, m in corpus]
+        elapsed = time.perf_counter() - t0
+        print(f"{name:30s} {elapsed * 1000 / n:.3f} ms/correo  ({size_kb / 1024 / elapsed:.1f} MB/s)")
+
+    antes, ahora = results[runs[0][0]], results[runs[2][0]]
+    assert [score(s + " " + m) for s, m in corpus] == results[runs[1][0]]
+
+    changed = sum(1 for a, b in zip(antes, ahora) if a[0] != b[0])
+    print(f"{n} correos de ~{words} palabras ({size_kb / n:.1f} KB); tipo distinto en {changed}")
+    for text in ("Tengo un problema con mi familia", "Quiero información sobre MEDIACIÓN y el panel PRO"):
+        print(f"  {text!r}: antes={_legacy_classify('', text)} ahora={classify_text('', text)}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Clasificador de contactos por palabras clave")
+    ap.add_argument("--bench", action="store_true")
+    ap.add_argument("-n", type=int, default=500)
+    ap.add_argument("--words", type=int, default=3000)
+    args = ap.parse_args()
+    if args.bench:
+        bench(args.n, args.words)
+    else:
+        ap.print_help()
@@ -1,9 +1,12 @@
 import os, smtplib, ssl
 from email.mime.text import MIMEText
 from email.utils import formataddr
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, BackgroundTasks, HTTPException
 from pydantic import BaseModel, EmailStr
-from typing import Literal
+
+import contactos
+import mail_transport
+from contact_classifier import ContactType, classify_contact
 
 # --- Soporte opcional para settings (config.py) ---
 try:
@@ -52,74 +55,64 @@ MAIL_FROM       = _get("MAIL_FROM", "info@mediazion.eu")
 MAIL_FROM_NAME  = _get("MAIL_FROM_NAME", "MEDIAZION")
 MAIL_TO_DEFAULT = _get("MAIL_TO_DEFAULT", "info@mediazion.eu")
 MAIL_BCC        = os.getenv("MAIL_BCC", "")  # solo desde entorno si se usa
+# true → _send_mail encola y vuelve al momento; false → envía dentro de la petición
+MAIL_ASYNC      = str(os.getenv("MAIL_ASYNC", "true")).strip().lower() in ("1","true","yes","on")
+SMTP_TIMEOUT    = float(os.getenv("SMTP_TIMEOUT", "20"))
 
-def _send_mail(to_email: str, subject: str, html: str, to_name: str = ""):
-    if not (SMTP_HOST and SMTP_USER and SMTP_PASS):
-        raise RuntimeError("SMTP no configurado (SMTP_HOST/USER/PASS)")
-
-    msg = MIMEText(html, "html", "utf-8")
-    msg["Subject"] = subject
-    msg["From"] = formataddr((MAIL_FROM_NAME, MAIL_FROM))
-    msg["To"] = formataddr((to_name or to_email, to_email))
-
-    # BCC (no se añade en cabecera)
-    bcc_list = [e.strip() for e in MAIL_BCC.split(",") if e.strip()] if MAIL_BCC else []
-    rcpt = [to_email] + bcc_list
-
+def _smtp_connect() -> smtplib.SMTP:
+    """Conexión nueva ya autenticada (la reutiliza el pool de mail_transport)."""
     context = ssl.create_default_context()
 
     # Reglas:
     #  - Puerto 465 => SSL implícito (SMTP_SSL), ignoramos STARTTLS
     #  - Cualquier otro puerto => STARTTLS si SMTP_TLS=true, si no, plano (no recomendado)
     if SMTP_PORT == 465:
-        with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context) as server:
-            server.login(SMTP_USER, SMTP_PASS)
-            server.sendmail(MAIL_FROM, rcpt, msg.as_string())
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context, timeout=SMTP_TIMEOUT)
     else:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            if SMTP_TLS:
-                server.ehlo()
-                server.starttls(context=context)
-                server.ehlo()
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_TLS:
+            server.ehlo()
+            server.starttls(context=context)
+            server.ehlo()
+    try:
+        # servidores locales de prueba (aiosmtpd) pueden ir sin usuario
+        if SMTP_USER:
             server.login(SMTP_USER, SMTP_PASS)
-            server.sendmail(MAIL_FROM, rcpt, msg.as_string())
+    except Exception:
+        server.close()
+        raise
+    return server
 
+_mailer = mail_transport.Mailer(_smtp_connect, MAIL_FROM)
 
-# --------- CLASIFICACIÓN BÁSICA (versión 1) ---------
-ContactType = Literal["mediador", "cliente", "otro"]
+def _build_message(to_email: str, subject: str, html: str, to_name: str = "") -> tuple[list, str]:
+    msg = MIMEText(html, "html", "utf-8")
+    msg["Subject"] = subject
+    msg["From"] = formataddr((MAIL_FROM_NAME, MAIL_FROM))
+    msg["To"] = formataddr((to_name or to_email, to_email))
 
-def classify_contact(body: ContactIn) -> tuple[ContactType, float]:
+    # BCC (no se añade en cabecera)
+    bcc_list = [e.strip() for e in MAIL_BCC.split(",") if e.strip()] if MAIL_BCC else []
+    rcpt = [to_email] + bcc_list
+    return rcpt, msg.as_string()
+
+def _send_mail(to_email: str, subject: str, html: str, to_name: str = "", wait: bool = False):
     """
-    Versión 1: clasificación sencilla por palabras clave.
-    Más adelante se puede sustituir por IA OpenAI sin tocar el resto.
+    Envía un correo por el pool SMTP.
+    Por defecto se encola y vuelve al momento (los errores de envío se registran en
+    el log del hilo emisor); wait=True envía dentro de la llamada y propaga errores.
     """
-    text = f"{body.subject} {body.message}".lower()
-
-    score_mediador = 0
-    score_cliente = 0
-
-    # Indicadores de mediador
-    for kw in ["mediador", "mediación", "panel", "alta", "suscripción", "pro", "herramientas", "ia"]:
-        if kw in text:
-            score_mediador += 1
-
-    # Indicadores de cliente
-    for kw in ["conflicto", "problema", "disputa", "mi pareja", "mi ex", "vecino", "empresa", "trabajo", "laboral"]:
-        if kw in text:
-            score_cliente += 1
-
-    # Si no hay casi contexto, lo marcamos como "otro"
-    if score_mediador == 0 and score_cliente == 0:
-        return "otro", 0.4
+    if not (SMTP_HOST and (SMTP_USER and SMTP_PASS or not SMTP_TLS)):
+        raise RuntimeError("SMTP no configurado (SMTP_HOST/USER/PASS)")
 
-    if score_mediador > score_cliente:
-        return "mediador", 0.7 + 0.05 * score_mediador
-    if score_cliente > score_mediador:
-        return "cliente", 0.7 + 0.05 * score_cliente
+    rcpt, data = _build_message(to_email, subject, html, to_name)
+    if wait or not MAIL_ASYNC:
+        _mailer.send_now(rcpt, data)
+    else:
+        _mailer.enqueue(rcpt, data)
 
-    # Empate raro → lo dejamos como "otro"
-    return "otro", 0.5
 
+# --------- CLASIFICACIÓN BÁSICA (contact_classifier) ---------
 
 def build_auto_reply(body: ContactIn, kind: ContactType) -> str:
     name = body.name.strip() or "Hola"
@@ -183,14 +176,23 @@ Mediazion
 """
 
 
-@contact_router.post("/contact")
-def contact(data: ContactIn):
-    if not data.accept:
-        raise HTTPException(400, "Debes aceptar la política de privacidad.")
+@contact_router.get("/mail/metrics")
+def mail_metrics():
+    """Cola y pool SMTP de este proceso."""
+    return {"ok": True, "metrics": _mailer.metrics()}
 
-    # Clasificar el mensaje
-    kind, confidence = classify_contact(data)
-    auto_reply_text = build_auto_reply(data, kind)
+
+@contact_router.on_event("shutdown")
+def _flush_mail_queue():
+    # dar una oportunidad a lo encolado antes de que muera el proceso
+    _mailer.flush(timeout=10.0)
+    _mailer.pool.close_all()
+
+
+def contact_emails(name: str, email: str, subject: str, message: str, kind: ContactType, confidence: float) -> list:
+    """Correos de un contacto de /contact: auto-respuesta + copia interna. [(to, asunto, html, nombre)]"""
+    contact = ContactIn(name=name, email=email, subject=subject, message=message, accept=True)
+    auto_reply_text = build_auto_reply(contact, kind)
     # Lo envolvemos en HTML sencillo
     user_html = f"""
     <div style="font-family:system-ui,Segoe UI,Roboto,Arial; white-space:pre-wrap">
@@ -203,50 +205,43 @@ def contact(data: ContactIn):
     <div style="font-family:system-ui,Segoe UI,Roboto,Arial">
       <p>Nuevo contacto desde la web:</p>
       <ul>
-        <li><strong>Nombre:</strong> {data.name}</li>
-        <li><strong>Email:</strong> {data.email}</li>
-        <li><strong>Asunto:</strong> {data.subject}</li>
+        <li><strong>Nombre:</strong> {name}</li>
+        <li><strong>Email:</strong> {email}</li>
+        <li><strong>Asunto:</strong> {subject}</li>
         <li><strong>Tipo detectado:</strong> {kind} (conf={confidence:.2f})</li>
       </ul>
-      <p>{data.message}</p>
+      <p>{message}</p>
     </div>
     """
 
-    # Envío con “soft-fail”: nunca tiramos 500 por el correo
-    mail_user_sent = False
-    mail_info_sent = False
-    mail_error = ""
-
-    try:
+    return [
         # Auto-respuesta al usuario
-        _send_mail(
-            data.email,
-            "Hemos recibido tu mensaje · MEDIAZION",
-            user_html,
-            data.name,
-        )
-        mail_user_sent = True
-
+        (email, "Hemos recibido tu mensaje · MEDIAZION", user_html, name),
         # Copia interna para MEDIAZION
-        _send_mail(
-            MAIL_TO_DEFAULT,
-            f"[Contacto] {data.subject} — {data.name} <{data.email}>",
-            info_html,
-            "MEDIAZION",
-        )
-        mail_info_sent = True
-    except RuntimeError:
-        # SMTP no configurado: devolvemos ok pero marcamos sent=False
-        mail_error = "SMTP no configurado"
+        (MAIL_TO_DEFAULT, f"[Contacto] {subject} — {name} <{email}>", info_html, "MEDIAZION"),
+    ]
+
+
+@contact_router.post("/contact")
+def contact(data: ContactIn, background: BackgroundTasks):
+    if not data.accept:
+        raise HTTPException(400, "Debes aceptar la política de privacidad.")
+
+    # Un solo INSERT y respondemos; los correos (bandeja de salida) van en
+    # segundo plano: contactos.process(). La clasificación es barata (palabras
+    # clave) y se devuelve ya, como siempre.
+    kind, confidence = classify_contact(data)
+    try:
+        contact_id = contactos.insert(data.name, data.email, data.subject, data.message, source="contact")
     except Exception as e:
-        # Error de transporte (p.ej. 'Connection unexpectedly closed')
-        mail_error = str(e)
+        raise HTTPException(500, f"No se pudo registrar el contacto: {e}")
+    background.add_task(contactos.process, contact_id)
 
     return {
         "ok": True,
-        "sent_user": mail_user_sent,
-        "sent_info": mail_info_sent,
-        "mail_error": mail_error,
+        "id": contact_id,
+        "status": "pending",
+        "mail_queued": True,
         "type": kind,
         "confidence": confidence,
     }
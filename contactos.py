@@ -0,0 +1,298 @@
+# contactos.py — Bandeja de contactos de la web (/contact y /contact/auto)
+# ---------------------------------------------------------------
+# - La petición solo hace un INSERT en `contactos` y responde.
+# - Después (BackgroundTasks) se clasifica el mensaje, se encolan los correos en
+#   email_outbox y se actualiza la fila, todo en una transacción. Si el proceso
+#   muere antes, un barrido periódico recoge los 'pending' que se quedaron atrás.
+# - Admin: /api/admin/contactos con búsqueda de texto completo (tsvector en
+#   español, índice GIN), filtros por tipo/confianza/estado y paginación keyset.
+
+import asyncio
+import os
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query
+
+from admin_auth import require_admin
+from contact_classifier import classify_text
+from db import pg_conn
+
+CONTACTOS_SWEEP_SECONDS = int(os.getenv("CONTACTOS_SWEEP_SECONDS", "60"))
+CONTACTOS_STALE_SECONDS = int(os.getenv("CONTACTOS_STALE_SECONDS", "120"))
+
+SQL_CONTACTOS = """
+CREATE TABLE IF NOT EXISTS contactos (
+  id            BIGSERIAL PRIMARY KEY,
+  name          TEXT NOT NULL,
+  email         TEXT NOT NULL,
+  subject       TEXT,
+  message       TEXT,
+  source        TEXT NOT NULL DEFAULT 'contact',   -- contact | contact_auto
+  status        TEXT NOT NULL DEFAULT 'pending',   -- pending | processed | failed
+  kind          TEXT,
+  confidence    REAL,
+  error         TEXT,
+  created_at    TIMESTAMP DEFAULT NOW(),
+  processed_at  TIMESTAMP NULL,
+  search_tsv    TSVECTOR GENERATED ALWAYS AS (
+                  to_tsvector('spanish',
+                    coalesce(name, '') || ' ' || coalesce(email, '') || ' ' ||
+                    coalesce(subject, '') || ' ' || coalesce(message, ''))
+                ) STORED
+);
+CREATE INDEX IF NOT EXISTS contactos_search_idx ON contactos USING GIN (search_tsv);
+CREATE INDEX IF NOT EXISTS contactos_kind_idx ON contactos (kind, id DESC);
+CREATE INDEX IF NOT EXISTS contactos_pending_idx ON contactos (created_at) WHERE status='pending';
+"""
+
+_table_ready = False
+
+
+def ensure_table() -> None:
+    # Conexión propia: el flag solo se marca con la tabla ya confirmada.
+    global _table_ready
+    if _table_ready:
+        return
+    with pg_conn() as cx:
+        with cx.cursor() as cur:
+            cur.execute(SQL_CONTACTOS)
+        cx.commit()
+    _table_ready = True
+
+
+def insert(name: str, email: str, subject: str, message: str, source: str = "contact") -> int:
+    """Un único INSERT; el resto del trabajo va en process()."""
+    ensure_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO contactos (name, email, subject, message, source)
+            VALUES (%s, LOWER(%s), %s, %s, %s)
+            RETURNING id;
+            """,
+            (name, email, subject, message, source),
+        )
+        contact_id = cur.fetchone()[0]
+        cx.commit()
+    return contact_id
+
+
+def _emails_for(source: str):
+    # import diferido: las rutas importan este módulo
+    if source == "contact_auto":
+        from contact_ai_routes import contact_emails
+    else:
+        from contact_routes import contact_emails
+    return contact_emails
+
+
+def process(contact_id: int) -> None:
+    """Clasifica, encola los correos y marca la fila (una sola transacción)."""
+    import email_outbox
+
+    try:
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute(
+                """
+                SELECT name, email, subject, message, source FROM contactos
+                 WHERE id=%s AND status='pending'
+                 FOR UPDATE SKIP LOCKED;
+                """,
+                (contact_id,),
+            )
+            row = cur.fetchone()
+            if not row:
+                return  # ya procesado (o lo está procesando otro)
+            name, email, subject, message, source = row
+            kind, confidence = classify_text(subject or "", message or "")
+            for to_email, mail_subject, html, to_name in _emails_for(source)(
+                name, email, subject or "", message or "", kind, confidence
+            ):
+                email_outbox.enqueue(cur, to_email, mail_subject, html, to_name, source=source)
+            cur.execute(
+                """
+                UPDATE contactos
+                   SET status='processed', kind=%s, confidence=%s, processed_at=NOW(), error=NULL
+                 WHERE id=%s;
+                """,
+                (kind, confidence, contact_id),
+            )
+            cx.commit()
+    except Exception as e:
+        print(f"[Contactos] Error procesando contacto {contact_id}: {e}")
+        try:
+            with pg_conn() as cx, cx.cursor() as cur:
+                cur.execute(
+                    "UPDATE contactos SET status='failed', error=%s WHERE id=%s AND status='pending';",
+                    (str(e)[:500], contact_id),
+                )
+                cx.commit()
+        except Exception:
+            pass  # sin BD: sigue en 'pending' y lo recoge el barrido
+
+
+def process_stale(limit: int = 100) -> int:
+    """Contactos 'pending' cuya tarea de fondo no llegó a ejecutarse (reinicio, caída)."""
+    ensure_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id FROM contactos
+             WHERE status='pending' AND created_at < NOW() - (%s * INTERVAL '1 second')
+             ORDER BY created_at
+             LIMIT %s;
+            """,
+            (CONTACTOS_STALE_SECONDS, limit),
+        )
+        ids = [r[0] for r in cur.fetchall()]
+    for contact_id in ids:
+        process(contact_id)
+    return len(ids)
+
+
+# ---------------- Admin ----------------
+
+contactos_router = APIRouter(prefix="/contactos", tags=["admin"])
+
+
+@contactos_router.get("")
+def contactos_list(
+    x_admin_token: Optional[str] = Header(None),
+    q: Optional[str] = None,
+    kind: Optional[str] = Query(None, pattern="^(mediador|cliente|otro)$"),
+    status: Optional[str] = Query(None, pattern="^(pending|processed|failed)$"),
+    min_confidence: Optional[float] = Query(None, ge=0, le=1),
+    max_confidence: Optional[float] = Query(None, ge=0, le=1),
+    before_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+):
+    """
+    Contactos más recientes primero. `q` es búsqueda de texto completo (sintaxis
+    web: palabras, "frase exacta", -excluir). Paginación con next_before_id.
+    """
+    require_admin(x_admin_token)
+    ensure_table()
+    sql = """
+        SELECT id, name, email, subject, LEFT(message, 300), source, status, kind, confidence,
+               created_at, processed_at, error
+          FROM contactos
+         WHERE TRUE
+    """
+    params: list = []
+    if q and q.strip():
+        sql += " AND search_tsv @@ websearch_to_tsquery('spanish', %s)"
+        params.append(q.strip())
+    if kind:
+        sql += " AND kind=%s"
+        params.append(kind)
+    if status:
+        sql += " AND status=%s"
+        params.append(status)
+    if min_confidence is not None:
+        sql += " AND confidence >= %s"
+        params.append(min_confidence)
+    if max_confidence is not None:
+        sql += " AND confidence <= %s"
+        params.append(max_confidence)
+    if before_id:
+        sql += " AND id < %s"
+        params.append(before_id)
+    sql += " ORDER BY id DESC LIMIT %s;"
+    params.append(limit)
+
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(sql, tuple(params))
+        rows = cur.fetchall()
+    items = [
+        {
+            "id": r[0],
+            "name": r[1],
+            "email": r[2],
+            "subject": r[3],
+            "message_preview": r[4],
+            "source": r[5],
+            "status": r[6],
+            "kind": r[7],
+            "confidence": r[8],
+            "created_at": r[9].isoformat() if r[9] else None,
+            "processed_at": r[10].isoformat() if r[10] else None,
+            "error": r[11],
+        }
+        for r in rows
+    ]
+    return {"ok": True, "items": items, "next_before_id": items[-1]["id"] if len(items) == limit else None}
+
+
+@contactos_router.get("/{contact_id}")
+def contactos_get(contact_id: int, x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    ensure_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, name, email, subject, message, source, status, kind, confidence,
+                   created_at, processed_at, error
+              FROM contactos WHERE id=%s;
+            """,
+            (contact_id,),
+        )
+        r = cur.fetchone()
+    if not r:
+        raise HTTPException(404, "Contacto no encontrado")
+    return {
+        "ok": True,
+        "id": r[0],
+        "name": r[1],
+        "email": r[2],
+        "subject": r[3],
+        "message": r[4],
+        "source": r[5],
+        "status": r[6],
+        "kind": r[7],
+        "confidence": r[8],
+        "created_at": r[9].isoformat() if r[9] else None,
+        "processed_at": r[10].isoformat() if r[10] else None,
+        "error": r[11],
+    }
+
+
+@contactos_router.post("/{contact_id}/retry")
+def contactos_retry(contact_id: int, x_admin_token: Optional[str] = Header(None)):
+    """Vuelve a procesar un contacto 'failed'."""
+    require_admin(x_admin_token)
+    ensure_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "UPDATE contactos SET status='pending', error=NULL WHERE id=%s AND status='failed';",
+            (contact_id,),
+        )
+        updated = cur.rowcount
+        cx.commit()
+    if not updated:
+        raise HTTPException(404, "Contacto no encontrado o no está en failed")
+    process(contact_id)
+    return {"ok": True, "id": contact_id}
+
+
+_sweeper: Optional[asyncio.Task] = None
+
+
+async def _sweep_loop():
+    while True:
+        try:
+            await asyncio.to_thread(process_stale)
+        except Exception as e:
+            print(f"[Contactos] Error en el barrido de pendientes: {e}")
+        await asyncio.sleep(CONTACTOS_SWEEP_SECONDS)
+
+
+@contactos_router.on_event("startup")
+async def _start_sweeper():
+    global _sweeper
+    _sweeper = asyncio.create_task(_sweep_loop())
+
+
+@contactos_router.on_event("shutdown")
+def _stop_sweeper():
+    if _sweeper:
+        _sweeper.cancel()
@@ -3,24 +3,52 @@ Mediazion · Email Listener IMAP (versión simplificada y estable)
 Lee el buzón info@ (Nominalia) por IMAP, clasifica el mensaje con la
 misma lógica que /contact y envía una auto-respuesta.
 
+Por defecto mantiene una conexión abierta con IMAP IDLE (el servidor avisa al
+llegar correo, se responde en segundos) y renueva el IDLE cada 29 min. Si la
+conexión cae reconecta; si el servidor no soporta IDLE (o IMAP_MODE=poll) vuelve
+al polling cada IMAP_CHECK_INTERVAL segundos.
+
+Lectura incremental por UID: se guarda el último UID procesado por buzón
+(email_listener_state, junto con UIDVALIDITY) y los mensajes nuevos se leen en
+lotes de UID FETCH: cabeceras + BODYSTRUCTURE y después solo la parte de texto
+con BODY.PEEK, truncada a IMAP_BODY_MAX_BYTES. Los adjuntos nunca se descargan.
+
+Los mensajes se procesan en tubería: la conexión IMAP lee lotes y los deja en una
+cola acotada; EMAIL_LISTENER_WORKERS hilos clasifican y encolan la respuesta, y
+los flags \\Seen se marcan por lotes. Cada respuesta se registra por Message-ID
+en email_listener_replies en la misma transacción que la encola en email_outbox,
+así que un reinicio nunca manda dos auto-respuestas al mismo correo.
+
+Benchmark (5.000 correos con adjunto en una carpeta aparte):
+  python email_listener_mediazion.py --seed 5000 --folder MediazionBench
+  python email_listener_mediazion.py --bench 5000 --folder MediazionBench
+
 Se apoya en:
 - ContactIn
-- classify_contact
 - build_auto_reply
-- _send_mail
 
-del módulo contact_routes.py
+del módulo contact_routes.py, en classify_contact de contact_classifier.py y en
+email_outbox para el envío.
 """
 
 import os
+import re
 import time
+import queue
+import threading
+import base64
+import quopri
+import select
 import imaplib
 import email
 from email.header import decode_header
 from email.utils import parseaddr
 from email.message import Message
 
-from contact_routes import ContactIn, classify_contact, build_auto_reply, _send_mail
+import email_outbox
+from contact_classifier import classify_contact
+from contact_routes import ContactIn, build_auto_reply
+from db import pg_conn
 
 
 # Config IMAP desde entorno (Render)
@@ -31,6 +59,18 @@ IMAP_PASS = os.getenv("IMAP_PASS", "")
 IMAP_SSL = str(os.getenv("IMAP_SSL", "true")).strip().lower() in ("1", "true", "yes", "on")
 IMAP_FOLDER = os.getenv("IMAP_FOLDER", "INBOX")
 CHECK_INTERVAL = int(os.getenv("IMAP_CHECK_INTERVAL", "60"))  # segundos
+# auto → IDLE si el servidor lo soporta, si no polling; idle | poll para forzar
+IMAP_MODE = os.getenv("IMAP_MODE", "auto").strip().lower()
+# RFC 2177: el servidor puede cortar un IDLE a los 30 min; lo renovamos antes
+IDLE_REFRESH = int(os.getenv("IMAP_IDLE_REFRESH", str(29 * 60)))
+RECONNECT_MAX_DELAY = int(os.getenv("IMAP_RECONNECT_MAX_DELAY", "60"))
+# Mensajes por UID FETCH y bytes máximos de texto por mensaje (los adjuntos no se bajan)
+IMAP_FETCH_BATCH = int(os.getenv("IMAP_FETCH_BATCH", "200"))
+IMAP_BODY_MAX_BYTES = int(os.getenv("IMAP_BODY_MAX_BYTES", "16384"))
+HEADER_FIELDS = "FROM SUBJECT MESSAGE-ID"
+# Hilos que clasifican y responden, y mensajes leídos que pueden esperar en cola
+LISTENER_WORKERS = int(os.getenv("EMAIL_LISTENER_WORKERS", "4"))
+LISTENER_QUEUE_MAX = int(os.getenv("EMAIL_LISTENER_QUEUE_MAX", "100"))
 
 # Umbral fijo para considerar alta prioridad
 MIN_CONFIDENCE = 0.75
@@ -93,11 +133,11 @@ def _get_body_from_message(msg: Message) -> str:
     return ""
 
 
-def process_unseen_messages() -> None:
-    if not (IMAP_HOST and IMAP_USER and IMAP_PASS):
-        print("[EmailListener] IMAP no configurado (IMAP_HOST/USER/PASS). Saliendo.")
-        return
+def _imap_configured() -> bool:
+    return bool(IMAP_HOST and IMAP_USER and IMAP_PASS)
 
+
+def _connect() -> imaplib.IMAP4:
     print(
         f"[EmailListener] Conectando a IMAP {IMAP_HOST}:{IMAP_PORT} (SSL={IMAP_SSL})…"
     )
@@ -109,104 +149,585 @@ def process_unseen_messages() -> None:
 
     imap.login(IMAP_USER, IMAP_PASS)
     imap.select(IMAP_FOLDER)
-
-    status, data = imap.search(None, "UNSEEN")
-    if status != "OK":
-        print("[EmailListener] No se pudieron buscar mensajes UNSEEN")
-        imap.logout()
+    return imap
+
+
+def process_unseen_messages(imap: imaplib.IMAP4 | None = None) -> None:
+    """
+    Procesa los UNSEEN. Con `imap` reutiliza esa conexión (modo IDLE); sin él abre
+    una y la cierra al terminar (modo polling).
+    """
+    if imap is None:
+        if not _imap_configured():
+            print("[EmailListener] IMAP no configurado (IMAP_HOST/USER/PASS). Saliendo.")
+            return
+        imap = _connect()
+        try:
+            _process_unseen(imap)
+        finally:
+            try:
+                imap.logout()
+            except Exception:
+                pass
+        print("[EmailListener] Ciclo completado.")
         return
+    _process_unseen(imap)
+
+
+def _build_reply(from_header: str, subject_header: str, body_text: str) -> tuple | None:
+    """
+    Clasifica un correo entrante y prepara la auto-respuesta.
+    Devuelve (email, nombre, asunto, html, tipo, confianza) o None si no se responde.
+    """
+    from_name, from_email = parseaddr(from_header)
+    from_name = from_name or from_email or "Amigo/a"
+
+    # Evitar bucles: si el remitente somos nosotros mismos, saltar
+    if not from_email or from_email.lower().endswith("@mediazion.eu"):
+        return None
+
+    subject = _decode_header_value(subject_header) or "(sin asunto)"
+    if not body_text.strip():
+        body_text = "(sin contenido)"
+
+    # Crear un ContactIn "falso" con el contenido del correo
+    contact = ContactIn(
+        name=from_name,
+        email=from_email,
+        subject=subject,
+        message=body_text,
+        accept=True,  # nos ha escrito voluntariamente
+    )
 
-    ids = data[0].split()
-    if not ids:
-        print("[EmailListener] No hay mensajes nuevos (UNSEEN).")
-        imap.logout()
+    kind, confidence = classify_contact(contact)
+    auto_reply_text = build_auto_reply(contact, kind)
+
+    # Alta prioridad: cliente y confianza alta
+    is_high_priority = (kind == "cliente" and confidence >= MIN_CONFIDENCE)
+
+    # Envolvemos en HTML sencillo (igual que en contact_routes)
+    user_html = f"""
+    <div style="font-family:system-ui,Segoe UI,Roboto,Arial; white-space:pre-wrap">
+    {auto_reply_text}
+    </div>
+    """
+
+    reply_subject = subject
+    if is_high_priority and PRIORITY_SUBJECT_PREFIX:
+        if not subject.startswith(PRIORITY_SUBJECT_PREFIX):
+            reply_subject = f"{PRIORITY_SUBJECT_PREFIX}{subject}"
+
+    return from_email, from_name, reply_subject, user_html, kind, confidence
+
+
+# ---------------- Checkpoint por UID ----------------
+
+SQL_LISTENER_STATE = """
+CREATE TABLE IF NOT EXISTS email_listener_state (
+  mailbox      TEXT PRIMARY KEY,
+  uidvalidity  BIGINT NOT NULL,
+  last_uid     BIGINT NOT NULL,
+  updated_at   TIMESTAMP DEFAULT NOW()
+);
+"""
+
+SQL_LISTENER_REPLIES = """
+CREATE TABLE IF NOT EXISTS email_listener_replies (
+  message_id  TEXT PRIMARY KEY,
+  mailbox     TEXT NOT NULL,
+  uid         BIGINT,
+  from_email  TEXT,
+  kind        TEXT,
+  confidence  REAL,
+  created_at  TIMESTAMP DEFAULT NOW()
+);
+"""
+
+_state_ready = False
+
+
+def _mailbox_key() -> str:
+    return f"{IMAP_USER.lower()}@{IMAP_HOST.lower()}/{IMAP_FOLDER}"
+
+
+def _ensure_state_table() -> None:
+    global _state_ready
+    if _state_ready:
         return
+    with pg_conn() as cx:
+        with cx.cursor() as cur:
+            cur.execute(SQL_LISTENER_STATE)
+            cur.execute(SQL_LISTENER_REPLIES)
+        cx.commit()
+    _state_ready = True
+
+
+def _load_checkpoint() -> tuple[int, int] | None:
+    _ensure_state_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "SELECT uidvalidity, last_uid FROM email_listener_state WHERE mailbox=%s;",
+            (_mailbox_key(),),
+        )
+        row = cur.fetchone()
+    return (int(row[0]), int(row[1])) if row else None
 
-    print(f"[EmailListener] Encontrados {len(ids)} mensajes nuevos. Procesando…")
 
-    for num in ids:
-        status, msg_data = imap.fetch(num, "(RFC822)")
+def _save_checkpoint(uidvalidity: int, last_uid: int) -> None:
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO email_listener_state (mailbox, uidvalidity, last_uid, updated_at)
+            VALUES (%s, %s, %s, NOW())
+            ON CONFLICT (mailbox) DO UPDATE
+              SET uidvalidity=EXCLUDED.uidvalidity, last_uid=EXCLUDED.last_uid, updated_at=NOW();
+            """,
+            (_mailbox_key(), uidvalidity, last_uid),
+        )
+        cx.commit()
+
+
+def _uidvalidity(imap: imaplib.IMAP4) -> int:
+    status, data = imap.status(IMAP_FOLDER, "(UIDVALIDITY)")
+    m = re.search(rb"UIDVALIDITY (\d+)", data[0] or b"") if status == "OK" else None
+    if not m:
+        raise imaplib.IMAP4.error("El servidor no devolvió UIDVALIDITY")
+    return int(m.group(1))
+
+
+# ---------------- Respuestas FETCH ----------------
+
+_TOKEN_RE = re.compile(
+    rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    rb"|(?P<literal>\{\d+\}$)|(?P<atom>(?:[^\s()\[\"]|\[[^\]]*\])+))"
+)
+
+
+def _tokenize(data: list) -> list:
+    """
+    Aplana la respuesta de imaplib (bytes y tuplas (cabecera, literal)) en tokens:
+    "(" / ")" / str / bytes (literales) / None (NIL).
+    """
+    tokens: list = []
+
+    def _scan(chunk: bytes) -> None:
+        pos = 0
+        chunk = chunk.rstrip()
+        while pos < len(chunk):
+            m = _TOKEN_RE.match(chunk, pos)
+            if not m or m.end() == pos:
+                raise ValueError(f"Respuesta FETCH no reconocida: {chunk[pos:pos + 40]!r}")
+            pos = m.end()
+            if m.group("open"):
+                tokens.append("(")
+            elif m.group("close"):
+                tokens.append(")")
+            elif m.group("quoted") is not None:
+                tokens.append(re.sub(rb"\\(.)", rb"\1", m.group("quoted")).decode("utf-8", errors="replace"))
+            elif m.group("literal"):
+                pass  # el contenido llega como segundo elemento de la tupla
+            else:
+                atom = m.group("atom").decode("ascii", errors="replace")
+                tokens.append(None if atom.upper() == "NIL" else atom)
+
+    for item in data:
+        if isinstance(item, tuple):
+            _scan(item[0])
+            tokens.append(item[1])
+        elif item:
+            _scan(item)
+    return tokens
+
+
+def _parse_fetch(data: list) -> dict:
+    """Respuesta de UID FETCH → {uid: {"BODYSTRUCTURE": [...], "BODY[...]": bytes, ...}}."""
+    tokens = _tokenize(data)
+    pos = 0
+
+    def _list() -> list:
+        nonlocal pos
+        out: list = []
+        pos += 1  # "("
+        while tokens[pos] != ")":
+            if tokens[pos] == "(":
+                out.append(_list())
+            else:
+                out.append(tokens[pos])
+                pos += 1
+        pos += 1
+        return out
+
+    result: dict = {}
+    while pos < len(tokens):
+        pos += 1  # nº de secuencia
+        items = _list()
+        fields = {str(items[i]).upper(): items[i + 1] for i in range(0, len(items) - 1, 2)}
+        uid = fields.get("UID")
+        if uid is not None:
+            result[int(uid)] = fields
+    return result
+
+
+def _text_section(bs, prefix: str = "") -> tuple | None:
+    """
+    Recorre BODYSTRUCTURE y devuelve (sección, subtipo, encoding, charset) de la
+    primera parte text/plain (o text/html si no hay) que no sea adjunto.
+    """
+    plain = html = None
+    stack = [(bs, prefix)]
+    while stack:
+        node, path = stack.pop(0)
+        if node and isinstance(node[0], list):  # multipart
+            for idx, child in enumerate(node, start=1):
+                if not isinstance(child, list):
+                    break  # tras las partes viene el subtipo (MIXED, ALTERNATIVE…)
+                stack.append((child, f"{path}{idx}."))
+            continue
+        if len(node) < 7 or not isinstance(node[0], str):
+            continue
+        ctype, subtype = (node[0] or "").lower(), (node[1] or "").lower()
+        if ctype != "text" or subtype not in ("plain", "html"):
+            continue
+        if any(isinstance(x, list) and x and str(x[0]).lower() == "attachment" for x in node[7:]):
+            continue
+        params = node[2] if isinstance(node[2], list) else []
+        charset = next(
+            (params[i + 1] for i in range(0, len(params) - 1, 2) if str(params[i]).lower() == "charset"),
+            None,
+        )
+        section = (path or "1.").rstrip(".")
+        found = (section, subtype, (node[5] or "7bit").lower(), charset)
+        if subtype == "plain" and plain is None:
+            plain = found
+        elif subtype == "html" and html is None:
+            html = found
+    return plain or html
+
+
+def _decode_section(raw: bytes, encoding: str, charset: str | None) -> str:
+    """Decodifica una parte (posiblemente truncada a IMAP_BODY_MAX_BYTES)."""
+    if encoding == "base64":
+        compact = re.sub(rb"[^A-Za-z0-9+/=]", b"", raw)
+        raw = base64.b64decode(compact[: len(compact) // 4 * 4] or b"")
+    elif encoding == "quoted-printable":
+        raw = quopri.decodestring(raw)
+    try:
+        return raw.decode(charset or "utf-8", errors="ignore")
+    except LookupError:
+        return raw.decode("utf-8", errors="ignore")
+
+
+def _fetch_batch(imap: imaplib.IMAP4, uids: list[int]) -> list[tuple]:
+    """
+    Dos round-trips por lote: cabeceras + BODYSTRUCTURE, y luego solo la parte de
+    texto de cada mensaje (BODY.PEEK, truncada). Los adjuntos no se descargan.
+    Devuelve [(uid, from, subject, message_id, texto)] en orden de UID.
+    """
+    uid_set = ",".join(str(u) for u in uids)
+    status, data = imap.uid(
+        "FETCH", uid_set, f"(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])"
+    )
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"UID FETCH de cabeceras falló: {data!r}")
+    meta = _parse_fetch(data)
+
+    sections: dict[str, list[int]] = {}
+    parts: dict[int, tuple] = {}
+    for uid, fields in meta.items():
+        part = _text_section(fields.get("BODYSTRUCTURE") or [])
+        if part:
+            parts[uid] = part
+            sections.setdefault(part[0], []).append(uid)
+
+    bodies: dict[int, str] = {}
+    for section, group in sections.items():
+        status, data = imap.uid(
+            "FETCH",
+            ",".join(str(u) for u in group),
+            f"(UID BODY.PEEK[{section}]<0.{IMAP_BODY_MAX_BYTES}>)",
+        )
         if status != "OK":
-            print(f"[EmailListener] No se pudo leer el mensaje {num!r}")
             continue
+        for uid, fields in _parse_fetch(data).items():
+            raw = next((v for k, v in fields.items() if k.startswith("BODY[")), None) or b""
+            if isinstance(raw, str):
+                raw = raw.encode("utf-8")
+            _, subtype, encoding, charset = parts[uid]
+            text = _decode_section(raw, encoding, charset)
+            if subtype == "html":
+                text = text.replace("<br>", "\n").replace("<br/>", "\n").replace("<br />", "\n")
+            bodies[uid] = text
+
+    out = []
+    for uid in sorted(meta):
+        header = next((v for k, v in meta[uid].items() if k.startswith("BODY[HEADER")), None) or b""
+        if isinstance(header, str):
+            header = header.encode("utf-8")
+        msg = email.message_from_bytes(header)
+        out.append((uid, msg.get("From", ""), msg.get("Subject", ""), msg.get("Message-ID", ""), bodies.get(uid, "")))
+    return out
+
+
+def _new_uids(imap: imaplib.IMAP4) -> tuple[int, list[int]]:
+    """UIDs pendientes: por encima del checkpoint o, sin checkpoint válido, los UNSEEN."""
+    uidvalidity = _uidvalidity(imap)
+    checkpoint = _load_checkpoint()
+    if checkpoint and checkpoint[0] == uidvalidity:
+        last_uid = checkpoint[1]
+        status, data = imap.uid("SEARCH", None, f"UID {last_uid + 1}:* UNSEEN")
+    else:
+        if checkpoint:
+            print("[EmailListener] UIDVALIDITY cambió; se reinicia el checkpoint.")
+        last_uid = 0
+        status, data = imap.uid("SEARCH", None, "UNSEEN")
+    if status != "OK":
+        raise imaplib.IMAP4.error("No se pudieron buscar mensajes nuevos")
+    # "n:*" siempre incluye el último mensaje aunque su UID sea menor que n
+    return uidvalidity, sorted(u for u in map(int, (data[0] or b"").split()) if u > last_uid)
+
+
+# ---------------- Tubería: lectura → workers → flags ----------------
+
+def _handle_message(uidvalidity: int, uid: int, from_header: str, subject_header: str,
+                    message_id: str, body_text: str) -> str:
+    """
+    Clasifica y encola la respuesta. El Message-ID se reserva en la misma
+    transacción que el correo de salida: o quedan las dos cosas o ninguna.
+    """
+    try:
+        reply = _build_reply(from_header, subject_header, body_text)
+    except Exception as e:
+        # Correo que no podemos tratar (remitente inválido…): no se reintenta
+        print(f"[EmailListener] Mensaje UID {uid} descartado: {e}")
+        return "invalid"
+    if reply is None:
+        return "skipped"
+    to_email, to_name, subject, html, kind, confidence = reply
+
+    key = (message_id or "").strip() or f"<uid-{uidvalidity}-{uid}@{_mailbox_key()}>"
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO email_listener_replies (message_id, mailbox, uid, from_email, kind, confidence)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (message_id) DO NOTHING
+            RETURNING message_id;
+            """,
+            (key[:998], _mailbox_key(), uid, to_email, kind, confidence),
+        )
+        if cur.fetchone() is None:
+            return "duplicate"
+        email_outbox.enqueue(cur, to_email, subject, html, to_name, source="email_listener")
+        cx.commit()
+    print(f"[EmailListener] Respuesta encolada a {to_email} (tipo={kind}, conf={confidence:.2f})")
+    return "replied"
 
-        raw_email = msg_data[0][1]
-        msg = email.message_from_bytes(raw_email)
 
-        from_header = msg.get("From", "")
-        from_name, from_email = parseaddr(from_header)
-        from_name = from_name or from_email or "Amigo/a"
+def _worker(work: "queue.Queue", done: "queue.Queue", uidvalidity: int, stats: dict, lock: threading.Lock) -> None:
+    while True:
+        item = work.get()
+        if item is None:
+            return
+        uid = item[0]
+        try:
+            result = _handle_message(uidvalidity, *item)
+        except Exception as e:
+            # Fallo transitorio (BD…): sin flag ni checkpoint, se reintenta en el siguiente ciclo
+            print(f"[EmailListener] Error procesando mensaje UID {uid}: {e}")
+            result = "failed"
+        else:
+            done.put(uid)
+        with lock:
+            stats[result] = stats.get(result, 0) + 1
 
-        # Evitar bucles: si el remitente somos nosotros mismos, saltar
-        if not from_email or from_email.lower().endswith("@mediazion.eu"):
-            imap.store(num, "+FLAGS", "\\Seen")
-            continue
 
-        subject_header = msg.get("Subject", "")
-        subject = _decode_header_value(subject_header) or "(sin asunto)"
+class _Progress:
+    """El checkpoint solo avanza hasta el mayor UID con todos los anteriores terminados."""
 
-        body_text = _get_body_from_message(msg)
-        if not body_text.strip():
-            body_text = "(sin contenido)"
+    def __init__(self, uids: list[int]):
+        self.pending = list(uids)
+        self.done: set = set()
+        self.pos = 0
 
-        print(f"[EmailListener] Procesando correo de {from_email}, asunto={subject!r}")
+    def mark(self, uids: list[int]) -> int | None:
+        self.done.update(uids)
+        last = None
+        while self.pos < len(self.pending) and self.pending[self.pos] in self.done:
+            last = self.pending[self.pos]
+            self.pos += 1
+        return last
 
-        # Crear un ContactIn "falso" con el contenido del correo
-        contact = ContactIn(
-            name=from_name,
-            email=from_email,
-            subject=subject,
-            message=body_text,
-            accept=True,  # nos ha escrito voluntariamente
-        )
 
+def _flush_flags(imap: imaplib.IMAP4, done: "queue.Queue", progress: _Progress, uidvalidity: int) -> None:
+    uids = []
+    while True:
         try:
-            kind, confidence = classify_contact(contact)
-            auto_reply_text = build_auto_reply(contact, kind)
+            uids.append(done.get_nowait())
+        except queue.Empty:
+            break
+    if not uids:
+        return
+    imap.uid("STORE", ",".join(str(u) for u in sorted(uids)), "+FLAGS.SILENT", "(\\Seen)")
+    last = progress.mark(uids)
+    if last is not None:
+        _save_checkpoint(uidvalidity, last)
 
-            # Alta prioridad: cliente y confianza alta
-            is_high_priority = (kind == "cliente" and confidence >= MIN_CONFIDENCE)
 
-            # Envolvemos en HTML sencillo (igual que en contact_routes)
-            user_html = f"""
-            <div style="font-family:system-ui,Segoe UI,Roboto,Arial; white-space:pre-wrap">
-            {auto_reply_text}
-            </div>
-            """
+def _process_unseen(imap: imaplib.IMAP4) -> None:
+    uidvalidity, uids = _new_uids(imap)
+    if not uids:
+        print("[EmailListener] No hay mensajes nuevos (UNSEEN).")
+        return
 
-            reply_subject = subject
-            if is_high_priority and PRIORITY_SUBJECT_PREFIX:
-                if not subject.startswith(PRIORITY_SUBJECT_PREFIX):
-                    reply_subject = f"{PRIORITY_SUBJECT_PREFIX}{subject}"
+    print(f"[EmailListener] Encontrados {len(uids)} mensajes nuevos. Procesando…")
+
+    t0 = time.perf_counter()
+    work: "queue.Queue" = queue.Queue(maxsize=LISTENER_QUEUE_MAX)
+    done: "queue.Queue" = queue.Queue()
+    stats: dict = {}
+    lock = threading.Lock()
+    progress = _Progress(uids)
+    workers = [
+        threading.Thread(target=_worker, args=(work, done, uidvalidity, stats, lock), name=f"listener-{i}", daemon=True)
+        for i in range(max(1, LISTENER_WORKERS))
+    ]
+    for t in workers:
+        t.start()
+
+    try:
+        for i in range(0, len(uids), IMAP_FETCH_BATCH):
+            batch = uids[i:i + IMAP_FETCH_BATCH]
+            fetched = _fetch_batch(imap, batch)
+            for item in fetched:
+                work.put(item)  # se bloquea si los workers van por detrás
+            # UIDs que desaparecieron entre SEARCH y FETCH (borrados): nada que hacer
+            gone = set(batch) - {item[0] for item in fetched}
+            for uid in gone:
+                done.put(uid)
+            # lo que ya terminaron los workers mientras leíamos este lote
+            _flush_flags(imap, done, progress, uidvalidity)
+    finally:
+        for _ in workers:
+            work.put(None)
+        for t in workers:
+            t.join()
+    _flush_flags(imap, done, progress, uidvalidity)
+
+    elapsed = time.perf_counter() - t0
+    summary = ", ".join(f"{k}={v}" for k, v in sorted(stats.items()))
+    print(
+        f"[EmailListener] {len(uids)} mensajes en {elapsed:.1f}s "
+        f"({len(uids) / elapsed:.1f} msg/s, {LISTENER_WORKERS} workers) · {summary}"
+    )
 
-            # Enviar respuesta automática al remitente
-            try:
-                _send_mail(
-                    from_email,
-                    reply_subject,
-                    user_html,
-                    from_name,
-                )
-                print(
-                    f"[EmailListener] Respuesta enviada a {from_email} "
-                    f"(tipo={kind}, conf={confidence:.2f}, alta={is_high_priority})"
-                )
-            except Exception as e:
-                print(f"[EmailListener] Error enviando respuesta a {from_email}: {e}")
-
-            # Marcar como visto para no reprocesarlo
-            imap.store(num, "+FLAGS", "\\Seen")
 
+# ---------------- Modo IDLE (conexión persistente) ----------------
+
+def _supports_idle(imap: imaplib.IMAP4) -> bool:
+    return "IDLE" in getattr(imap, "capabilities", ())
+
+
+def _idle_wait(imap: imaplib.IMAP4, timeout: float) -> bool:
+    """
+    IDLE (RFC 2177) hasta que llegue correo o pase `timeout`.
+    Devuelve True si el servidor avisó de mensajes nuevos (EXISTS/RECENT).
+    imaplib no implementa IDLE: se habla el protocolo a mano leyendo del socket
+    con select (el fichero de imaplib queda inservible tras un timeout).
+    """
+    sock = imap.socket()
+    buf = b""
+
+    def _readline(deadline: float | None) -> bytes | None:
+        nonlocal buf
+        while b"\r\n" not in buf:
+            pending = sock.pending() if hasattr(sock, "pending") else 0
+            if not pending:
+                wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+                ready, _, _ = select.select([sock], [], [], wait)
+                if not ready:
+                    return None
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise imaplib.IMAP4.abort("Conexión cerrada durante IDLE")
+            buf += chunk
+        line, buf = buf.split(b"\r\n", 1)
+        return line
+
+    tag = imap._new_tag()
+    imap.send(tag + b" IDLE\r\n")
+    line = _readline(time.monotonic() + 30)
+    if line is None or not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rechazado: {line!r}")
+
+    deadline = time.monotonic() + timeout
+    new_mail = False
+    while not new_mail:
+        line = _readline(deadline)
+        if line is None:
+            break
+        upper = line.upper()
+        if upper.startswith(b"* BYE"):
+            raise imaplib.IMAP4.abort(line.decode(errors="ignore"))
+        if upper.startswith(b"* ") and upper.endswith((b" EXISTS", b" RECENT")):
+            new_mail = True
+
+    # Salir de IDLE y consumir hasta la respuesta etiquetada
+    imap.send(b"DONE\r\n")
+    while True:
+        line = _readline(time.monotonic() + 30)
+        if line is None:
+            raise imaplib.IMAP4.abort("Sin respuesta al salir de IDLE")
+        if line.startswith(tag + b" "):
+            if not line[len(tag) + 1:].upper().startswith(b"OK"):
+                raise imaplib.IMAP4.error(f"IDLE terminó mal: {line!r}")
+            break
+    return new_mail
+
+
+def idle_loop() -> None:
+    """
+    Conexión persistente con IDLE: procesa al momento lo que llega y renueva el IDLE
+    cada IDLE_REFRESH. Si la conexión cae, reconecta con espera creciente; si el
+    servidor no soporta IDLE, pasa a polling.
+    """
+    delay = 1
+    while True:
+        imap = None
+        try:
+            imap = _connect()
+            if not _supports_idle(imap):
+                print("[EmailListener] El servidor no soporta IDLE; uso polling.")
+                try:
+                    imap.logout()
+                except Exception:
+                    pass
+                poll_loop()
+                return
+
+            print("[EmailListener] Modo IDLE activo.")
+            _process_unseen(imap)  # lo que llegó mientras estábamos desconectados
+            delay = 1
+            while True:
+                if _idle_wait(imap, IDLE_REFRESH):
+                    _process_unseen(imap)
+                else:
+                    # keepalive: el IDLE se renueva y se comprueba la conexión
+                    imap.noop()
+        except (imaplib.IMAP4.abort, OSError) as e:
+            print(f"[EmailListener] Conexión IMAP perdida ({e}); reconectando en {delay}s…")
         except Exception as e:
-            print(f"[EmailListener] Error procesando mensaje {num!r}: {e}")
-            imap.store(num, "+FLAGS", "\\Seen")
-
-    imap.logout()
-    print("[EmailListener] Ciclo completado.")
+            print(f"[EmailListener] Error en modo IDLE: {e}; reconectando en {delay}s…")
+        finally:
+            if imap is not None:
+                try:
+                    imap.logout()
+                except Exception:
+                    pass
+        time.sleep(delay)
+        delay = min(RECONNECT_MAX_DELAY, delay * 2)
 
 
-def main_loop() -> None:
-    print("[EmailListener] Iniciando bucle de escucha IMAP…")
+def poll_loop() -> None:
     while True:
         try:
             process_unseen_messages()
@@ -215,5 +736,85 @@ def main_loop() -> None:
         time.sleep(CHECK_INTERVAL)
 
 
+def main_loop() -> None:
+    print("[EmailListener] Iniciando bucle de escucha IMAP…")
+    if not _imap_configured():
+        print("[EmailListener] IMAP no configurado (IMAP_HOST/USER/PASS). Saliendo.")
+        return
+    if IMAP_MODE == "poll":
+        poll_loop()
+    else:
+        idle_loop()
+
+
+# ---------------- Benchmark ----------------
+
+def seed_mailbox(folder: str, n: int, attachment_kb: int = 200) -> None:
+    """Rellena `folder` con n correos de prueba (texto + adjunto) para el benchmark."""
+    from email.message import EmailMessage
+
+    imap = _connect()
+    imap.create(folder)
+    blob = os.urandom(attachment_kb * 1024)
+    for i in range(n):
+        msg = EmailMessage()
+        msg["From"] = f"Cliente {i} <cliente{i}@example.test>"
+        msg["To"] = IMAP_USER
+        msg["Subject"] = f"Consulta {i}: conflicto con un vecino"
+        msg["Message-ID"] = f"<bench-{i}@example.test>"
+        msg.set_content("Hola, tengo un problema con mi vecino y quería información sobre mediación.\n" * 5)
+        msg.add_attachment(blob, maintype="application", subtype="pdf", filename=f"doc{i}.pdf")
+        imap.append(folder, None, None, msg.as_bytes())
+    imap.logout()
+
+
+def bench_fetch(folder: str, limit: int) -> None:
+    """
+    Compara, en solo lectura y sin responder, el bucle antiguo (un FETCH del mensaje
+    completo por correo) con el lote por UID que solo baja cabeceras y texto.
+    """
+    imap = _connect()
+    imap.select(folder, readonly=True)
+    status, data = imap.uid("SEARCH", None, "ALL")
+    uids = [int(u) for u in (data[0] or b"").split()][:limit]
+    print(f"{len(uids)} mensajes en {folder}")
+
+    t0 = time.perf_counter()
+    legacy_bytes = 0
+    for uid in uids:
+        status, msg_data = imap.uid("FETCH", str(uid), "(BODY.PEEK[])")
+        raw = msg_data[0][1]
+        legacy_bytes += len(raw)
+        _get_body_from_message(email.message_from_bytes(raw))
+    legacy = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    batched_bytes = 0
+    for i in range(0, len(uids), IMAP_FETCH_BATCH):
+        for _uid, from_header, subject, _mid, body in _fetch_batch(imap, uids[i:i + IMAP_FETCH_BATCH]):
+            batched_bytes += len(from_header) + len(subject) + len(body)
+    batched = time.perf_counter() - t0
+    imap.logout()
+
+    n = max(1, len(uids))
+    print(f"antes:  {legacy:.1f}s  {n / legacy:.0f} msg/s  {legacy_bytes / 1e6:.1f} MB  {len(uids)} FETCH")
+    print(
+        f"ahora:  {batched:.1f}s  {n / batched:.0f} msg/s  ~{batched_bytes / 1e6:.1f} MB de texto  "
+        f"lotes de {IMAP_FETCH_BATCH}"
+    )
+
+
 if __name__ == "__main__":
-    main_loop()
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Auto-respuestas del buzón info@ por IMAP")
+    ap.add_argument("--seed", type=int, help="añadir N correos de prueba a --folder")
+    ap.add_argument("--bench", type=int, help="comparar la lectura de N correos de --folder (solo lectura)")
+    ap.add_argument("--folder", default="MediazionBench")
+    args = ap.parse_args()
+    if args.seed:
+        seed_mailbox(args.folder, args.seed)
+    if args.bench:
+        bench_fetch(args.folder, args.bench)
+    if not (args.seed or args.bench):
+        main_loop()
@@ -0,0 +1,338 @@
+# email_outbox.py — Bandeja de salida persistente para todo el correo saliente
+# ---------------------------------------------------------------
+# - Los módulos insertan el correo en email_outbox DENTRO de su propia transacción
+#   (enqueue(cur, ...)): si la operación se deshace, el correo tampoco sale.
+# - Un worker (proceso aparte: `python email_outbox.py`) reclama lotes con
+#   FOR UPDATE SKIP LOCKED, los envía por una conexión SMTP reutilizada
+#   (pool de contact_routes) y reintenta con backoff exponencial.
+# - Si no se despliega ese worker, la propia app vacía la bandeja en segundo
+#   plano (OUTBOX_IN_APP=1, por defecto). Con worker dedicado, OUTBOX_IN_APP=0.
+#   Los dos a la vez tampoco duplican envíos (SKIP LOCKED).
+# - Tras OUTBOX_MAX_ATTEMPTS fallos el mensaje queda en 'dead' y se ve en
+#   /api/admin/outbox/dead, desde donde se puede reencolar.
+# - Una vez enviado se borra el cuerpo (puede contener contraseñas temporales).
+#   Los 'dead' lo conservan para poder reencolarlos.
+#
+# Medida de throughput con un SMTP local (aiosmtpd):
+#   python email_outbox.py --bench 10000
+
+import argparse
+import asyncio
+import os
+import random
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, Query
+
+from admin_auth import require_admin
+from db import pg_conn
+
+OUTBOX_BATCH         = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_MAX_ATTEMPTS  = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE  = int(os.getenv("OUTBOX_BACKOFF_BASE", "30"))      # s tras el 1er fallo
+OUTBOX_BACKOFF_MAX   = int(os.getenv("OUTBOX_BACKOFF_MAX", "21600"))    # 6 h
+OUTBOX_IDLE_SECONDS  = float(os.getenv("OUTBOX_IDLE_SECONDS", "2"))
+OUTBOX_STUCK_SECONDS = int(os.getenv("OUTBOX_STUCK_SECONDS", "600"))
+OUTBOX_IN_APP        = os.getenv("OUTBOX_IN_APP", "1").strip().lower() not in ("0", "false", "no")
+
+SQL_OUTBOX = """
+CREATE TABLE IF NOT EXISTS email_outbox (
+  id              BIGSERIAL PRIMARY KEY,
+  to_email        TEXT NOT NULL,
+  to_name         TEXT,
+  subject         TEXT NOT NULL,
+  html            TEXT,
+  status          TEXT NOT NULL DEFAULT 'pending',   -- pending | sending | sent | dead
+  attempts        INTEGER NOT NULL DEFAULT 0,
+  next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+  claimed_at      TIMESTAMP NULL,
+  last_error      TEXT,
+  source          TEXT,
+  created_at      TIMESTAMP DEFAULT NOW(),
+  sent_at         TIMESTAMP NULL
+);
+CREATE INDEX IF NOT EXISTS email_outbox_pending_idx ON email_outbox (next_attempt_at, id) WHERE status='pending';
+CREATE INDEX IF NOT EXISTS email_outbox_dead_idx ON email_outbox (id) WHERE status='dead';
+"""
+
+_table_ready = False
+
+
+def ensure_table() -> None:
+    # En su propia conexión: si la transacción del llamante se deshace, la tabla
+    # queda creada igual y _table_ready no miente.
+    global _table_ready
+    if _table_ready:
+        return
+    with pg_conn() as cx:
+        with cx.cursor() as cur:
+            cur.execute(SQL_OUTBOX)
+        cx.commit()
+    _table_ready = True
+
+
+def enqueue(cur, to_email: str, subject: str, html: str, to_name: str = "", source: str = "") -> None:
+    """Añade un correo a la bandeja usando el cursor (y la transacción) del llamante."""
+    ensure_table()
+    cur.execute(
+        """
+        INSERT INTO email_outbox (to_email, to_name, subject, html, source)
+        VALUES (%s, %s, %s, %s, %s);
+        """,
+        (to_email, to_name or "", subject, html, source or None),
+    )
+
+
+def enqueue_now(to_email: str, subject: str, html: str, to_name: str = "", source: str = "") -> None:
+    """Para llamantes sin transacción propia."""
+    with pg_conn() as cx, cx.cursor() as cur:
+        enqueue(cur, to_email, subject, html, to_name, source)
+        cx.commit()
+
+
+# ---------------- Worker ----------------
+
+def _backoff(attempts: int) -> int:
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** max(0, attempts - 1))
+    return int(delay * random.uniform(0.8, 1.2))  # jitter: no reintentar todos a la vez
+
+
+def _claim_batch(limit: int) -> list:
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE email_outbox
+               SET status='sending', claimed_at=NOW(), attempts=attempts+1
+             WHERE id IN (
+                   SELECT id FROM email_outbox
+                    WHERE status='pending' AND next_attempt_at <= NOW()
+                    ORDER BY next_attempt_at, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+             )
+            RETURNING id, to_email, to_name, subject, html, attempts;
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall()
+        cx.commit()
+    return rows
+
+
+def _release_stuck() -> None:
+    """Mensajes 'sending' de un worker que murió a mitad → vuelven a pending."""
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE email_outbox SET status='pending', claimed_at=NULL
+             WHERE status='sending' AND claimed_at < NOW() - (%s * INTERVAL '1 second');
+            """,
+            (OUTBOX_STUCK_SECONDS,),
+        )
+        cx.commit()
+
+
+def process_batch(limit: int = OUTBOX_BATCH) -> int:
+    """Envía un lote. Devuelve cuántos mensajes se reclamaron."""
+    from contact_routes import _build_message, _mailer
+
+    rows = _claim_batch(limit)
+    if not rows:
+        return 0
+
+    sent, retry, dead = [], [], []
+    for msg_id, to_email, to_name, subject, html, attempts in rows:
+        try:
+            rcpt, data = _build_message(to_email, subject, html or "", to_name or "")
+            _mailer.send_now(rcpt, data)  # misma conexión del pool para todo el lote
+            sent.append((msg_id,))
+        except Exception as e:
+            err = str(e)[:500]
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                dead.append((err, msg_id))
+            else:
+                retry.append((_backoff(attempts), err, msg_id))
+
+    with pg_conn() as cx, cx.cursor() as cur:
+        if sent:
+            cur.executemany(
+                "UPDATE email_outbox SET status='sent', sent_at=NOW(), html=NULL, last_error=NULL WHERE id=%s;",
+                sent,
+            )
+        if retry:
+            cur.executemany(
+                """
+                UPDATE email_outbox
+                   SET status='pending', next_attempt_at=NOW() + (%s * INTERVAL '1 second'), last_error=%s
+                 WHERE id=%s;
+                """,
+                retry,
+            )
+        if dead:
+            cur.executemany("UPDATE email_outbox SET status='dead', last_error=%s WHERE id=%s;", dead)
+        cx.commit()
+    return len(rows)
+
+
+def run_worker(stop_when_empty: bool = False) -> None:
+    ensure_table()
+    last_sweep = 0.0
+    print("[Outbox] Worker iniciado")
+    while True:
+        try:
+            if time.monotonic() - last_sweep > 60:
+                _release_stuck()
+                last_sweep = time.monotonic()
+            n = process_batch()
+        except Exception as e:
+            print(f"[Outbox] Error procesando lote: {e}")
+            n = 0
+        if not n:
+            if stop_when_empty:
+                return
+            time.sleep(OUTBOX_IDLE_SECONDS)
+
+
+# ---------------- Vaciado dentro de la app ----------------
+
+outbox_router = APIRouter(prefix="/outbox", tags=["admin"])
+
+_drainer: Optional[asyncio.Task] = None
+
+
+async def _drain_loop():
+    last_sweep = 0.0
+    while True:
+        n = 0
+        try:
+            if time.monotonic() - last_sweep > 60:
+                await asyncio.to_thread(_release_stuck)
+                last_sweep = time.monotonic()
+            n = await asyncio.to_thread(process_batch)
+        except Exception as e:
+            print(f"[Outbox] Error procesando lote: {e}")
+        if not n:
+            await asyncio.sleep(OUTBOX_IDLE_SECONDS)
+
+
+@outbox_router.on_event("startup")
+async def _start_drainer():
+    global _drainer
+    if OUTBOX_IN_APP:
+        _drainer = asyncio.create_task(_drain_loop())
+
+
+@outbox_router.on_event("shutdown")
+def _stop_drainer():
+    if _drainer:
+        _drainer.cancel()
+
+
+# ---------------- Admin ----------------
+
+
+@outbox_router.get("/stats")
+def outbox_stats(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    ensure_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status;")
+        counts = {r[0]: r[1] for r in cur.fetchall()}
+        cur.execute(
+            "SELECT EXTRACT(EPOCH FROM NOW() - MIN(created_at)) FROM email_outbox WHERE status='pending';"
+        )
+        oldest = cur.fetchone()[0]
+    return {"ok": True, "counts": counts, "oldest_pending_seconds": int(oldest) if oldest else 0}
+
+
+@outbox_router.get("/dead")
+def outbox_dead(
+    x_admin_token: Optional[str] = Header(None),
+    before_id: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+):
+    """Mensajes que agotaron los reintentos (más recientes primero)."""
+    require_admin(x_admin_token)
+    ensure_table()
+    sql = """
+        SELECT id, to_email, subject, attempts, last_error, source, created_at
+          FROM email_outbox
+         WHERE status='dead'
+    """
+    params: list = []
+    if before_id:
+        sql += " AND id < %s"
+        params.append(before_id)
+    sql += " ORDER BY id DESC LIMIT %s;"
+    params.append(limit)
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(sql, tuple(params))
+        rows = cur.fetchall()
+    items = [
+        {
+            "id": r[0],
+            "to_email": r[1],
+            "subject": r[2],
+            "attempts": r[3],
+            "last_error": r[4],
+            "source": r[5],
+            "created_at": r[6].isoformat() if r[6] else None,
+        }
+        for r in rows
+    ]
+    return {"ok": True, "items": items, "next_before_id": items[-1]["id"] if len(items) == limit else None}
+
+
+@outbox_router.post("/{msg_id}/retry")
+def outbox_retry(msg_id: int, x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    ensure_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "SELECT html IS NOT NULL FROM email_outbox WHERE id=%s AND status='dead' FOR UPDATE;",
+            (msg_id,),
+        )
+        row = cur.fetchone()
+        if not row:
+            raise HTTPException(404, "Mensaje no encontrado o no está en dead")
+        if not row[0]:
+            # sin cuerpo saldría un correo en blanco
+            raise HTTPException(409, "El mensaje ya no tiene cuerpo; no se puede reenviar")
+        cur.execute(
+            """
+            UPDATE email_outbox
+               SET status='pending', attempts=0, next_attempt_at=NOW(), last_error=NULL
+             WHERE id=%s;
+            """,
+            (msg_id,),
+        )
+        cx.commit()
+    return {"ok": True, "id": msg_id, "status": "pending"}
+
+
+# ---------------- CLI ----------------
+
+def bench(n: int) -> None:
+    """Encola n mensajes de prueba y mide cuánto tarda el worker en vaciarlos."""
+    ensure_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.executemany(
+            "INSERT INTO email_outbox (to_email, subject, html, source) VALUES (%s, %s, %s, 'bench');",
+            [(f"bench{i}@example.test", f"Bench {i}", "<p>prueba</p>") for i in range(n)],
+        )
+        cx.commit()
+    t0 = time.perf_counter()
+    run_worker(stop_when_empty=True)
+    elapsed = time.perf_counter() - t0
+    print(f"{n} mensajes en {elapsed:.1f}s → {n / elapsed:.0f} msg/s")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Worker de la bandeja de salida de correo")
+    ap.add_argument("--bench", type=int, help="encolar N mensajes de prueba y medir el vaciado")
+    args = ap.parse_args()
+    if args.bench:
+        bench(args.bench)
+    else:
+        run_worker()
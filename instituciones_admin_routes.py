@@ -8,7 +8,8 @@ from fastapi import APIRouter, Header, HTTPException
 from pydantic import BaseModel
 
 from db import pg_conn
-from contact_routes import _send_mail, MAIL_FROM_NAME, MAIL_FROM
+from contact_routes import MAIL_FROM_NAME, MAIL_FROM
+import email_outbox
 
 # Usamos el mismo patrón de token admin que el resto de módulos,
 # pero _auth está desactivado para uso desde el panel web.
@@ -264,10 +265,8 @@ def crear_usuario_desde_solicitud(
             (body.solicitud_id,),
         )
 
-        cx.commit()
-
-    # 6) Enviar correo a la institución con la contraseña temporal
-    try:
+        # 6) Correo a la institución con la contraseña temporal (bandeja de salida,
+        #    en la misma transacción: si la aprobación falla, no sale)
         asunto = "Mediazion · Acceso institucional"
         html = f"""
         <div style="font-family:system-ui,Segoe UI,Roboto,Arial; white-space:pre-wrap">
@@ -289,15 +288,9 @@ Un saludo,
 {MAIL_FROM}
         </div>
         """
-        _send_mail(
-            solicitud["email"],
-            asunto,
-            html,
-            solicitud["nombre"],
-        )
-    except Exception as e:
-        # No rompemos el flujo si el email falla
-        print(f"[AVISO] Error enviando correo a usuario institucional: {e}")
+        email_outbox.enqueue(cur, solicitud["email"], asunto, html, solicitud["nombre"], source="instituciones")
+
+        cx.commit()
 
     return {
         "ok": True,
@@ -406,10 +399,8 @@ def crear_usuario_directo(
                 body.creado_por,
             ),
         )
-        cx.commit()
 
-    # Enviar correo con credenciales
-    try:
+        # Correo con credenciales (bandeja de salida, misma transacción)
         asunto = "Mediazion · Acceso institucional"
         html = f"""
         <div style="font-family:system-ui,Segoe UI,Roboto,Arial; white-space:pre-wrap">
@@ -430,9 +421,8 @@ Un saludo,
 {MAIL_FROM}
         </div>
         """
-        _send_mail(body.email, asunto, html, body.nombre)
-    except Exception as e:
-        print(f"[AVISO] Error enviando correo a institución: {e}")
+        email_outbox.enqueue(cur, body.email, asunto, html, body.nombre, source="instituciones")
+        cx.commit()
 
     return {
         "ok": True,
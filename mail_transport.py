@@ -0,0 +1,198 @@
+# mail_transport.py — Envío SMTP con conexiones reutilizadas y cola en proceso
+# ---------------------------------------------------------------
+# - Pool pequeño de conexiones SMTP ya autenticadas (TLS + login una sola vez).
+# - Antes de reutilizar una conexión ociosa se comprueba con NOOP; si falla, se
+#   reconecta. Las conexiones se renuevan por antigüedad y nº de mensajes.
+# - enqueue() deja el mensaje en una cola en memoria y vuelve al momento; unos
+#   pocos hilos emisores la vacían usando el pool.
+#
+# Genérico: el módulo no sabe de configuración. contact_routes crea el Mailer con
+# su función de conexión (host/puerto/TLS/login).
+#
+# Prueba local sin servidor real:
+#   python -m aiosmtpd -n -l 127.0.0.1:1025      (SMTP_HOST=127.0.0.1 SMTP_PORT=1025 SMTP_TLS=false)
+
+import os
+import queue
+import smtplib
+import threading
+import time
+from typing import Callable, List, Optional
+
+SMTP_POOL_SIZE      = int(os.getenv("SMTP_POOL_SIZE", "2"))
+SMTP_SENDER_THREADS = int(os.getenv("SMTP_SENDER_THREADS", "2"))
+SMTP_QUEUE_MAX      = int(os.getenv("SMTP_QUEUE_MAX", "1000"))
+SMTP_NOOP_AFTER     = float(os.getenv("SMTP_NOOP_AFTER", "10"))     # s ociosa antes de comprobar
+SMTP_MAX_AGE        = float(os.getenv("SMTP_MAX_AGE", "300"))       # s de vida de una conexión
+SMTP_MAX_MESSAGES   = int(os.getenv("SMTP_MAX_MESSAGES", "100"))    # mensajes por conexión
+SMTP_SEND_RETRIES   = int(os.getenv("SMTP_SEND_RETRIES", "2"))
+
+
+class _Conn:
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.sent = 0
+
+    def close(self) -> None:
+        try:
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                pass
+
+
+class SmtpPool:
+    """Conexiones SMTP autenticadas reutilizables (thread-safe)."""
+
+    def __init__(self, connect: Callable[[], smtplib.SMTP], size: int = SMTP_POOL_SIZE):
+        self._connect = connect
+        self._size = max(1, size)
+        self._idle: List[_Conn] = []
+        self._slots = threading.BoundedSemaphore(self._size)
+        self._lock = threading.Lock()
+        self.stats = {"connects": 0, "reused": 0, "noop_failed": 0, "recycled": 0}
+
+    def _healthy(self, conn: _Conn) -> bool:
+        now = time.monotonic()
+        if now - conn.created > SMTP_MAX_AGE or conn.sent >= SMTP_MAX_MESSAGES:
+            self.stats["recycled"] += 1
+            return False
+        if now - conn.last_used < SMTP_NOOP_AFTER:
+            return True
+        try:
+            return conn.smtp.noop()[0] == 250
+        except Exception:
+            self.stats["noop_failed"] += 1
+            return False
+
+    def acquire(self) -> _Conn:
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    break
+                if self._healthy(conn):
+                    self.stats["reused"] += 1
+                    return conn
+                conn.close()
+            self.stats["connects"] += 1
+            return _Conn(self._connect())
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn: _Conn, broken: bool = False) -> None:
+        try:
+            if broken:
+                conn.close()
+            else:
+                conn.last_used = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def sendmail(self, sender: str, rcpt: List[str], data: str) -> None:
+        """Envía por una conexión del pool; reintenta con otra si el servidor la cerró."""
+        last: Optional[Exception] = None
+        for _ in range(SMTP_SEND_RETRIES + 1):
+            conn = self.acquire()
+            try:
+                conn.smtp.sendmail(sender, rcpt, data)
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError) as e:
+                # conexión muerta a mitad: se descarta y se prueba con una nueva
+                self.release(conn, broken=True)
+                last = e
+                continue
+            except Exception:
+                self.release(conn, broken=True)
+                raise
+            conn.sent += 1
+            self.release(conn)
+            return
+        raise last  # type: ignore[misc]
+
+
+class Mailer:
+    """Cola en proceso delante del pool: enqueue() no espera al servidor SMTP."""
+
+    def __init__(self, connect: Callable[[], smtplib.SMTP], sender: str):
+        self.pool = SmtpPool(connect)
+        self.sender = sender
+        self._queue: "queue.Queue" = queue.Queue(maxsize=SMTP_QUEUE_MAX)
+        self._threads: List[threading.Thread] = []
+        self._start_lock = threading.Lock()
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "seconds": 0.0}
+
+    def send_now(self, rcpt: List[str], data: str) -> None:
+        t0 = time.perf_counter()
+        self.pool.sendmail(self.sender, rcpt, data)
+        self.stats["sent"] += 1
+        self.stats["seconds"] += time.perf_counter() - t0
+
+    def _ensure_threads(self) -> None:
+        if self._threads:
+            return
+        with self._start_lock:
+            if self._threads:
+                return
+            for i in range(max(1, SMTP_SENDER_THREADS)):
+                t = threading.Thread(target=self._run, name=f"smtp-sender-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def enqueue(self, rcpt: List[str], data: str, on_error: Optional[Callable[[Exception], None]] = None) -> None:
+        """Encola el mensaje. Si la cola está llena se envía en el momento (no se pierde)."""
+        self._ensure_threads()
+        try:
+            self._queue.put_nowait((rcpt, data, on_error))
+            self.stats["queued"] += 1
+        except queue.Full:
+            self.send_now(rcpt, data)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            rcpt, data, on_error = item
+            try:
+                self.send_now(rcpt, data)
+            except Exception as e:
+                self.stats["failed"] += 1
+                if on_error:
+                    try:
+                        on_error(e)
+                    except Exception:
+                        pass
+                else:
+                    print(f"[Mail] Error enviando a {rcpt}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Espera a que la cola se vacíe (p. ej. al apagar). Devuelve False si no da tiempo."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return not self._queue.unfinished_tasks
+
+    def metrics(self) -> dict:
+        out = dict(self.stats)
+        out["pending"] = self._queue.qsize()
+        out["avg_send_seconds"] = round(out["seconds"] / out["sent"], 4) if out["sent"] else 0.0
+        out["pool"] = dict(self.pool.stats)
+        return out
@@ -3,7 +3,7 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel, EmailStr
 from db import pg_conn
 import bcrypt
-from contact_routes import _send_mail  # ya lo tienes en tu backend
+import email_outbox
 
 register_router = APIRouter()
 
@@ -49,18 +49,18 @@ def register_mediador(body: MediadorRegister):
                 body.especialidad, body.dni_cif, body.tipo,
                 temp_hash
             ))
-            cx.commit()
 
-        # enviar correo con contraseña temporal
-        html = f"""
-        <div style="font-family:system-ui,Segoe UI,Roboto,Arial">
-          <h2>¡Bienvenido/a a MEDIAZION!</h2>
-          <p>Tu cuenta se ha creado correctamente. Aquí tienes tu contraseña temporal:</p>
-          <p><b>{temp_pwd}</b></p>
-          <p>Puedes cambiarla desde tu Panel cuando accedas.</p>
-        </div>
-        """
-        _send_mail(email, "Alta de mediador · MEDIAZION", html, email)
+            # correo con contraseña temporal (sale por la bandeja, en la misma transacción)
+            html = f"""
+            <div style="font-family:system-ui,Segoe UI,Roboto,Arial">
+              <h2>¡Bienvenido/a a MEDIAZION!</h2>
+              <p>Tu cuenta se ha creado correctamente. Aquí tienes tu contraseña temporal:</p>
+              <p><b>{temp_pwd}</b></p>
+              <p>Puedes cambiarla desde tu Panel cuando accedas.</p>
+            </div>
+            """
+            email_outbox.enqueue(cur, email, "Alta de mediador · MEDIAZION", html, email, source="register")
+            cx.commit()
 
         return {"ok": True, "message": "Alta realizada. Revisa tu email con la contraseña temporal."}
 
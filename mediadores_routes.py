@@ -4,6 +4,7 @@ from fastapi import APIRouter, HTTPException
 from pydantic import EmailStr
 from typing import Optional, List
 from db import pg_conn
+import photo_variants
 
 mediadores_router = APIRouter()
 
@@ -94,7 +95,8 @@ def mediadores_public(
     Filtra por nombre, bio, provincia o especialidad.
     """
     sql = """
-    SELECT id, name, public_slug, bio, website, photo_url, cv_url, provincia, especialidad
+    SELECT id, name, public_slug, bio, website, photo_url, cv_url, provincia, especialidad,
+           photo_variants
       FROM mediadores
      WHERE status='active'
     """
@@ -117,6 +119,7 @@ def mediadores_public(
     params.append(min(200, max(1, limit)))
 
     try:
+        photo_variants.ensure_column()
         with pg_conn() as cx, cx.cursor() as cur:
             cur.execute(sql, tuple(params))
             rows = cur.fetchall()
@@ -125,6 +128,7 @@ def mediadores_public(
 
     items = []
     for r in rows:
+        variants = photo_variants.public_variants(r[9], r[5])
         items.append(
             {
                 "id": r[0],
@@ -133,6 +137,9 @@ def mediadores_public(
                 "bio": r[3] or "",
                 "website": r[4] or "",
                 "photo_url": r[5] or "",
+                # miniatura para la tarjeta; variants para <picture>/srcset
+                "photo_thumb_url": photo_variants.thumb_url(variants) or r[5] or "",
+                "photo_variants": variants,
                 "cv_url": r[6] or "",
                 "provincia": r[7] or "",
                 "especialidad": r[8] or "",
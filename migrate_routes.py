@@ -102,6 +102,21 @@ CREATE TABLE IF NOT EXISTS posts (
   published_at  TIMESTAMP NULL
 );
 
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS moderation JSONB;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS moderation_attempts INTEGER DEFAULT 0;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS moderation_claimed_at TIMESTAMP NULL;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS moderated_at TIMESTAMP NULL;
+CREATE INDEX IF NOT EXISTS posts_pending_ai_idx ON posts (created_at, id) WHERE status='pending_ai';
+
+CREATE TABLE IF NOT EXISTS voces_moderation_cache (
+  content_hash TEXT PRIMARY KEY,
+  verdict      JSONB NOT NULL,
+  source       TEXT NOT NULL,
+  hits         INTEGER DEFAULT 0,
+  created_at   TIMESTAMP DEFAULT NOW(),
+  last_hit_at  TIMESTAMP NULL
+);
+
 CREATE TABLE IF NOT EXISTS post_comments (
   id SERIAL PRIMARY KEY,
   post_id INTEGER NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
@@ -130,7 +145,8 @@ ALTER TABLE mediadores
   ADD COLUMN IF NOT EXISTS bio TEXT,
   ADD COLUMN IF NOT EXISTS website TEXT,
   ADD COLUMN IF NOT EXISTS photo_url TEXT,
-  ADD COLUMN IF NOT EXISTS cv_url TEXT;
+  ADD COLUMN IF NOT EXISTS cv_url TEXT,
+  ADD COLUMN IF NOT EXISTS photo_variants JSONB;
 DO $$
 BEGIN
   IF NOT EXISTS (
@@ -1,8 +1,9 @@
 # perfil_routes.py — Gestión de perfil del mediador (alias/bio/web/foto/cv)
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, BackgroundTasks
 from pydantic import BaseModel, EmailStr
 from typing import Optional
 from db import pg_conn
+import photo_variants
 
 perfil_router = APIRouter(prefix="/perfil", tags=["perfil"])
 
@@ -17,11 +18,13 @@ class PerfilIn(BaseModel):
 @perfil_router.get("")
 def get_perfil(email: str):
     email = email.lower().strip()
+    photo_variants.ensure_column()
     with pg_conn() as cx:
         with cx.cursor() as cur:
             cur.execute(
                 """
-                SELECT id, email, public_slug, bio, website, photo_url, cv_url, provincia, especialidad
+                SELECT id, email, public_slug, bio, website, photo_url, cv_url, provincia, especialidad,
+                       photo_variants
                   FROM mediadores
                  WHERE email = LOWER(%s);
                 """,
@@ -31,6 +34,7 @@ def get_perfil(email: str):
             if not row:
                 raise HTTPException(404, "No encontrado")
 
+    variants = photo_variants.public_variants(row[9], row[5])
     return {
         "ok": True,
         "perfil": {
@@ -43,16 +47,18 @@ def get_perfil(email: str):
             "cv_url": row[6] or "",
             "provincia": row[7] or "",
             "especialidad": row[8] or "",
+            "photo_variants": variants,
+            "photo_thumb_url": photo_variants.thumb_url(variants) or row[5] or "",
         },
     }
 
 @perfil_router.post("")
-def save_perfil(body: PerfilIn):
+def save_perfil(body: PerfilIn, background: BackgroundTasks):
     email = body.email.lower().strip()
     with pg_conn() as cx:
         with cx.cursor() as cur:
             # comprobar que el mediador existe
-            cur.execute("SELECT id FROM mediadores WHERE email=LOWER(%s);", (email,))
+            cur.execute("SELECT id, photo_url FROM mediadores WHERE email=LOWER(%s);", (email,))
             row = cur.fetchone()
             if not row:
                 raise HTTPException(404, "Mediador no encontrado")
@@ -77,4 +83,8 @@ def save_perfil(body: PerfilIn):
                 ),
             )
         cx.commit()
+
+    # Foto nueva → miniaturas en segundo plano (la respuesta no espera)
+    if body.photo_url and body.photo_url != row[1]:
+        background.add_task(photo_variants.process_photo, email, body.photo_url)
     return {"ok": True}
@@ -0,0 +1,366 @@
+# photo_variants.py — Miniaturas WebP/JPEG de las fotos de perfil
+# ---------------------------------------------------------------
+# Cuando un mediador guarda una foto nueva (perfil_routes), se generan variantes a
+# varios tamaños en WebP y JPEG, se suben a S3 junto al original
+# (uploads/abc.jpg → uploads/abc_w256.webp, ...) y se guardan en
+# mediadores.photo_variants. El directorio y el perfil las devuelven para que el
+# frontend use <picture>/srcset en vez de la foto original.
+#
+# El redimensionado corre en un pool de procesos y fuera de la petición
+# (BackgroundTasks), así que guardar el perfil sigue siendo inmediato.
+#
+# Ahorro en una página del directorio:  python photo_variants.py --measure
+# Generar variantes de fotos antiguas:  python photo_variants.py --backfill
+
+import argparse
+import hashlib
+import io
+import ipaddress
+import json
+import multiprocessing
+import os
+import socket
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+from urllib.parse import urlsplit
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+    _HAS_PIL = True
+except Exception:
+    _HAS_PIL = False
+
+PHOTO_SIZES       = [int(x) for x in os.getenv("PHOTO_VARIANT_SIZES", "96,256,512").split(",") if x.strip()]
+PHOTO_WORKERS     = int(os.getenv("PHOTO_VARIANT_WORKERS", "2"))
+PHOTO_TIMEOUT     = int(os.getenv("PHOTO_VARIANT_TIMEOUT", "60"))
+PHOTO_MAX_BYTES   = int(os.getenv("PHOTO_MAX_BYTES", str(15 * 1024 * 1024)))
+PHOTO_WEBP_QUALITY = int(os.getenv("PHOTO_WEBP_QUALITY", "80"))
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", "82"))
+# Fotos fuera de nuestro bucket: solo de estos hosts (CDN), por HTTPS y sin redirecciones
+PHOTO_ALLOWED_HOSTS = {h.strip().lower() for h in os.getenv("PHOTO_ALLOWED_HOSTS", "").split(",") if h.strip()}
+# Fotos de nuestro bucket: solo las subidas por upload_routes (nada de actas/ u otros prefijos)
+UPLOADS_PREFIX    = "uploads/"
+# Tamaño que usa la tarjeta del directorio
+DIRECTORY_SIZE    = int(os.getenv("PHOTO_DIRECTORY_SIZE", "256"))
+
+FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+
+SQL_PHOTO_VARIANTS = """
+ALTER TABLE mediadores ADD COLUMN IF NOT EXISTS photo_variants JSONB;
+"""
+
+_column_ready = False
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def ensure_column() -> None:
+    global _column_ready
+    if _column_ready:
+        return
+    from db import pg_conn
+    with pg_conn() as cx:
+        with cx.cursor() as cur:
+            cur.execute(SQL_PHOTO_VARIANTS)
+        cx.commit()
+    _column_ready = True
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=PHOTO_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def _reset_pool(failed: ProcessPoolExecutor, kill: bool = False) -> None:
+    """
+    Descarta el pool si sigue siendo `failed` (otra tarea pudo rehacerlo ya); con
+    kill=True termina sus procesos (render colgado, p. ej. una bomba de descompresión).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not failed:
+            return
+        _pool = None
+    if kill:
+        for proc in list(getattr(failed, "_processes", {}).values()):
+            proc.terminate()
+    failed.shutdown(wait=False, cancel_futures=True)
+
+
+def _render(data: bytes) -> list:
+    """render_variants en el pool, con timeout; un pool roto o colgado se rehace."""
+    pool = _get_pool()
+    try:
+        future = pool.submit(render_variants, data, PHOTO_SIZES)
+    except BrokenProcessPool:
+        # un proceso murió en una foto anterior: pool nuevo y un reintento
+        _reset_pool(pool)
+        pool = _get_pool()
+        future = pool.submit(render_variants, data, PHOTO_SIZES)
+    try:
+        return future.result(timeout=PHOTO_TIMEOUT)
+    except FutureTimeout:
+        if not future.cancel():
+            _reset_pool(pool, kill=True)  # sigue ocupando un proceso
+        raise ValueError("El redimensionado ha tardado demasiado")
+    except BrokenProcessPool:
+        _reset_pool(pool)
+        raise
+
+
+# ---------------- Render (en el pool) ----------------
+
+def render_variants(data: bytes, sizes: list) -> list:
+    """
+    Función pura: original → [(tamaño, formato, bytes, ancho, alto)].
+    Rota según EXIF, aplana transparencias y no amplía fotos pequeñas.
+    """
+    img = Image.open(io.BytesIO(data))
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "L"):
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        rgba = img.convert("RGBA")
+        bg.paste(rgba, mask=rgba.split()[-1])
+        img = bg
+    elif img.mode == "L":
+        img = img.convert("RGB")
+
+    out = []
+    for size in sorted(set(sizes)):
+        if size >= max(img.size) and out:
+            break  # más grande que el original: ya tenemos la mayor útil
+        thumb = img.copy()
+        thumb.thumbnail((size, size), Image.LANCZOS)
+        for fmt, (pil_fmt, _) in FORMATS.items():
+            buf = io.BytesIO()
+            if pil_fmt == "WEBP":
+                thumb.save(buf, format=pil_fmt, quality=PHOTO_WEBP_QUALITY, method=4)
+            else:
+                thumb.save(buf, format=pil_fmt, quality=PHOTO_JPEG_QUALITY, optimize=True, progressive=True)
+            out.append((size, fmt, buf.getvalue(), thumb.size[0], thumb.size[1]))
+    return out
+
+
+# ---------------- Pipeline ----------------
+
+def _bucket_key(photo_url: str) -> Optional[str]:
+    """
+    Clave S3 si la URL es de nuestro bucket; None si no. Solo vale una subida
+    (UPLOADS_PREFIX): la URL la pone el usuario y las variantes se escriben
+    junto al original.
+    """
+    import upload_routes
+    prefix = upload_routes._public_url("")
+    if not photo_url.startswith(prefix):
+        return None
+    key = photo_url[len(prefix):].split("?")[0].split("#")[0]
+    if not key.startswith(UPLOADS_PREFIX) or ".." in key or "//" in key:
+        raise ValueError(f"Foto fuera de las subidas: {photo_url}")
+    return key
+
+
+def _variant_base(photo_url: str) -> str:
+    """Clave base de las variantes: junto al original si está en nuestro bucket."""
+    key = _bucket_key(photo_url)
+    if key:
+        return os.path.splitext(key)[0]
+    return "uploads/variants/" + hashlib.sha256(photo_url.encode("utf-8")).hexdigest()[:24]
+
+
+def _check_public_host(host: str) -> None:
+    """El host debe resolver solo a direcciones públicas (nada interno ni de metadatos)."""
+    for info in socket.getaddrinfo(host, 443, proto=socket.IPPROTO_TCP):
+        if not ipaddress.ip_address(info[4][0]).is_global:
+            raise ValueError(f"Host de foto no permitido: {host}")
+
+
+def _download(photo_url: str) -> bytes:
+    """
+    Original de la foto, como mucho PHOTO_MAX_BYTES. La URL la pone el usuario:
+    - de nuestro bucket → se lee de S3 con el cliente (sin pedir nada por HTTP);
+    - de PHOTO_ALLOWED_HOSTS → HTTPS a IPs públicas, sin seguir redirecciones;
+    - cualquier otra → se rechaza.
+    """
+    import upload_routes
+
+    key = _bucket_key(photo_url)
+    if key:
+        obj = upload_routes.s3_client.get_object(Bucket=upload_routes.S3_BUCKET, Key=key)
+        body = obj["Body"]
+        try:
+            if int(obj.get("ContentLength") or 0) > PHOTO_MAX_BYTES:
+                raise ValueError("Foto demasiado grande")
+            data = body.read(PHOTO_MAX_BYTES + 1)
+        finally:
+            body.close()
+        if len(data) > PHOTO_MAX_BYTES:
+            raise ValueError("Foto demasiado grande")
+        return data
+
+    parts = urlsplit(photo_url)
+    host = (parts.hostname or "").lower()
+    if parts.scheme != "https" or host not in PHOTO_ALLOWED_HOSTS:
+        raise ValueError(f"URL de foto no permitida: {photo_url}")
+    _check_public_host(host)
+
+    import httpx
+    with httpx.stream("GET", photo_url, timeout=30.0, follow_redirects=False) as r:
+        if r.status_code != 200:
+            raise ValueError(f"La foto respondió {r.status_code}")
+        length = r.headers.get("content-length") or ""
+        if length.isdigit() and int(length) > PHOTO_MAX_BYTES:
+            raise ValueError("Foto demasiado grande")
+        buf = bytearray()
+        for chunk in r.iter_bytes():
+            buf.extend(chunk)
+            if len(buf) > PHOTO_MAX_BYTES:
+                raise ValueError("Foto demasiado grande")
+    return bytes(buf)
+
+
+def build_variants(photo_url: str) -> dict:
+    """Descarga, redimensiona (pool), sube a S3 y devuelve el JSON de variantes."""
+    import upload_routes
+
+    data = _download(photo_url)
+    rendered = _render(data)
+
+    base = _variant_base(photo_url)
+    variants: dict = {"source": photo_url, "orig_bytes": len(data), "webp": {}, "jpeg": {}}
+    for size, fmt, blob, w, h in rendered:
+        ext = "jpg" if fmt == "jpeg" else fmt
+        key = f"{base}_w{size}.{ext}"
+        upload_routes.s3_client.put_object(
+            Bucket=upload_routes.S3_BUCKET,
+            Key=key,
+            Body=blob,
+            ContentType=FORMATS[fmt][1],
+            CacheControl=upload_routes.IMMUTABLE_CACHE_CONTROL,
+        )
+        variants[fmt][str(size)] = {"url": upload_routes._public_url(key), "width": w, "height": h, "bytes": len(blob)}
+    return variants
+
+
+def process_photo(email: str, photo_url: str) -> None:
+    """
+    Tarea de fondo tras guardar el perfil. Si la foto cambió mientras tanto, no
+    pisa nada (photo_url=%s en el UPDATE).
+    """
+    if not _HAS_PIL or not photo_url or not photo_url.startswith(("http://", "https://")):
+        return
+    from db import pg_conn
+    try:
+        ensure_column()
+        variants = build_variants(photo_url)
+    except Exception as e:
+        print(f"[Perfil] No se pudieron generar miniaturas de {email}: {e}")
+        return
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE mediadores SET photo_variants=%s::jsonb
+             WHERE email=LOWER(%s) AND photo_url=%s;
+            """,
+            (json.dumps(variants), email, photo_url),
+        )
+        cx.commit()
+
+
+def public_variants(raw, photo_url: Optional[str]) -> Optional[dict]:
+    """Variantes para la respuesta (solo si corresponden a la foto actual)."""
+    if not raw:
+        return None
+    if isinstance(raw, str):
+        raw = json.loads(raw)
+    if raw.get("source") != photo_url:
+        return None
+    return {
+        fmt: {size: v["url"] for size, v in raw.get(fmt, {}).items()}
+        for fmt in FORMATS
+    }
+
+
+def thumb_url(variants: Optional[dict], size: int = DIRECTORY_SIZE) -> Optional[str]:
+    """La variante WebP más pequeña que cubre `size` (o la mayor disponible)."""
+    if not variants or not variants.get("webp"):
+        return None
+    sizes = sorted(int(s) for s in variants["webp"])
+    pick = next((s for s in sizes if s >= size), sizes[-1])
+    return variants["webp"][str(pick)]
+
+
+# ---------------- Medida y backfill ----------------
+
+def measure_directory(limit: int = 100) -> dict:
+    """Bytes de fotos de una página del directorio: originales frente a miniaturas."""
+    from db import pg_conn
+    ensure_column()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            SELECT photo_url, photo_variants FROM mediadores
+             WHERE status='active' AND photo_url IS NOT NULL AND photo_url <> ''
+             ORDER BY created_at DESC LIMIT %s;
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall()
+
+    orig = thumbs = with_variants = 0
+    for photo_url, raw in rows:
+        if isinstance(raw, str):
+            raw = json.loads(raw)
+        if not raw or raw.get("source") != photo_url:
+            continue
+        with_variants += 1
+        orig += raw["orig_bytes"]
+        sizes = sorted(int(s) for s in raw["webp"])
+        pick = next((s for s in sizes if s >= DIRECTORY_SIZE), sizes[-1])
+        thumbs += raw["webp"][str(pick)]["bytes"]
+
+    return {
+        "mediadores": len(rows),
+        "with_variants": with_variants,
+        "original_bytes": orig,
+        "thumbnail_bytes": thumbs,
+        "reduction": round(1 - thumbs / orig, 4) if orig else None,
+    }
+
+
+def backfill(limit: int = 500) -> int:
+    from db import pg_conn
+    ensure_column()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            SELECT email, photo_url FROM mediadores
+             WHERE photo_url IS NOT NULL AND photo_url <> ''
+               AND (photo_variants IS NULL OR photo_variants->>'source' IS DISTINCT FROM photo_url)
+             LIMIT %s;
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall()
+    for email, photo_url in rows:
+        process_photo(email, photo_url)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Miniaturas de fotos de perfil")
+    ap.add_argument("--measure", action="store_true", help="ahorro en una página del directorio")
+    ap.add_argument("--backfill", action="store_true", help="generar variantes que falten")
+    ap.add_argument("--limit", type=int, default=100)
+    args = ap.parse_args()
+    if args.backfill:
+        print(f"Procesadas: {backfill(args.limit)}")
+    if args.measure or not args.backfill:
+        print(json.dumps(measure_directory(args.limit), indent=2))
@@ -0,0 +1,74 @@
+# signing.py — Tokens firmados (HMAC-SHA256) sin estado en BD
+# ---------------------------------------------------------------
+# - Sesión de mediador: /auth/login devuelve `token` firmado con su email; las
+#   rutas lo reciben como Authorization: Bearer <token> y obtienen el email
+#   verificado con email_from_authorization() (X-User-Email no es de fiar).
+# - Enlaces con caducidad (p. ej. descarga de actas): sign()/unsign().
+# - SIGNING_SECRET es obligatorio y debe ser el mismo en todas las instancias y
+#   workers: sin él no arranca. Solo para desarrollo local, SIGNING_DEV=1 usa uno
+#   aleatorio por proceso (los tokens dejan de valer al reiniciar).
+
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from typing import Optional
+
+SIGNING_SECRET = os.getenv("SIGNING_SECRET") or ""
+SESSION_TTL    = int(os.getenv("SESSION_TTL", str(30 * 24 * 3600)))
+SIGNING_DEV    = os.getenv("SIGNING_DEV", "").strip().lower() in ("1", "true", "yes")
+
+if not SIGNING_SECRET:
+    if not SIGNING_DEV:
+        raise RuntimeError(
+            "SIGNING_SECRET no configurado: las sesiones y enlaces firmados no valdrían entre "
+            "instancias ni tras reiniciar (SIGNING_DEV=1 solo para desarrollo local)"
+        )
+    print("[Signing] SIGNING_DEV: se usa un secreto temporal de este proceso")
+    SIGNING_SECRET = secrets.token_hex(32)
+
+_KEY = SIGNING_SECRET.encode("utf-8")
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _mac(purpose: str, body: str) -> str:
+    return _b64(hmac.new(_KEY, f"{purpose}|{body}".encode("utf-8"), hashlib.sha256).digest())
+
+
+def sign(value: str, ttl: int, purpose: str) -> str:
+    """`value` firmado para `purpose` y válido `ttl` segundos: "<valor>.<caduca>.<firma>"."""
+    body = f"{_b64(value.encode('utf-8'))}.{int(time.time()) + ttl}"
+    return f"{body}.{_mac(purpose, body)}"
+
+
+def unsign(token: str, purpose: str) -> Optional[str]:
+    """El valor firmado, o None si la firma no cuadra o ha caducado."""
+    try:
+        value, expires, mac = (token or "").strip().split(".")
+        body = f"{value}.{expires}"
+        if not hmac.compare_digest(mac, _mac(purpose, body)) or int(expires) < time.time():
+            return None
+        return _unb64(value).decode("utf-8")
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def issue_session(email: str) -> str:
+    return sign(email.strip().lower(), SESSION_TTL, "session")
+
+
+def email_from_authorization(authorization: Optional[str]) -> Optional[str]:
+    """Email verificado de un `Authorization: Bearer <token de sesión>`, o None."""
+    auth = (authorization or "").strip()
+    if not auth.lower().startswith("bearer "):
+        return None
+    return unsign(auth[7:], "session")
@@ -2,6 +2,7 @@
 import os
 from fastapi import APIRouter, HTTPException, Request
 from db import pg_conn
+import email_outbox
 import stripe
 
 router = APIRouter()  # we'll register with prefix="" and put /stripe/* in paths
@@ -40,7 +41,7 @@ def _get_mediator(email: str):
             return _row_to_dict(cur, cur.fetchone())
 
 
-def _set_subscription(email: str, sub_id: str, subs_status: str):
+def _set_subscription(email: str, sub_id: str, subs_status: str, notify: bool = True):
     with pg_conn() as cx:
         with cx.cursor() as cur:
             cur.execute(
@@ -54,29 +55,28 @@ def _set_subscription(email: str, sub_id: str, subs_status: str):
                 """,
                 (sub_id, subs_status, subs_status, email),
             )
+            if notify:
+                _queue_activation(cur, email, sub_id, subs_status)
         cx.commit()
 
 
-def _send_activation(email: str, sub_id: str, subs_status: str):
-    try:
-        from contact_routes import _send_mail, MAIL_TO_DEFAULT
-        html = f"""
-        <div style="font-family:system-ui,Segoe UI,Roboto,Arial">
-          <p>¡Suscripción {subs_status}!</p>
-          <p>Tu suscripción en <strong>MEDIAZION</strong> está ahora <strong>{subs_status.upper()}</strong>.</p>
-          <p>ID de suscripción: <code>{sub_id}</code></p>
-          <p>
-            <a href="https://mediazion.eu/personal" style="display:inline-block;background:#0a7cff;color:#fff;padding:10px 14px;border-radius:12px;text-decoration:none">
-              Ir a mi panel
-            </a>
-          </p>
-        </div>
-        """
-        _send_mail(email, "Estado de tu suscripción · MEDIAZION", html, email)
-        _send_mail(MAIL_TO_DEFAULT, f"[Suscripción {subs_status}] {email}", html, "MEDIAZION")
-    except Exception:
-        # soft-fail, no 500
-        pass
+def _queue_activation(cur, email: str, sub_id: str, subs_status: str):
+    """Correos de activación por la bandeja de salida (misma transacción que el cambio)."""
+    from contact_routes import MAIL_TO_DEFAULT
+    html = f"""
+    <div style="font-family:system-ui,Segoe UI,Roboto,Arial">
+      <p>¡Suscripción {subs_status}!</p>
+      <p>Tu suscripción en <strong>MEDIAZION</strong> está ahora <strong>{subs_status.upper()}</strong>.</p>
+      <p>ID de suscripción: <code>{sub_id}</code></p>
+      <p>
+        <a href="https://mediazion.eu/personal" style="display:inline-block;background:#0a7cff;color:#fff;padding:10px 14px;border-radius:12px;text-decoration:none">
+          Ir a mi panel
+        </a>
+      </p>
+    </div>
+    """
+    email_outbox.enqueue(cur, email, "Estado de tu suscripción · MEDIAZION", html, email, source="stripe")
+    email_outbox.enqueue(cur, MAIL_TO_DEFAULT, f"[Suscripción {subs_status}] {email}", html, "MEDIAZION", source="stripe")
 
 
 @router.post("/stripe/subscribe")
@@ -129,7 +129,6 @@ def confirm(payload: dict):
         subs = "active" if status == "active" else ("trialing" if status == "trialing" else status)
 
         _set_subscription(email.lower(), sub_id, subs)
-        _send_activation(email, sub_id, subs)
         return {"ok": True, "email": email, "subscription_id": sub_id, "subscription_status": subs}
     except stripe.error.StripeError as e:
         detail = getattr(e, "user_message", None) or str(e)
@@ -159,14 +158,13 @@ async def webhook(request: Request):
             subs = "active" if status == "active" else ("trialing" if status == "trialing" else status)
             if email and sub_id:
                 _set_subscription(email.lower(), sub_id, subs)
-                _send_activation(email, sub_id, subs)
         elif typ == "customer.subscription.deleted":
             email = (obj.get("customer_email") or "")
             if not email and obj.get("customer"):
                 c = stripe.Customer.retrieve(obj["customer"])
                 email = (c.get("email") or "")
             if email:
-                _set_subscription(email.lower(), obj.get("id") or "", "canceled")
+                _set_subscription(email.lower(), obj.get("id") or "", "canceled", notify=False)
     except Exception:
         # No romper el webhook si hay fallos suaves
         pass
@@ -0,0 +1,107 @@
+# upload_bench.py — Coste en el worker de /upload/file frente a la subida prefirmada
+# ---------------------------------------------------------------
+# Sube N ficheros por cada camino y mide, en el proceso del worker (por PID, vía /proc):
+#   - CPU (user+sys) por subida
+#   - RSS máximo (VmHWM) y crecimiento de RSS
+#   - latencia por subida
+#
+#   uvicorn app:app --port 8000 --workers 1 &
+#   python upload_bench.py --pid $(pgrep -f "uvicorn app:app" | head -1) --size-mb 5 --count 20
+#
+# Con S3_ENDPOINT_URL apuntando a MinIO/moto se puede ejecutar sin AWS.
+
+import argparse
+import os
+import time
+from typing import Dict, List
+
+import httpx
+
+
+def _proc_stats(pid: int) -> Dict[str, float]:
+    """CPU acumulada (s) y memoria (KB) del proceso (solo Linux)."""
+    with open(f"/proc/{pid}/stat") as fh:
+        fields = fh.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    cpu = (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+    mem = {}
+    with open(f"/proc/{pid}/status") as fh:
+        for line in fh:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                key, value = line.split(":", 1)
+                mem[key] = int(value.split()[0])
+    return {"cpu": cpu, "rss_kb": mem.get("VmRSS", 0), "hwm_kb": mem.get("VmHWM", 0)}
+
+
+def _upload_proxy(client: httpx.Client, base: str, name: str, data: bytes) -> None:
+    r = client.post(f"{base}/api/upload/file", files={"file": (name, data, "application/pdf")})
+    r.raise_for_status()
+
+
+def _upload_direct(client: httpx.Client, base: str, name: str, data: bytes, method: str) -> None:
+    r = client.post(
+        f"{base}/api/upload/presign",
+        json={"filename": name, "content_type": "application/pdf", "size": len(data), "method": method},
+    )
+    r.raise_for_status()
+    signed = r.json()
+    if signed["method"] == "PUT":
+        r = client.put(signed["url"], content=data, headers=signed["headers"])
+    else:
+        r = client.post(signed["url"], data=signed["fields"], files={"file": (name, data, "application/pdf")})
+    r.raise_for_status()
+    r = client.post(f"{base}/api/upload/complete", json={"key": signed["key"]})
+    r.raise_for_status()
+
+
+def _payload(size: int) -> bytes:
+    # contenido nuevo en cada subida: con la deduplicación por hash, repetir los
+    # mismos bytes mediría una consulta a la BD, no una subida
+    return b"%PDF-1.4\n" + os.urandom(size)
+
+
+def run(path: str, args, size: int) -> Dict[str, float]:
+    latencies: List[float] = []
+    before = _proc_stats(args.pid)
+    with httpx.Client(timeout=args.timeout) as client:
+        for i in range(args.count):
+            data = _payload(size)
+            t0 = time.perf_counter()
+            if path == "proxy":
+                _upload_proxy(client, args.base, f"bench-{i}.pdf", data)
+            else:
+                _upload_direct(client, args.base, f"bench-{i}.pdf", data, args.method)
+            latencies.append(time.perf_counter() - t0)
+    after = _proc_stats(args.pid)
+    latencies.sort()
+    return {
+        "path": path,
+        "uploads": args.count,
+        "cpu_ms_per_upload": round((after["cpu"] - before["cpu"]) / args.count * 1000, 2),
+        "rss_growth_kb": after["rss_kb"] - before["rss_kb"],
+        "rss_peak_kb": after["hwm_kb"],
+        "p50_s": round(latencies[len(latencies) // 2], 3),
+        "max_s": round(latencies[-1], 3),
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="CPU/memoria del worker por subida: proxy vs prefirmada")
+    ap.add_argument("--base", default="http://127.0.0.1:8000")
+    ap.add_argument("--pid", type=int, required=True, help="PID del worker uvicorn")
+    ap.add_argument("--size-mb", type=float, default=5)
+    ap.add_argument("--count", type=int, default=20)
+    ap.add_argument("--method", default="put", choices=("put", "post"))
+    ap.add_argument("--paths", default="proxy,direct")
+    ap.add_argument("--timeout", type=float, default=120.0)
+    args = ap.parse_args()
+    args.base = args.base.rstrip("/")
+
+    size = int(args.size_mb * 1024 * 1024)
+    for path in args.paths.split(","):
+        res = run(path.strip(), args, size)
+        print("  ".join(f"{k}={v}" for k, v in res.items()), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,917 @@
 # upload_routes.py — Subida de archivos a S3 y devolución de URL pública
 
+import asyncio
+import hashlib
 import os
+import time
 import uuid
-from fastapi import APIRouter, File, UploadFile, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException, Request
 from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from starlette.datastructures import UploadFile
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+import admin_auth
+import signing
+from db import pg_conn
 
 # 👇 OJO: aquí SIN prefix. Lo añadimos luego en app.py
 upload_router = APIRouter(tags=["upload"])
 
 S3_BUCKET = os.getenv("S3_BUCKET_NAME")
 AWS_REGION = os.getenv("AWS_DEFAULT_REGION", "eu-north-1")
+# Endpoint alternativo (MinIO / moto en local); vacío → AWS
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+
+# Límite de tamaño y subida multiparte
+UPLOAD_MAX_BYTES       = int(os.getenv("UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_PART_BYTES      = int(os.getenv("UPLOAD_PART_BYTES", str(8 * 1024 * 1024)))   # mínimo S3: 5MB
+UPLOAD_PART_CONCURRENCY = int(os.getenv("UPLOAD_PART_CONCURRENCY", "4"))
+UPLOAD_WORKERS         = int(os.getenv("UPLOAD_WORKERS", "4"))
+HASH_CHUNK_BYTES       = 1024 * 1024
+MULTIPART_OVERHEAD     = 64 * 1024   # cabeceras y separadores del multipart
+
+# Subidas reanudables por trozos (expedientes escaneados, audio/vídeo de sesiones)
+RESUMABLE_MAX_BYTES    = int(os.getenv("UPLOAD_RESUMABLE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+RESUMABLE_PART_BYTES   = max(5 * 1024 * 1024, int(os.getenv("UPLOAD_RESUMABLE_PART_BYTES", str(8 * 1024 * 1024))))
+RESUMABLE_EXPIRE_HOURS = int(os.getenv("UPLOAD_RESUMABLE_EXPIRE_HOURS", "24"))
+RESUMABLE_SWEEP_SECONDS = int(os.getenv("UPLOAD_RESUMABLE_SWEEP_SECONDS", "3600"))
+
+# Las claves por hash no cambian nunca de contenido → caché "para siempre"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Subida directa del navegador a S3 (URL prefirmada)
+PRESIGN_EXPIRES = int(os.getenv("UPLOAD_PRESIGN_EXPIRES", "900"))
+ALLOWED_CONTENT_TYPES = {
+    t.strip().lower()
+    for t in os.getenv(
+        "UPLOAD_ALLOWED_TYPES",
+        "image/jpeg,image/png,image/webp,application/pdf,text/plain,application/msword,"
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ).split(",")
+    if t.strip()
+}
 
 if not S3_BUCKET:
     raise RuntimeError("Falta S3_BUCKET_NAME en las variables de entorno")
 
 # Cliente S3 (usa AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY del entorno)
-s3_client = boto3.client("s3", region_name=AWS_REGION)
+s3_client = boto3.client("s3", region_name=AWS_REGION, endpoint_url=S3_ENDPOINT_URL)
+
+# A partir de UPLOAD_PART_BYTES boto3 sube en partes, varias a la vez
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=UPLOAD_PART_BYTES,
+    multipart_chunksize=UPLOAD_PART_BYTES,
+    max_concurrency=UPLOAD_PART_CONCURRENCY,
+    use_threads=UPLOAD_PART_CONCURRENCY > 1,
+)
+
+# Executor propio: las subidas no ocupan el threadpool por defecto de FastAPI
+_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="s3-upload")
+
+UPLOAD_STATS = {
+    "completed": 0,
+    "failed": 0,
+    "rejected_size": 0,
+    "in_flight": 0,
+    "bytes": 0,
+    "seconds": 0.0,
+    "max_seconds": 0.0,
+    "direct_completed": 0,
+    "direct_bytes": 0,
+    "dedup_hits": 0,
+    "dedup_bytes_saved": 0,
+    "resumable_parts": 0,
+    "resumable_bytes": 0,
+    "resumable_completed": 0,
+    "resumable_expired": 0,
+}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def _limited_receive(receive, limit: int):
+    """
+    `receive` ASGI que corta en cuanto el cuerpo pasa de `limit` bytes. Se aplica
+    mientras Starlette parsea el multipart: un cuerpo enorme no llega a escribirse
+    entero en el fichero temporal ni a leerse hasta el final.
+    """
+    received = 0
+
+    async def _receive():
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise UploadTooLarge()
+        return message
+
+    return _receive
+
+
+class _LimitedReader:
+    """
+    Envuelve el fichero ya recibido y corta si pasa de `limit` bytes. Es la
+    comprobación del tamaño del fichero en sí (sin el multipart); la del cuerpo
+    de la petición la hace _limited_receive al recibirlo.
+    """
+
+    def __init__(self, fh, limit: int):
+        self._fh = fh
+        self._limit = limit
+        self.read_bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self._fh.read(size)
+        self.read_bytes += len(chunk)
+        if self.read_bytes > self._limit:
+            raise UploadTooLarge()
+        return chunk
+
+
+def _public_url(key: str) -> str:
+    """URL pública estándar de S3 (o del endpoint local si se usa S3_ENDPOINT_URL)."""
+    if S3_ENDPOINT_URL:
+        return f"{S3_ENDPOINT_URL.rstrip('/')}/{S3_BUCKET}/{key}"
+    return f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{key}"
+
+
+def _hash_file(fh) -> tuple[str, int]:
+    """SHA-256 y tamaño leyendo por bloques (con el límite de tamaño). Deja el fichero al principio."""
+    reader = _LimitedReader(fh, UPLOAD_MAX_BYTES)
+    digest = hashlib.sha256()
+    while True:
+        chunk = reader.read(HASH_CHUNK_BYTES)
+        if not chunk:
+            break
+        digest.update(chunk)
+    fh.seek(0)
+    return digest.hexdigest(), reader.read_bytes
+
+
+def _content_key(sha256: str, ext: str) -> str:
+    return f"uploads/sha256/{sha256[:2]}/{sha256}{ext.lower()}"
+
+
+def _put_object(fh, key: str, content_type: str) -> int:
+    """Subida bloqueante (en el executor). Devuelve los bytes subidos."""
+    reader = _LimitedReader(fh, UPLOAD_MAX_BYTES)
+    # Subir a S3 — SIN ACL (tu bucket tiene ACLs desactivadas)
+    s3_client.upload_fileobj(
+        reader,
+        S3_BUCKET,
+        key,
+        ExtraArgs={"ContentType": content_type, "CacheControl": IMMUTABLE_CACHE_CONTROL},
+        Config=TRANSFER_CONFIG,
+    )
+    return reader.read_bytes
+
+
+# ---------------- Almacenamiento por contenido (dedup) ----------------
+
+SQL_UPLOADS = """
+CREATE TABLE IF NOT EXISTS uploads (
+  sha256        TEXT PRIMARY KEY,
+  key           TEXT NOT NULL,
+  size          BIGINT NOT NULL,
+  content_type  TEXT,
+  refcount      INTEGER NOT NULL DEFAULT 1,
+  created_at    TIMESTAMP DEFAULT NOW(),
+  last_used_at  TIMESTAMP DEFAULT NOW()
+);
+-- Quién subió qué: solo el dueño de una referencia (sesión firmada) puede soltarla.
+-- Las subidas sin sesión cuentan en refcount pero no tienen dueño: solo las borra admin.
+CREATE TABLE IF NOT EXISTS upload_refs (
+  sha256        TEXT NOT NULL REFERENCES uploads(sha256) ON DELETE CASCADE,
+  owner         TEXT NOT NULL,
+  created_at    TIMESTAMP DEFAULT NOW(),
+  PRIMARY KEY (sha256, owner)
+);
+"""
+
+_uploads_table_ready = False
+
+def _ensure_uploads_table():
+    global _uploads_table_ready
+    if _uploads_table_ready:
+        return
+    with pg_conn() as cx:
+        with cx.cursor() as cur:
+            cur.execute(SQL_UPLOADS)
+        cx.commit()
+    _uploads_table_ready = True
+
+
+def _add_ref(cur, sha256: str, owner: Optional[str]) -> None:
+    """Suma la referencia de `owner` (una por dueño y contenido) o una anónima."""
+    added = 1
+    if owner:
+        cur.execute(
+            "INSERT INTO upload_refs (sha256, owner) VALUES (%s, %s) ON CONFLICT DO NOTHING;",
+            (sha256, owner),
+        )
+        added = cur.rowcount  # 0: este dueño ya lo tenía
+    cur.execute(
+        "UPDATE uploads SET refcount = refcount + %s, last_used_at = NOW() WHERE sha256=%s;",
+        (added, sha256),
+    )
+
+
+def _claim_existing(sha256: str, owner: Optional[str]):
+    """Si el contenido ya está subido, suma la referencia y devuelve (key, size)."""
+    _ensure_uploads_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute("SELECT key, size FROM uploads WHERE sha256=%s FOR UPDATE;", (sha256,))
+        row = cur.fetchone()
+        if row:
+            _add_ref(cur, sha256, owner)
+        cx.commit()
+    return row
+
+
+def _record_upload(sha256: str, key: str, size: int, content_type: str, owner: Optional[str]) -> bool:
+    """Registra la subida. True si la fila es nueva (la creó esta subida)."""
+    with pg_conn() as cx, cx.cursor() as cur:
+        # Dos subidas simultáneas del mismo contenido escriben la misma clave: basta con contar
+        for _ in range(3):
+            cur.execute(
+                """
+                INSERT INTO uploads (sha256, key, size, content_type, refcount)
+                VALUES (%s, %s, %s, %s, 0)
+                ON CONFLICT (sha256) DO NOTHING;
+                """,
+                (sha256, key, size, content_type),
+            )
+            inserted = cur.rowcount == 1
+            # Espera a un upload_release en curso; si borró la fila, se vuelve a crear
+            cur.execute("SELECT 1 FROM uploads WHERE sha256=%s FOR UPDATE;", (sha256,))
+            if cur.fetchone():
+                break
+        else:
+            raise RuntimeError("No se pudo registrar la subida (borrado concurrente)")
+        _add_ref(cur, sha256, owner)
+        cx.commit()
+    return inserted
+
+
+def _ensure_object(fh, key: str, content_type: str) -> None:
+    """
+    Tras crear la fila: si un upload_release del mismo contenido borró el objeto
+    mientras esta subida estaba en curso (entre _claim_existing y _record_upload,
+    que espera a que ese borrado confirme), se vuelve a subir.
+    """
+    try:
+        s3_client.head_object(Bucket=S3_BUCKET, Key=key)
+    except ClientError as e:
+        code = (e.response.get("Error") or {}).get("Code")
+        if code not in ("404", "NoSuchKey", "NotFound"):
+            raise
+        fh.seek(0)
+        _put_object(fh, key, content_type)
 
 
 @upload_router.post("/upload/file")
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(request: Request):
     """
     Endpoint real: POST /api/upload/file  (porque app.py usa prefix="/api")
-    Sube un archivo a S3 y devuelve una URL pública.
+    Multipart con el campo `file`. Sube el archivo a S3 y devuelve una URL pública.
+    El formulario se parsea aquí (no en la firma) para aplicar el límite de tamaño
+    antes y durante la recepción, no después de tenerlo entero en disco.
+    La subida corre en un executor propio (no bloquea el event loop) y es
+    multiparte para ficheros grandes.
     """
-    if not file or not file.filename:
+    # Rechazo por Content-Length antes de leer nada del cuerpo
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD:
+        UPLOAD_STATS["rejected_size"] += 1
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+
+    # Sin Content-Length (chunked) o si miente: se corta al recibir
+    limited = Request(request.scope, _limited_receive(request.receive, UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD))
+    try:
+        form = await limited.form()
+    except UploadTooLarge:
+        UPLOAD_STATS["rejected_size"] += 1
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+    owner = signing.email_from_authorization(request.headers.get("authorization"))
+    try:
+        return await _upload_form_file(form.get("file"), owner)
+    finally:
+        await form.close()
+
+
+async def _upload_form_file(file, owner: Optional[str]) -> JSONResponse:
+    if not isinstance(file, UploadFile) or not file.filename:
         raise HTTPException(status_code=400, detail="No se recibió archivo")
 
+    # Obtener extensión (si existe)
+    _, ext = os.path.splitext(file.filename)
+    ext = ext or ""
+    content_type = file.content_type or "application/octet-stream"
+
+    loop = asyncio.get_running_loop()
+    UPLOAD_STATS["in_flight"] += 1
+    t0 = time.perf_counter()
     try:
-        # Obtener extensión (si existe)
-        _, ext = os.path.splitext(file.filename)
-        ext = ext or ""
+        # Clave por contenido: si ya existe no se vuelve a subir
+        sha256, size = await loop.run_in_executor(_upload_executor, _hash_file, file.file)
+        existing = await loop.run_in_executor(_upload_executor, _claim_existing, sha256, owner)
+        if existing:
+            UPLOAD_STATS["dedup_hits"] += 1
+            UPLOAD_STATS["dedup_bytes_saved"] += size
+            return JSONResponse({
+                "ok": True,
+                "url": _public_url(existing[0]),
+                "size": existing[1],
+                "sha256": sha256,
+                "duplicate": True,
+            })
+
+        key = _content_key(sha256, ext)
+        size = await loop.run_in_executor(_upload_executor, _put_object, file.file, key, content_type)
+        created = await loop.run_in_executor(_upload_executor, _record_upload, sha256, key, size, content_type, owner)
+        if created:
+            await loop.run_in_executor(_upload_executor, _ensure_object, file.file, key, content_type)
+    except UploadTooLarge:
+        UPLOAD_STATS["rejected_size"] += 1
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+    except Exception as e:
+        UPLOAD_STATS["failed"] += 1
+        raise HTTPException(status_code=500, detail=f"Error al subir a S3: {e}")
+    finally:
+        UPLOAD_STATS["in_flight"] -= 1
+
+    elapsed = time.perf_counter() - t0
+    UPLOAD_STATS["completed"] += 1
+    UPLOAD_STATS["bytes"] += size
+    UPLOAD_STATS["seconds"] += elapsed
+    UPLOAD_STATS["max_seconds"] = max(UPLOAD_STATS["max_seconds"], elapsed)
+
+    return JSONResponse({
+        "ok": True,
+        "url": _public_url(key),
+        "size": size,
+        "sha256": sha256,
+        "duplicate": False,
+        "seconds": round(elapsed, 3),
+    })
+
+
+@upload_router.delete("/upload/{sha256}")
+def upload_release(
+    sha256: str,
+    authorization: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
+    owner: Optional[str] = None,
+):
+    """
+    Suelta la referencia del usuario (Bearer con su token de sesión) a un contenido
+    que subió él. Con la última referencia, se borra el objeto.
+    Admin (X-Admin-Token): suelta la de `owner`, o todas si no se indica.
+    """
+    sha256 = sha256.lower()
+    is_admin = admin_auth.is_admin(x_admin_token)
+    email = signing.email_from_authorization(authorization)
+    if not is_admin and not email:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    target = (owner or "").strip().lower() if is_admin else email
+
+    _ensure_uploads_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute("SELECT key FROM uploads WHERE sha256=%s FOR UPDATE;", (sha256,))
+        row = cur.fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Archivo no encontrado")
+        key = row[0]
+        if target:
+            cur.execute("DELETE FROM upload_refs WHERE sha256=%s AND owner=%s;", (sha256, target))
+            if not cur.rowcount:
+                raise HTTPException(status_code=404, detail="Archivo no encontrado")
+            cur.execute(
+                "UPDATE uploads SET refcount = refcount - 1 WHERE sha256=%s RETURNING refcount;",
+                (sha256,),
+            )
+            refcount = cur.fetchone()[0]
+        else:
+            refcount = 0  # admin sin owner: se borra del todo
+        if refcount <= 0:
+            # El objeto se borra con la fila aún bloqueada: un _claim_existing o
+            # _record_upload del mismo contenido espera a este commit y no puede
+            # quedarse con una fila que apunte a un objeto ya borrado.
+            try:
+                s3_client.delete_object(Bucket=S3_BUCKET, Key=key)
+            except Exception as e:
+                cx.rollback()
+                raise HTTPException(status_code=500, detail=f"Error al borrar en S3: {e}")
+            cur.execute("DELETE FROM uploads WHERE sha256=%s;", (sha256,))
+        cx.commit()
+    return {"ok": True, "refcount": max(0, refcount)}
+
+
+# ---------------- Subida directa a S3 (prefirmada) ----------------
+#
+# 1) POST /upload/presign   → URL (POST con policy o PUT firmado) con tamaño y tipo fijados
+# 2) El navegador sube el fichero directamente al bucket
+# 3) POST /upload/complete  → HEAD del objeto, se comprueba y se registra
+#
+# /upload/file sigue disponible como alternativa (navegadores sin CORS hacia S3, etc.).
+
+SQL_DIRECT_UPLOADS = """
+CREATE TABLE IF NOT EXISTS direct_uploads (
+  key           TEXT PRIMARY KEY,
+  filename      TEXT,
+  content_type  TEXT NOT NULL,
+  max_bytes     BIGINT NOT NULL,
+  status        TEXT NOT NULL DEFAULT 'pending',   -- pending | completed | rejected
+  size          BIGINT,
+  etag          TEXT,
+  created_at    TIMESTAMP DEFAULT NOW(),
+  completed_at  TIMESTAMP NULL
+);
+"""
+
+_direct_table_ready = False
+
+def _ensure_direct_table():
+    global _direct_table_ready
+    if _direct_table_ready:
+        return
+    with pg_conn() as cx:
+        with cx.cursor() as cur:
+            cur.execute(SQL_DIRECT_UPLOADS)
+        cx.commit()
+    _direct_table_ready = True
+
+
+class PresignIn(BaseModel):
+    filename: str
+    content_type: str
+    size: int
+    method: Optional[str] = "post"  # post (formulario con policy) | put
+
 
-        # Nombre único dentro del bucket
-        key = f"uploads/{uuid.uuid4().hex}{ext}"
+class CompleteIn(BaseModel):
+    key: str
 
-        # Subir a S3 — SIN ACL (tu bucket tiene ACLs desactivadas)
-        s3_client.upload_fileobj(
-            file.file,
-            S3_BUCKET,
-            key,
-            ExtraArgs={
-                "ContentType": file.content_type or "application/octet-stream",
-            },
+
+def _presign(key: str, content_type: str, size: int, method: str) -> dict:
+    if method == "put":
+        url = s3_client.generate_presigned_url(
+            "put_object",
+            Params={"Bucket": S3_BUCKET, "Key": key, "ContentType": content_type, "ContentLength": size},
+            ExpiresIn=PRESIGN_EXPIRES,
         )
+        return {"method": "PUT", "url": url, "headers": {"Content-Type": content_type}}
+
+    post = s3_client.generate_presigned_post(
+        S3_BUCKET,
+        key,
+        Fields={"Content-Type": content_type},
+        Conditions=[
+            {"Content-Type": content_type},
+            ["content-length-range", 1, size],
+        ],
+        ExpiresIn=PRESIGN_EXPIRES,
+    )
+    return {"method": "POST", "url": post["url"], "fields": post["fields"]}
+
 
-        # URL pública estándar de S3
-        url = f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{key}"
+@upload_router.post("/upload/presign")
+def upload_presign(body: PresignIn):
+    """
+    Endpoint real: POST /api/upload/presign
+    Devuelve una URL para subir el fichero directamente a S3 (sin pasar por el backend).
+    """
+    method = (body.method or "post").lower()
+    if method not in ("post", "put"):
+        raise HTTPException(status_code=400, detail="method debe ser post o put")
+    content_type = (body.content_type or "").strip().lower()
+    if content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(status_code=415, detail="Tipo de archivo no permitido")
+    if body.size <= 0:
+        raise HTTPException(status_code=400, detail="Tamaño no válido")
+    if body.size > UPLOAD_MAX_BYTES:
+        UPLOAD_STATS["rejected_size"] += 1
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande")
 
-        return JSONResponse({"ok": True, "url": url})
+    _, ext = os.path.splitext(body.filename or "")
+    key = f"uploads/{uuid.uuid4().hex}{ext or ''}"
 
+    try:
+        signed = _presign(key, content_type, body.size, method)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error al subir a S3: {e}")
+        raise HTTPException(status_code=500, detail=f"Error al firmar la subida: {e}")
+
+    _ensure_direct_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO direct_uploads (key, filename, content_type, max_bytes)
+            VALUES (%s, %s, %s, %s);
+            """,
+            (key, body.filename, content_type, body.size),
+        )
+        cx.commit()
+
+    return {"ok": True, "key": key, "expires_in": PRESIGN_EXPIRES, **signed}
+
+
+@upload_router.post("/upload/complete")
+def upload_complete(body: CompleteIn):
+    """
+    Callback del navegador tras subir a S3: comprueba el objeto con HEAD
+    (existe, tamaño y tipo dentro de lo firmado) y lo registra.
+    """
+    _ensure_direct_table()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "SELECT content_type, max_bytes, status FROM direct_uploads WHERE key=%s;",
+            (body.key,),
+        )
+        row = cur.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Subida no encontrada")
+    content_type, max_bytes, status = row
+    if status == "completed":
+        return {"ok": True, "url": _public_url(body.key)}
+
+    try:
+        head = s3_client.head_object(Bucket=S3_BUCKET, Key=body.key)
+    except ClientError as e:
+        code = (e.response.get("Error") or {}).get("Code")
+        if code in ("404", "NoSuchKey", "NotFound"):
+            raise HTTPException(status_code=409, detail="El archivo aún no está en S3")
+        raise HTTPException(status_code=500, detail=f"Error al comprobar en S3: {e}")
+
+    size = int(head.get("ContentLength") or 0)
+    got_type = (head.get("ContentType") or "").lower()
+    if size <= 0 or size > max_bytes or got_type != content_type:
+        s3_client.delete_object(Bucket=S3_BUCKET, Key=body.key)
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute("UPDATE direct_uploads SET status='rejected' WHERE key=%s;", (body.key,))
+            cx.commit()
+        raise HTTPException(status_code=422, detail="El archivo subido no coincide con lo autorizado")
+
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE direct_uploads
+               SET status='completed', size=%s, etag=%s, completed_at=NOW()
+             WHERE key=%s;
+            """,
+            (size, (head.get("ETag") or "").strip('"'), body.key),
+        )
+        cx.commit()
+
+    UPLOAD_STATS["direct_completed"] += 1
+    UPLOAD_STATS["direct_bytes"] += size
+    return {"ok": True, "url": _public_url(body.key), "size": size}
+
+
+# ---------------- Subidas reanudables (S3 multipart) ----------------
+#
+# 1) POST   /upload/resumable                      → id, part_size
+# 2) PUT    /upload/resumable/{id}?offset=N         → cuerpo = trozo de part_size bytes
+#                                                     (el último puede ser menor)
+# 3) GET    /upload/resumable/{id}                  → offset actual (para reanudar)
+# 4) POST   /upload/resumable/{id}/complete         → URL final
+#    DELETE /upload/resumable/{id}                  → cancelar
+#
+# Cada trozo es una parte del multipart de S3; las partes recibidas se apuntan en
+# Postgres. Reenviar un trozo ya recibido (respuesta perdida) sustituye la parte.
+# Las subidas sin actividad en UPLOAD_RESUMABLE_EXPIRE_HOURS caducan y se abortan.
+
+SQL_RESUMABLE = """
+CREATE TABLE IF NOT EXISTS resumable_uploads (
+  id            TEXT PRIMARY KEY,
+  key           TEXT NOT NULL,
+  s3_upload_id  TEXT NOT NULL,
+  filename      TEXT,
+  content_type  TEXT NOT NULL,
+  size          BIGINT NOT NULL,
+  part_size     BIGINT NOT NULL,
+  "offset"      BIGINT NOT NULL DEFAULT 0,
+  status        TEXT NOT NULL DEFAULT 'uploading',  -- uploading | completed | aborted | expired
+  created_at    TIMESTAMP DEFAULT NOW(),
+  updated_at    TIMESTAMP DEFAULT NOW(),
+  expires_at    TIMESTAMP NOT NULL
+);
+CREATE TABLE IF NOT EXISTS resumable_upload_parts (
+  upload_id     TEXT NOT NULL REFERENCES resumable_uploads(id) ON DELETE CASCADE,
+  part_number   INTEGER NOT NULL,
+  etag          TEXT NOT NULL,
+  size          BIGINT NOT NULL,
+  PRIMARY KEY (upload_id, part_number)
+);
+CREATE INDEX IF NOT EXISTS resumable_uploads_expiry_idx ON resumable_uploads (expires_at) WHERE status='uploading';
+"""
+
+_resumable_tables_ready = False
+
+def _ensure_resumable_tables():
+    global _resumable_tables_ready
+    if _resumable_tables_ready:
+        return
+    with pg_conn() as cx:
+        with cx.cursor() as cur:
+            cur.execute(SQL_RESUMABLE)
+        cx.commit()
+    _resumable_tables_ready = True
+
+
+class ResumableIn(BaseModel):
+    filename: str
+    content_type: Optional[str] = None
+    size: int
+
+
+RESUMABLE_COLS = ["id", "key", "s3_upload_id", "content_type", "size", "part_size", "offset", "status", "expires_at"]
+
+def _get_resumable(upload_id: str) -> dict:
+    _ensure_resumable_tables()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, key, s3_upload_id, content_type, size, part_size, "offset", status, expires_at
+              FROM resumable_uploads WHERE id=%s;
+            """,
+            (upload_id,),
+        )
+        row = cur.fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="Subida no encontrada")
+    return dict(zip(RESUMABLE_COLS, row))
+
+
+def _resumable_state(up: dict) -> dict:
+    return {
+        "ok": True,
+        "id": up["id"],
+        "offset": up["offset"],
+        "size": up["size"],
+        "part_size": up["part_size"],
+        "status": up["status"],
+        "expires_at": up["expires_at"].isoformat() if up["expires_at"] else None,
+    }
+
+
+@upload_router.post("/upload/resumable")
+def resumable_create(body: ResumableIn):
+    if body.size <= 0:
+        raise HTTPException(status_code=400, detail="Tamaño no válido")
+    if body.size > RESUMABLE_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande")
+
+    _, ext = os.path.splitext(body.filename or "")
+    key = f"uploads/{uuid.uuid4().hex}{ext or ''}"
+    content_type = body.content_type or "application/octet-stream"
+
+    try:
+        mpu = s3_client.create_multipart_upload(Bucket=S3_BUCKET, Key=key, ContentType=content_type)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al iniciar la subida en S3: {e}")
+
+    _ensure_resumable_tables()
+    upload_id = uuid.uuid4().hex
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO resumable_uploads
+                   (id, key, s3_upload_id, filename, content_type, size, part_size, expires_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, NOW() + (%s * INTERVAL '1 hour'))
+            RETURNING expires_at;
+            """,
+            (upload_id, key, mpu["UploadId"], body.filename, content_type, body.size,
+             RESUMABLE_PART_BYTES, RESUMABLE_EXPIRE_HOURS),
+        )
+        expires_at = cur.fetchone()[0]
+        cx.commit()
+
+    return {
+        "ok": True,
+        "id": upload_id,
+        "offset": 0,
+        "size": body.size,
+        "part_size": RESUMABLE_PART_BYTES,
+        "status": "uploading",
+        "expires_at": expires_at.isoformat() if expires_at else None,
+    }
+
+
+@upload_router.get("/upload/resumable/{upload_id}")
+def resumable_status(upload_id: str):
+    """Offset a partir del cual hay que seguir enviando."""
+    return _resumable_state(_get_resumable(upload_id))
+
+
+def _upload_part(up: dict, part_number: int, data: bytes) -> str:
+    resp = s3_client.upload_part(
+        Bucket=S3_BUCKET,
+        Key=up["key"],
+        UploadId=up["s3_upload_id"],
+        PartNumber=part_number,
+        Body=data,
+    )
+    return resp["ETag"].strip('"')
+
+
+def _record_part(up: dict, offset: int, part_number: int, etag: str, size: int) -> int:
+    """Apunta la parte y avanza el offset si era el trozo siguiente. Devuelve el offset actual."""
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO resumable_upload_parts (upload_id, part_number, etag, size)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (upload_id, part_number) DO UPDATE
+               SET etag = EXCLUDED.etag, size = EXCLUDED.size;
+            """,
+            (up["id"], part_number, etag, size),
+        )
+        # offset=%s: si otro PUT del mismo trozo ya avanzó, no se suma dos veces
+        cur.execute(
+            """
+            UPDATE resumable_uploads
+               SET "offset" = "offset" + %s, updated_at = NOW(),
+                   expires_at = NOW() + (%s * INTERVAL '1 hour')
+             WHERE id=%s AND "offset"=%s;
+            """,
+            (size, RESUMABLE_EXPIRE_HOURS, up["id"], offset),
+        )
+        cur.execute('SELECT "offset" FROM resumable_uploads WHERE id=%s;', (up["id"],))
+        current = cur.fetchone()[0]
+        cx.commit()
+    return current
+
+
+@upload_router.put("/upload/resumable/{upload_id}")
+async def resumable_put(upload_id: str, request: Request, offset: int):
+    """
+    Recibe un trozo en `offset`. Debe empezar en un múltiplo de part_size, no pasar
+    del offset actual y medir part_size (o lo que quede, si es el último).
+    """
+    loop = asyncio.get_running_loop()
+    up = await loop.run_in_executor(_upload_executor, _get_resumable, upload_id)
+    if up["status"] != "uploading":
+        raise HTTPException(status_code=409, detail=f"La subida está {up['status']}")
+    if offset % up["part_size"] != 0 or offset > up["offset"] or offset >= up["size"]:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Offset no válido; el servidor tiene {up['offset']} bytes",
+            headers={"Upload-Offset": str(up["offset"])},
+        )
+
+    expected = min(up["part_size"], up["size"] - offset)
+    buf = bytearray()
+    async for chunk in request.stream():
+        buf.extend(chunk)
+        if len(buf) > expected:
+            raise HTTPException(status_code=413, detail=f"El trozo debe medir {expected} bytes")
+    if len(buf) != expected:
+        raise HTTPException(status_code=400, detail=f"El trozo debe medir {expected} bytes")
+
+    part_number = offset // up["part_size"] + 1
+    try:
+        etag = await loop.run_in_executor(_upload_executor, _upload_part, up, part_number, bytes(buf))
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Error al subir el trozo a S3: {e}")
+    current = await loop.run_in_executor(
+        _upload_executor, _record_part, up, offset, part_number, etag, len(buf)
+    )
+    UPLOAD_STATS["resumable_parts"] += 1
+    UPLOAD_STATS["resumable_bytes"] += len(buf)
+    return JSONResponse({"ok": True, "offset": current, "size": up["size"]}, headers={"Upload-Offset": str(current)})
+
+
+@upload_router.post("/upload/resumable/{upload_id}/complete")
+def resumable_complete(upload_id: str):
+    up = _get_resumable(upload_id)
+    if up["status"] == "completed":
+        return {"ok": True, "url": _public_url(up["key"]), "size": up["size"]}
+    if up["status"] != "uploading":
+        raise HTTPException(status_code=409, detail=f"La subida está {up['status']}")
+    if up["offset"] != up["size"]:
+        raise HTTPException(status_code=409, detail=f"Faltan datos: recibidos {up['offset']} de {up['size']} bytes")
+
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "SELECT part_number, etag FROM resumable_upload_parts WHERE upload_id=%s ORDER BY part_number;",
+            (upload_id,),
+        )
+        parts = [{"PartNumber": r[0], "ETag": r[1]} for r in cur.fetchall()]
+
+    try:
+        s3_client.complete_multipart_upload(
+            Bucket=S3_BUCKET,
+            Key=up["key"],
+            UploadId=up["s3_upload_id"],
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al completar la subida en S3: {e}")
+
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "UPDATE resumable_uploads SET status='completed', updated_at=NOW() WHERE id=%s;",
+            (upload_id,),
+        )
+        cur.execute("DELETE FROM resumable_upload_parts WHERE upload_id=%s;", (upload_id,))
+        cx.commit()
+
+    UPLOAD_STATS["resumable_completed"] += 1
+    return {"ok": True, "url": _public_url(up["key"]), "size": up["size"]}
+
+
+def _abort_resumable(upload_id: str, key: str, s3_upload_id: str, status: str) -> None:
+    try:
+        s3_client.abort_multipart_upload(Bucket=S3_BUCKET, Key=key, UploadId=s3_upload_id)
+    except ClientError as e:
+        # ya abortada o inexistente en S3: solo queda marcarla
+        if (e.response.get("Error") or {}).get("Code") != "NoSuchUpload":
+            raise
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            "UPDATE resumable_uploads SET status=%s, updated_at=NOW() WHERE id=%s AND status='uploading';",
+            (status, upload_id),
+        )
+        cur.execute("DELETE FROM resumable_upload_parts WHERE upload_id=%s;", (upload_id,))
+        cx.commit()
+
+
+@upload_router.delete("/upload/resumable/{upload_id}")
+def resumable_abort(upload_id: str):
+    up = _get_resumable(upload_id)
+    if up["status"] != "uploading":
+        return _resumable_state(up)
+    try:
+        _abort_resumable(upload_id, up["key"], up["s3_upload_id"], "aborted")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error al cancelar la subida en S3: {e}")
+    return _resumable_state(_get_resumable(upload_id))
+
+
+def _expire_resumable() -> int:
+    """Aborta en S3 las subidas caducadas (las partes sueltas cuestan almacenamiento)."""
+    _ensure_resumable_tables()
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, key, s3_upload_id FROM resumable_uploads
+             WHERE status='uploading' AND expires_at < NOW()
+             LIMIT 200;
+            """
+        )
+        rows = cur.fetchall()
+    expired = 0
+    for upload_id, key, s3_upload_id in rows:
+        try:
+            _abort_resumable(upload_id, key, s3_upload_id, "expired")
+            expired += 1
+        except Exception as e:
+            print(f"[upload] no se pudo abortar {upload_id}: {e}")
+    UPLOAD_STATS["resumable_expired"] += expired
+    return expired
+
+
+_resumable_sweeper: Optional[asyncio.Task] = None
+
+async def _resumable_sweep_loop():
+    while True:
+        try:
+            await asyncio.to_thread(_expire_resumable)
+        except Exception as e:
+            print(f"[upload] error caducando subidas reanudables: {e}")
+        await asyncio.sleep(RESUMABLE_SWEEP_SECONDS)
+
+
+@upload_router.on_event("startup")
+async def _start_resumable_sweeper():
+    global _resumable_sweeper
+    _resumable_sweeper = asyncio.create_task(_resumable_sweep_loop())
+
+
+@upload_router.get("/upload/metrics")
+def upload_metrics():
+    """Bytes y segundos por subida (este proceso)."""
+    stats = dict(UPLOAD_STATS)
+    done = stats["completed"]
+    stats["avg_bytes"] = int(stats["bytes"] / done) if done else 0
+    stats["avg_seconds"] = round(stats["seconds"] / done, 4) if done else 0.0
+    stats["mb_per_second"] = round(stats["bytes"] / stats["seconds"] / 1e6, 2) if stats["seconds"] else 0.0
+    stats["max_bytes"] = UPLOAD_MAX_BYTES
+    stats["part_bytes"] = UPLOAD_PART_BYTES
+    stats["part_concurrency"] = UPLOAD_PART_CONCURRENCY
+    return {"ok": True, "metrics": stats}
+
+
+@upload_router.on_event("shutdown")
+def _shutdown_upload_executor():
+    if _resumable_sweeper:
+        _resumable_sweeper.cancel()
+    _upload_executor.shutdown(wait=False)
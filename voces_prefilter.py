@@ -0,0 +1,294 @@
+# voces_prefilter.py — Pre-moderación local de VOCES (antes de llamar a la IA)
+# ---------------------------------------------------------------
+# Etapa barata delante de voces_routes._moderate_text:
+#   1) Caché de veredictos por hash del contenido normalizado (memoria + tabla).
+#   2) Puntuación por palabras clave y patrones (insultos, DNI/NIE, teléfono, IBAN,
+#      email) en UNA sola pasada con una expresión regular compilada.
+#   3) Texto muy corto (un saludo, una frase) y limpio → publish local; datos
+#      personales claros → review local; el resto → IA. Las palabras clave no ven
+#      detalles confidenciales de casos, nombres de terceros ni insultos fuera de
+#      la lista, así que un texto normal nunca se publica sin la IA.
+#
+# Réplica de precisión:  python voces_prefilter.py fixtures/voces_moderacion.jsonl
+
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, Optional
+
+PREFILTER_ENABLED           = str(os.getenv("VOCES_PREFILTER", "true")).strip().lower() in ("1", "true", "yes", "on")
+PREFILTER_PUBLISH_MAX_CHARS = int(os.getenv("VOCES_PREFILTER_PUBLISH_MAX_CHARS", "200"))  # más largo → IA
+CACHE_MAX_ITEMS             = int(os.getenv("VOCES_MODERATION_CACHE_ITEMS", "2000"))
+
+# Puntuación a partir de la cual el texto va a revisión manual sin pasar por la IA
+REVIEW_SCORE = 3.0
+
+SQL_CACHE = """
+CREATE TABLE IF NOT EXISTS voces_moderation_cache (
+  content_hash TEXT PRIMARY KEY,
+  verdict      JSONB NOT NULL,
+  source       TEXT NOT NULL,            -- prefilter | ai
+  hits         INTEGER DEFAULT 0,
+  created_at   TIMESTAMP DEFAULT NOW(),
+  last_hit_at  TIMESTAMP NULL
+);
+"""
+
+
+# ---------------- Normalización ----------------
+
+def _fold(text: str) -> str:
+    """Minúsculas, sin tildes y con espacios colapsados."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def content_hash(title: str, summary: Optional[str], content: str) -> str:
+    blob = "\x1f".join(_fold(x or "") for x in (title, summary, content))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+# ---------------- Puntuación local ----------------
+
+# Términos en forma normalizada (sin tildes)
+_INSULTS = [
+    "idiota", "imbecil", "gilipollas", "subnormal", "estupido", "estupida", "cabron", "cabrona",
+    "hijo de puta", "hija de puta", "mierda", "capullo", "payaso", "retrasado", "maldito",
+    "puta", "zorra", "mamon", "cretino", "inutil",
+]
+_POLITICS = ["votad", "votar a", "vota a", "partido", "elecciones", "campana electoral"]
+_VIOLENCE = ["te voy a matar", "os voy a matar", "hay que matar", "quemar", "paliza", "te vas a enterar"]
+
+# (categoría, peso, patrón). Cada coincidencia suma su peso.
+_RULES = [
+    ("insult", 1.0, r"\b(?:" + "|".join(re.escape(w) for w in _INSULTS) + r")\b"),
+    ("politics", 1.0, r"\b(?:" + "|".join(re.escape(w) for w in _POLITICS) + r")\b"),
+    ("violence", 3.0, r"\b(?:" + "|".join(re.escape(w) for w in _VIOLENCE) + r")\b"),
+    ("dni", 3.0, r"\b\d{8}\s?-?\s?[a-z]\b"),
+    ("nie", 3.0, r"\b[xyz]\s?-?\s?\d{7}\s?-?\s?[a-z]\b"),
+    ("iban", 3.0, r"\b[a-z]{2}\d{2}(?:\s?\d{4}){4,7}\b"),
+    ("phone", 2.0, r"(?<![\d])(?:\+34\s?)?[6789]\d{2}(?:[\s.-]?\d{2,3}){3}(?![\d])"),
+    ("email", 2.0, r"\b[a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,}\b"),
+]
+
+# Una única alternancia con grupos con nombre → una sola pasada por el texto
+_SCANNER = re.compile("|".join(f"(?P<{name}>{pat})" for name, _, pat in _RULES))
+_WEIGHTS = {name: weight for name, weight, _ in _RULES}
+
+_PII = {"dni", "nie", "iban", "phone", "email"}
+
+
+def score_text(text: str) -> tuple[float, dict]:
+    """Devuelve (puntuación total, {categoría: nº de coincidencias})."""
+    hits: dict = {}
+    for m in _SCANNER.finditer(_fold(text)):
+        cat = m.lastgroup
+        hits[cat] = hits.get(cat, 0) + 1
+    score = sum(_WEIGHTS[c] * n for c, n in hits.items())
+    return score, hits
+
+
+def local_verdict(title: str, summary: Optional[str], content: str) -> Optional[dict]:
+    """
+    Veredicto local o None si el texto es ambiguo y debe decidirlo la IA.
+      - Sin coincidencias y muy corto (PREFILTER_PUBLISH_MAX_CHARS) → publish/low
+      - Datos personales o violencia (puntuación >= REVIEW_SCORE) → review/high
+    """
+    texto = f"{title}\n{summary or ''}\n{content}"
+    score, hits = score_text(texto)
+
+    if score == 0 and len(texto) <= PREFILTER_PUBLISH_MAX_CHARS:
+        return {"action": "publish", "risk": "low", "reasons": ["prefilter_clean"]}
+
+    if score >= REVIEW_SCORE and (hits.keys() & (_PII | {"violence"})):
+        reasons = [f"prefilter_{cat}" for cat in sorted(hits)]
+        return {"action": "review", "risk": "high", "reasons": reasons}
+
+    return None
+
+
+# ---------------- Caché de veredictos ----------------
+
+_cache: "OrderedDict[str, dict]" = OrderedDict()
+_lock = threading.Lock()
+
+STATS = {
+    "total": 0,
+    "cache_hits": 0,
+    "prefilter_publish": 0,
+    "prefilter_review": 0,
+    "ai_calls": 0,
+}
+
+
+def _cache_get(h: str) -> Optional[dict]:
+    with _lock:
+        verdict = _cache.get(h)
+        if verdict is not None:
+            _cache.move_to_end(h)
+            return verdict
+    try:
+        from db import pg_conn
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE voces_moderation_cache
+                   SET hits = hits + 1, last_hit_at = NOW()
+                 WHERE content_hash=%s
+                RETURNING verdict;
+                """,
+                (h,),
+            )
+            row = cur.fetchone()
+            cx.commit()
+    except Exception:
+        return None
+    if not row:
+        return None
+    verdict = row[0] if not isinstance(row, dict) else row["verdict"]
+    if isinstance(verdict, str):
+        verdict = json.loads(verdict)
+    _cache_put_memory(h, verdict)
+    return verdict
+
+
+def _cache_put_memory(h: str, verdict: dict) -> None:
+    with _lock:
+        _cache[h] = verdict
+        _cache.move_to_end(h)
+        while len(_cache) > CACHE_MAX_ITEMS:
+            _cache.popitem(last=False)
+
+
+def _cache_put(h: str, verdict: dict, source: str) -> None:
+    _cache_put_memory(h, verdict)
+    try:
+        from db import pg_conn
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO voces_moderation_cache (content_hash, verdict, source)
+                VALUES (%s, %s::jsonb, %s)
+                ON CONFLICT (content_hash) DO UPDATE
+                   SET verdict = EXCLUDED.verdict, source = EXCLUDED.source;
+                """,
+                (h, json.dumps(verdict), source),
+            )
+            cx.commit()
+    except Exception:
+        # la caché en BD es opcional; la de memoria ya sirve para este proceso
+        pass
+
+
+def ensure_cache_table() -> None:
+    from db import pg_conn
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(SQL_CACHE)
+        cx.commit()
+
+
+def moderate(
+    title: str,
+    summary: Optional[str],
+    content: str,
+    ai_moderate: Callable[[str, Optional[str], str], dict],
+) -> dict:
+    """
+    Moderación con etapa local delante de la IA.
+    Solo se cachean veredictos reales (no los fallback por error o sin API key).
+    """
+    with _lock:
+        STATS["total"] += 1
+
+    if not PREFILTER_ENABLED:
+        with _lock:
+            STATS["ai_calls"] += 1
+        return ai_moderate(title, summary, content)
+
+    h = content_hash(title, summary, content)
+    cached = _cache_get(h)
+    if cached is not None and "prefilter_clean" in (cached.get("reasons") or []) \
+            and local_verdict(title, summary, content) is None:
+        cached = None  # publish local guardado con un límite anterior más laxo: que decida la IA
+    if cached is not None:
+        with _lock:
+            STATS["cache_hits"] += 1
+        return {**cached, "cached": True}
+
+    verdict = local_verdict(title, summary, content)
+    if verdict is not None:
+        with _lock:
+            STATS[f"prefilter_{verdict['action']}"] += 1
+        _cache_put(h, verdict, "prefilter")
+        return verdict
+
+    with _lock:
+        STATS["ai_calls"] += 1
+    verdict = ai_moderate(title, summary, content)
+    if not set(verdict.get("reasons") or []) & {"error_ia", "no_api_key"}:
+        _cache_put(h, verdict, "ai")
+    return verdict
+
+
+def stats() -> dict:
+    with _lock:
+        out = dict(STATS)
+    out["ai_calls_avoided"] = out["total"] - out["ai_calls"]
+    out["avoided_ratio"] = round(out["ai_calls_avoided"] / out["total"], 4) if out["total"] else 0.0
+    out["cache_items"] = len(_cache)
+    return out
+
+
+# ---------------- Réplica sobre fixtures etiquetados ----------------
+
+def replay(path: str) -> dict:
+    """
+    Reproduce un fichero JSONL de ejemplos etiquetados
+    ({"title", "summary", "content", "label": publish|review|reject}) y mide:
+      - cuántos resuelve la etapa local (sin IA)
+      - precisión de los publish locales (etiqueta publish)
+      - precisión de los review locales (etiqueta review o reject)
+    """
+    total = decided = 0
+    pub_ok = pub_n = rev_ok = rev_n = 0
+    errors = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            total += 1
+            v = local_verdict(item.get("title", ""), item.get("summary"), item.get("content", ""))
+            if v is None:
+                continue
+            decided += 1
+            label = item.get("label")
+            if v["action"] == "publish":
+                pub_n += 1
+                pub_ok += label == "publish"
+            else:
+                rev_n += 1
+                rev_ok += label in ("review", "reject")
+            if (v["action"] == "publish") != (label == "publish"):
+                errors.append({"title": item.get("title"), "label": label, "local": v["action"]})
+
+    return {
+        "total": total,
+        "decided_locally": decided,
+        "sent_to_ai": total - decided,
+        "publish_precision": round(pub_ok / pub_n, 4) if pub_n else None,
+        "review_precision": round(rev_ok / rev_n, 4) if rev_n else None,
+        "errors": errors,
+    }
+
+
+if __name__ == "__main__":
+    fixture = sys.argv[1] if len(sys.argv) > 1 else os.path.join("fixtures", "voces_moderacion.jsonl")
+    print(json.dumps(replay(fixture), ensure_ascii=False, indent=2))
@@ -1,17 +1,40 @@
 # voces_routes.py — Gestión de VOCES con moderación IA (Mediazion)
 # ---------------------------------------------------------------
 # Backend: FastAPI + PostgreSQL directo usando db.pg_conn (sin ORM).
+#
+# Moderación asíncrona:
+#   - POST /voces inserta el post como 'pending_ai' y responde al momento.
+#   - Un worker en segundo plano reclama posts 'pending_ai' de la tabla posts
+#     (FOR UPDATE SKIP LOCKED, seguro con varios workers/instancias), los modera
+#     por lotes y aplica la transición publish / review / reject.
+#   - Un barrido periódico libera los posts reclamados que se quedaron colgados.
+#   - Si la moderación falla (IA saturada, presupuesto), el post vuelve a la cola
+#     con backoff; tras MODERATION_MAX_ATTEMPTS intentos pasa a revisión manual.
 
 from fastapi import APIRouter, HTTPException, Query
 from pydantic import BaseModel, EmailStr
 from db import pg_conn
+import ai_admission
+import voces_prefilter
 from datetime import datetime
+from typing import Optional
+import asyncio
+import time
 import re
 import os
 import json
 
 voces_router = APIRouter(prefix="/voces", tags=["voces"])
 
+MODERATION_WORKER_ENABLED = str(os.getenv("VOCES_MODERATION_WORKER", "true")).strip().lower() in ("1", "true", "yes", "on")
+MODERATION_BATCH          = int(os.getenv("VOCES_MODERATION_BATCH", "5"))
+MODERATION_POLL_SECONDS   = float(os.getenv("VOCES_MODERATION_POLL_SECONDS", "10"))
+MODERATION_STUCK_MINUTES  = int(os.getenv("VOCES_MODERATION_STUCK_MINUTES", "10"))
+MODERATION_MAX_ATTEMPTS   = int(os.getenv("VOCES_MODERATION_MAX_ATTEMPTS", "3"))
+MODERATION_RETRY_SECONDS  = int(os.getenv("VOCES_MODERATION_RETRY_SECONDS", "30"))   # backoff tras el 1er fallo
+MODERATION_RETRY_MAX      = 900
+MODERATION_SWEEP_SECONDS  = 60
+
 
 # ---------------- Helpers ----------------
 
@@ -63,15 +86,18 @@ def _moderate_text(title: str, summary: str | None, content: str) -> dict:
 
         model_name = os.getenv("OPENAI_MODEL_GENERAL", "gpt-4o-mini")
 
-        resp = client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": texto},
-            ],
-            max_tokens=200,
-            temperature=0.0,
-        )
+        est = ai_admission.estimate_tokens(system_prompt, texto, max_output=200)
+        with ai_admission.admit(ai_admission.system_identity("voces"), est) as ticket:
+            resp = client.chat.completions.create(
+                model=model_name,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": texto},
+                ],
+                max_tokens=200,
+                temperature=0.0,
+            )
+            ticket.settle(resp)
 
         raw = (resp.choices[0].message.content or "").strip()
         cleaned = raw.replace("'", '"')
@@ -89,11 +115,247 @@ def _moderate_text(title: str, summary: str | None, content: str) -> dict:
             risk = "low"
 
         return {"action": action, "risk": risk, "reasons": reasons}
+    except ai_admission.AdmissionRejected:
+        # IA saturada: el post sigue en cola y se reintenta (no se publica sin moderar)
+        raise
     except Exception:
         # Cualquier error → no bloqueamos
         return {"action": "publish", "risk": "low", "reasons": ["error_ia"]}
 
 
+# ---------------- Cola de moderación (worker en segundo plano) ----------------
+
+SQL_MODERATION_COLS = """
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS moderation JSONB;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS moderation_attempts INTEGER DEFAULT 0;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS moderation_claimed_at TIMESTAMP NULL;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS moderation_next_at TIMESTAMP NULL;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS moderated_at TIMESTAMP NULL;
+CREATE INDEX IF NOT EXISTS posts_pending_ai_idx ON posts (created_at, id) WHERE status='pending_ai';
+"""
+
+_STATUS_BY_ACTION = {
+    "publish": "published",
+    "review": "pending_review",
+    "reject": "rejected",
+}
+
+_moderation_task: Optional[asyncio.Task] = None
+_moderation_wakeup: Optional[asyncio.Event] = None
+_moderation_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _ensure_moderation_cols() -> None:
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(SQL_MODERATION_COLS)
+        cx.commit()
+
+
+def _claim_pending(limit: int) -> list:
+    """Reclama hasta `limit` posts 'pending_ai' libres (SKIP LOCKED entre workers)."""
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE posts
+               SET moderation_claimed_at = NOW(),
+                   moderation_attempts = COALESCE(moderation_attempts, 0) + 1
+             WHERE id IN (
+                   SELECT id
+                     FROM posts
+                    WHERE status='pending_ai'
+                      AND moderation_claimed_at IS NULL
+                      AND (moderation_next_at IS NULL OR moderation_next_at <= NOW())
+                    ORDER BY created_at, id
+                    LIMIT %s
+                      FOR UPDATE SKIP LOCKED
+             )
+            RETURNING id, title, summary, content, moderation_attempts;
+            """,
+            (limit,),
+        )
+        rows = cur.fetchall() or []
+        cx.commit()
+    return [_row_dict(r, ["id", "title", "summary", "content", "moderation_attempts"]) for r in rows]
+
+
+def _apply_moderation(post_id: int, mod: dict) -> None:
+    """Aplica la transición según la acción de la IA (solo si sigue en 'pending_ai')."""
+    new_status = _STATUS_BY_ACTION.get(mod.get("action", "publish"), "published")
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE posts
+               SET status=%s,
+                   published_at = CASE WHEN %s='published' THEN NOW() ELSE published_at END,
+                   moderation=%s::jsonb,
+                   moderated_at=NOW(),
+                   moderation_claimed_at=NULL
+             WHERE id=%s AND status='pending_ai';
+            """,
+            (new_status, new_status, json.dumps(mod), post_id),
+        )
+        cx.commit()
+
+
+def _release_claim(post_id: int, attempts: int, reason: str) -> None:
+    """
+    Devuelve el post a la cola con backoff (p. ej. la IA estaba saturada). Con
+    MODERATION_MAX_ATTEMPTS intentos agotados pasa a revisión manual.
+    """
+    with pg_conn() as cx, cx.cursor() as cur:
+        if attempts >= MODERATION_MAX_ATTEMPTS:
+            cur.execute(
+                """
+                UPDATE posts
+                   SET status='pending_review',
+                       moderation=%s::jsonb,
+                       moderated_at=NOW(),
+                       moderation_claimed_at=NULL
+                 WHERE id=%s AND status='pending_ai';
+                """,
+                (json.dumps({"action": "review", "risk": "medium", "reasons": [reason]}), post_id),
+            )
+        else:
+            delay = min(MODERATION_RETRY_MAX, MODERATION_RETRY_SECONDS * 2 ** max(0, attempts - 1))
+            cur.execute(
+                """
+                UPDATE posts
+                   SET moderation_claimed_at=NULL,
+                       moderation_next_at=NOW() + (%s * INTERVAL '1 second')
+                 WHERE id=%s AND status='pending_ai';
+                """,
+                (delay, post_id),
+            )
+        cx.commit()
+
+
+def _sweep_stuck() -> None:
+    """
+    Re-encola posts reclamados hace más de MODERATION_STUCK_MINUTES (worker caído).
+    Tras MODERATION_MAX_ATTEMPTS intentos pasan a revisión manual.
+    """
+    with pg_conn() as cx, cx.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE posts
+               SET status='pending_review',
+                   moderation=%s::jsonb,
+                   moderated_at=NOW(),
+                   moderation_claimed_at=NULL
+             WHERE status='pending_ai'
+               AND moderation_claimed_at < NOW() - (%s || ' minutes')::interval
+               AND COALESCE(moderation_attempts, 0) >= %s;
+            """,
+            (
+                json.dumps({"action": "review", "risk": "medium", "reasons": ["moderation_timeout"]}),
+                MODERATION_STUCK_MINUTES,
+                MODERATION_MAX_ATTEMPTS,
+            ),
+        )
+        cur.execute(
+            """
+            UPDATE posts
+               SET moderation_claimed_at=NULL
+             WHERE status='pending_ai'
+               AND moderation_claimed_at < NOW() - (%s || ' minutes')::interval;
+            """,
+            (MODERATION_STUCK_MINUTES,),
+        )
+        cx.commit()
+
+
+async def _moderate_pending_batch() -> int:
+    """Modera un lote de posts pendientes. Devuelve cuántos se han moderado de verdad."""
+    posts = await asyncio.to_thread(_claim_pending, MODERATION_BATCH)
+    if not posts:
+        return 0
+
+    results = await asyncio.gather(
+        *(
+            asyncio.to_thread(
+                voces_prefilter.moderate, p["title"], p["summary"], p["content"], _moderate_text
+            )
+            for p in posts
+        ),
+        return_exceptions=True,
+    )
+    moderated = 0
+    for p, mod in zip(posts, results):
+        if isinstance(mod, BaseException):
+            reason = "moderation_unavailable" if isinstance(mod, ai_admission.AdmissionRejected) else "moderation_error"
+            await asyncio.to_thread(_release_claim, p["id"], p["moderation_attempts"] or 0, reason)
+            continue
+        try:
+            await asyncio.to_thread(_apply_moderation, p["id"], mod)
+            moderated += 1
+        except Exception as e:
+            # el barrido lo re-encolará
+            print(f"[Voces] Error aplicando moderación al post {p['id']}: {e}")
+    return moderated
+
+
+async def _moderation_worker() -> None:
+    try:
+        await asyncio.to_thread(_ensure_moderation_cols)
+        await asyncio.to_thread(voces_prefilter.ensure_cache_table)
+    except Exception as e:
+        print(f"[Voces] No se pudieron asegurar columnas de moderación: {e}")
+
+    last_sweep = 0.0
+    while True:
+        processed = 0
+        _moderation_wakeup.clear()
+        try:
+            if time.monotonic() - last_sweep > MODERATION_SWEEP_SECONDS:
+                await asyncio.to_thread(_sweep_stuck)
+                last_sweep = time.monotonic()
+            processed = await _moderate_pending_batch()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[Voces] Error en el worker de moderación: {e}")
+
+        # Lote completo moderado → seguimos sin esperar; si no (cola vacía o fallos,
+        # que ya quedan con backoff), dormimos hasta aviso o timeout
+        if processed < MODERATION_BATCH:
+            try:
+                await asyncio.wait_for(_moderation_wakeup.wait(), MODERATION_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+
+def _wake_moderation_worker() -> None:
+    """Despierta al worker tras un INSERT (llamado desde el threadpool de FastAPI)."""
+    if _moderation_loop is not None and _moderation_wakeup is not None:
+        try:
+            _moderation_loop.call_soon_threadsafe(_moderation_wakeup.set)
+        except RuntimeError:
+            # loop cerrado (apagado): el post sigue en cola para el siguiente arranque
+            pass
+
+
+@voces_router.on_event("startup")
+async def _start_moderation_worker():
+    global _moderation_task, _moderation_wakeup, _moderation_loop
+    if not MODERATION_WORKER_ENABLED or _moderation_task is not None:
+        return
+    _moderation_loop = asyncio.get_running_loop()
+    _moderation_wakeup = asyncio.Event()
+    _moderation_task = asyncio.create_task(_moderation_worker())
+
+
+@voces_router.on_event("shutdown")
+async def _stop_moderation_worker():
+    global _moderation_task
+    if _moderation_task is not None:
+        _moderation_task.cancel()
+        try:
+            await _moderation_task
+        except asyncio.CancelledError:
+            pass
+        _moderation_task = None
+
+
 # ---------------- Modelos ----------------
 
 class VozCreate(BaseModel):
@@ -122,15 +384,15 @@ class CommentIn(BaseModel):
 @voces_router.post("")
 def crear_con_moderacion(body: VozCreate):
     """
-    Crea un post y aplica moderación IA inmediatamente.
+    Crea un post y lo deja en cola para moderación IA.
 
     Flujo:
-      - Inserta con status='pending_ai'
-      - Llama a IA
-      - action:
+      - Inserta con status='pending_ai' y responde inmediatamente.
+      - El worker de moderación aplica después:
           - publish → status='published', published_at=NOW()
           - review  → status='pending_review'
           - reject  → status='rejected'
+      - El editor consulta el resultado en GET /voces/{id}/moderation.
     """
     email = body.email.strip().lower()
     title = body.title.strip()
@@ -142,7 +404,6 @@ def crear_con_moderacion(body: VozCreate):
 
     slug = _slugify(title)
 
-    # 1) Insertar como pending_ai
     try:
         with pg_conn() as cx, cx.cursor() as cur:
             cur.execute(
@@ -163,51 +424,14 @@ def crear_con_moderacion(body: VozCreate):
     except Exception as e:
         raise HTTPException(500, f"No se pudo crear el borrador: {e}")
 
-    # 2) Moderar con IA (no bloqueante si falla)
-    mod = _moderate_text(title, summary, content)
-    action = mod.get("action", "publish")
-
-    new_status = "published"
-    set_published_at = True
-    if action == "review":
-        new_status = "pending_review"
-        set_published_at = False
-    elif action == "reject":
-        new_status = "rejected"
-        set_published_at = False
-
-    try:
-        with pg_conn() as cx, cx.cursor() as cur:
-            if set_published_at:
-                cur.execute(
-                    """
-                    UPDATE posts
-                       SET status=%s,
-                           published_at=NOW()
-                     WHERE id=%s;
-                    """,
-                    (new_status, post_id),
-                )
-            else:
-                cur.execute(
-                    """
-                    UPDATE posts
-                       SET status=%s
-                     WHERE id=%s;
-                    """,
-                    (new_status, post_id),
-                )
-            cx.commit()
-    except Exception:
-        # Si falla esta parte, dejamos pending_ai en DB y no rompemos nada
-        pass
+    _wake_moderation_worker()
 
     return {
         "ok": True,
         "id": post_id,
         "slug": slug,
-        "status": new_status,
-        "moderation": mod,
+        "status": "pending_ai",
+        "moderation": None,
     }
 
 
@@ -282,6 +506,57 @@ def publicar_manual(post_id: int, email: EmailStr = Query(...)):
     return {"ok": True, "id": post_id, "slug": slug}
 
 
+# ---------------- Estadísticas de pre-moderación ----------------
+
+@voces_router.get("/moderation/stats")
+def moderation_stats():
+    """Llamadas a la IA evitadas por la caché y el filtro local (este proceso)."""
+    return {"ok": True, "stats": voces_prefilter.stats()}
+
+
+# ---------------- Estado de moderación (polling del editor) ----------------
+
+@voces_router.get("/{post_id}/moderation")
+def estado_moderacion(post_id: int, email: EmailStr = Query(...)):
+    """
+    Estado de moderación de un post del autor.
+    pending_ai → en cola; published / pending_review / rejected → resultado final.
+    """
+    email_norm = email.strip().lower()
+    COLS = ["id", "slug", "author_email", "status", "moderation", "moderated_at"]
+
+    try:
+        with pg_conn() as cx, cx.cursor() as cur:
+            cur.execute(
+                """
+                SELECT id, slug, author_email, status, moderation, moderated_at
+                  FROM posts
+                 WHERE id=%s;
+                """,
+                (post_id,),
+            )
+            row = cur.fetchone()
+    except Exception as e:
+        raise HTTPException(500, f"Error consultando moderación: {e}")
+
+    if not row:
+        raise HTTPException(404, "Post no encontrado.")
+
+    d = _row_dict(row, COLS)
+    if (d.get("author_email") or "").lower() != email_norm:
+        raise HTTPException(403, "No puedes consultar un post de otro usuario.")
+
+    return {
+        "ok": True,
+        "id": d["id"],
+        "slug": d["slug"],
+        "status": d["status"],
+        "pending": d["status"] == "pending_ai",
+        "moderation": d.get("moderation"),
+        "moderated_at": d["moderated_at"].isoformat() if d.get("moderated_at") else None,
+    }
+
+
 # ---------------- Listado público ----------------
 
 @voces_router.get("/public")